@@ -0,0 +1,110 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+import spotipy
+from spotipy.oauth2 import SpotifyClientCredentials
+import soundcloud
+from googleapiclient.discovery import build
+
+class ClientProvider:
+    """
+    Holds long-lived, authenticated API clients and pooled keep-alive HTTP
+    sessions shared by the whole process.
+
+    Clients are created on first use and keyed by their credentials, so every
+    caller with the same credentials reuses one client, one connection pool and
+    one OAuth token (spotipy's credentials manager only fetches a new token
+    once the cached one has expired).
+    """
+    def __init__(self, pool_connections=None, pool_maxsize=None, timeout=10):
+        """
+        Args:
+            pool_connections (int, optional): Number of hosts to keep pools for per session. Defaults to HTTP_POOL_CONNECTIONS or 10.
+            pool_maxsize (int, optional): Keep-alive connections per host. Defaults to HTTP_POOL_MAXSIZE or 32.
+            timeout (float, optional): Default request timeout in seconds.
+        """
+        self.pool_connections = pool_connections or int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+        self.pool_maxsize = pool_maxsize or int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+        self.timeout = timeout
+        self.sessions = {}
+        self.clients = {}
+        self._lock = threading.Lock()
+        self._thread_clients = threading.local()
+
+    def session(self, name="default"):
+        """Returns the pooled keep-alive session called `name`."""
+        with self._lock:
+            session = self.sessions.get(name)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[name] = session
+            return session
+
+    def _get_client(self, key, factory):
+        with self._lock:
+            client = self.clients.get(key)
+        if client is None:
+            created = factory()
+            with self._lock:
+                client = self.clients.setdefault(key, created)
+        return client
+
+    def spotify(self, client_id=None, client_secret=None):
+        """Returns a shared spotipy client, using SPOTIFY_CLIENT_ID/SECRET by default."""
+        client_id = client_id or os.getenv("SPOTIFY_CLIENT_ID")
+        client_secret = client_secret or os.getenv("SPOTIFY_CLIENT_SECRET")
+
+        def create():
+            credentials_manager = SpotifyClientCredentials(
+                client_id=client_id,
+                client_secret=client_secret,
+                requests_session=self.session("spotify-auth"),
+            )
+            return spotipy.Spotify(
+                client_credentials_manager=credentials_manager,
+                requests_session=self.session("spotify"),
+                requests_timeout=self.timeout,
+            )
+
+        return self._get_client(("spotify", client_id, client_secret), create)
+
+    def soundcloud(self, client_id=None, client_secret=None):
+        """Returns a shared SoundCloud client, using SOUNDCLOUD_CLIENT_ID/SECRET by default."""
+        client_id = client_id or os.getenv("SOUNDCLOUD_CLIENT_ID")
+        client_secret = client_secret or os.getenv("SOUNDCLOUD_CLIENT_SECRET")
+        return self._get_client(
+            ("soundcloud", client_id, client_secret),
+            lambda: soundcloud.Client(client_id=client_id, client_secret=client_secret),
+        )
+
+    def youtube(self, api_key=None):
+        """
+        Returns a YouTube Data API client, using YOUTUBE_API_KEY by default.
+
+        googleapiclient's HTTP transport is not thread-safe, so each worker
+        thread gets its own long-lived client.
+        """
+        api_key = api_key or os.getenv("YOUTUBE_API_KEY")
+        youtube_clients = getattr(self._thread_clients, "youtube", None)
+        if youtube_clients is None:
+            youtube_clients = self._thread_clients.youtube = {}
+        client = youtube_clients.get(api_key)
+        if client is None:
+            client = youtube_clients[api_key] = build('youtube', 'v3', developerKey=api_key, cache_discovery=False)
+        return client
+
+    def close(self):
+        """Closes every pooled session."""
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+            self.clients.clear()
+
+# Shared provider for the whole process
+clients = ClientProvider()
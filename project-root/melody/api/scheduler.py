@@ -0,0 +1,294 @@
+import contextlib
+import contextvars
+import datetime
+import email.utils
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from melody.utils import metrics
+
+# Priority classes; lower values are served first
+PRIORITY_NOW_PLAYING = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+
+# The priority of API calls made from the current context. Tasks and the
+# resolver's worker threads inherit it from whoever started them.
+current_priority = contextvars.ContextVar("request_priority", default=PRIORITY_INTERACTIVE)
+# The time.monotonic() by which the caller stops waiting for the result, e.g.
+# the resolver's timeout; calls waiting past it for a request slot give up
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+# Requests per second and burst size allowed for each service
+DEFAULT_BUDGETS = {
+    "youtube": (5.0, 10),
+    "spotify": (10.0, 20),
+    "soundcloud": (5.0, 10),
+}
+DEFAULT_BUDGET = (10.0, 10)
+
+MAX_RETRIES = 3
+# Backoff after a rate limit that doesn't say how long to wait, doubled on each retry
+BASE_BACKOFF = 1.0
+# Callers give up rather than wait longer than this for a request slot
+MAX_QUEUE_WAIT = 30.0
+# YouTube's daily quota only resets at midnight Pacific time; checking again hourly costs one request
+QUOTA_BACKOFF = 60 * 60
+
+# Reasons Google APIs give in 403 responses that are really rate limits
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+QUOTA_REASONS = ("quotaExceeded", "dailyLimitExceeded")
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """
+    Runs the enclosed code, and any task or resolver lookup it starts, at `priority`.
+
+    Example:
+        with request_priority(PRIORITY_BACKGROUND):
+            task = asyncio.ensure_future(song.get_audio_stream())
+    """
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+class RateLimited(Exception):
+    """Raised when a service is rate limited for longer than a caller may wait."""
+    def __init__(self, service, retry_after):
+        super().__init__(f"{service} is rate limited; try again in {retry_after:.0f}s")
+        self.service = service
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header, given in seconds or as an HTTP date.
+
+    Returns:
+        float: Seconds to wait, or None if the header is missing or malformed.
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+def error_response(error):
+    """
+    Returns the HTTP status, headers and body text behind an API client error.
+
+    Understands spotipy's SpotifyException, googleapiclient's HttpError and
+    requests' HTTPError (used by the SoundCloud client).
+
+    Returns:
+        tuple: (status, headers, text), or (None, {}, "") for other errors.
+    """
+    # spotipy
+    status = getattr(error, "http_status", None)
+    if status is not None:
+        return status, getattr(error, "headers", None) or {}, str(error)
+    # googleapiclient; its headers are a dict with lowercase names
+    resp = getattr(error, "resp", None)
+    if resp is not None and hasattr(resp, "status"):
+        return resp.status, resp, str(error)
+    # requests
+    response = getattr(error, "response", None)
+    if response is not None and hasattr(response, "status_code"):
+        return response.status_code, response.headers, response.text
+    return None, {}, ""
+
+def rate_limit_delay(error):
+    """
+    Decides whether an error means the service is rate limiting us.
+
+    Returns:
+        float: Seconds to back off (0 when the service didn't say), or None
+            if the error has nothing to do with rate limits.
+    """
+    status, headers, text = error_response(error)
+    if status == 403 and any(reason in text for reason in QUOTA_REASONS):
+        return QUOTA_BACKOFF
+    if status in (429, 503) or (status == 403 and any(reason in text for reason in RATE_LIMIT_REASONS)):
+        return parse_retry_after(headers.get("retry-after")) or 0.0
+    return None
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, and bursts of up to `burst`."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Returns the seconds until a token is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class ServiceQueue:
+    """The budget, waiting callers and backoff state of one service."""
+    def __init__(self, service, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        # Waiting callers as (priority, arrival) entries; only the head may take a token
+        self.waiters = []
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.queue_delay = metrics.histogram(f"{service}_api_queue_ms")
+        self.rate_limited = metrics.counter(f"{service}_api_rate_limited")
+        self.coalesced = metrics.counter(f"{service}_api_coalesced")
+
+class RequestScheduler:
+    """
+    Paces every call to a rate-limited API so the bot stays within its budgets.
+
+    Callers (usually the resolver's worker threads) wait in a per-service
+    queue ordered by priority, then arrival; the head of the queue goes once
+    the service's token bucket has a token. When a service answers with a
+    rate limit, the whole service is paused for its Retry-After (or an
+    exponential backoff) instead of each caller retrying on its own, and the
+    call is retried. Identical calls made while one is in flight share it.
+    """
+    def __init__(self, budgets=None, max_retries=MAX_RETRIES, max_wait=MAX_QUEUE_WAIT):
+        """
+        Args:
+            budgets (dict, optional): (requests per second, burst) per service, over DEFAULT_BUDGETS.
+            max_retries (int, optional): Retries of a rate-limited call.
+            max_wait (float, optional): The longest a caller waits for a slot before RateLimited is
+                raised; callers with an earlier request_deadline give up at that instead.
+        """
+        self.budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.queues = {}
+        self._flights = {}
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+
+    def queue(self, service):
+        with self._lock:
+            queue = self.queues.get(service)
+            if queue is None:
+                rate, burst = self.budgets.get(service, DEFAULT_BUDGET)
+                queue = self.queues[service] = ServiceQueue(service, rate, burst)
+            return queue
+
+    def call(self, service, func, *args, key=None, **kwargs):
+        """
+        Runs `func(*args, **kwargs)` once the service's budget allows. Blocks, so call it from a worker thread.
+
+        Args:
+            service (str): The budget to spend, e.g. "spotify".
+            func (callable): The blocking API call.
+            key (hashable, optional): Identifies the request; callers with the
+                same key while it is in flight get its result instead of
+                making their own call.
+
+        Returns:
+            The result of `func`.
+
+        Raises:
+            RateLimited: The service stayed rate limited for longer than `max_wait`.
+        """
+        if key is None:
+            return self._call(service, func, args, kwargs)
+        flight_key = (service, key)
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[flight_key] = Future()
+        if not leader:
+            self.queue(service).coalesced.increment()
+            return flight.result()
+        try:
+            result = self._call(service, func, args, kwargs)
+            flight.set_result(result)
+            return result
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[flight_key]
+
+    def _call(self, service, func, args, kwargs):
+        queue = self.queue(service)
+        priority = current_priority.get()
+        for attempt in range(self.max_retries + 1):
+            self.acquire(queue, service, priority)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = rate_limit_delay(e)
+                if delay is None:
+                    raise
+                queue.rate_limited.increment()
+                if not delay:
+                    # Jittered so callers that failed together don't retry together
+                    delay = BASE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.0)
+                self.pause(service, delay)
+                if attempt == self.max_retries or time.monotonic() + delay > self.deadline():
+                    raise RateLimited(service, delay) from e
+
+    def deadline(self):
+        """Returns the time.monotonic() after which the caller stops waiting for a request slot."""
+        deadline = time.monotonic() + self.max_wait
+        caller_deadline = request_deadline.get()
+        return deadline if caller_deadline is None else min(deadline, caller_deadline)
+
+    def acquire(self, queue, service, priority):
+        """Waits for this caller's turn and a token, in priority order."""
+        started = time.monotonic()
+        deadline = self.deadline()
+        entry = (priority, next(self._arrivals))
+        with queue.condition:
+            heapq.heappush(queue.waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if queue.waiters[0] is entry:
+                        wait = max(queue.paused_until - now, queue.bucket.wait_time(now))
+                        if wait <= 0:
+                            heapq.heappop(queue.waiters)
+                            queue.bucket.take()
+                            # The next caller in line may be able to go too
+                            queue.condition.notify_all()
+                            break
+                        if now + wait > deadline:
+                            raise RateLimited(service, wait)
+                    elif now >= deadline:
+                        raise RateLimited(service, max(queue.paused_until - now, 0.0))
+                    else:
+                        wait = deadline - now
+                    queue.condition.wait(wait)
+            except BaseException:
+                queue.waiters.remove(entry)
+                heapq.heapify(queue.waiters)
+                queue.condition.notify_all()
+                raise
+        queue.queue_delay.record((time.monotonic() - started) * 1000)
+
+    def pause(self, service, seconds):
+        """Holds back every request to a service for `seconds`."""
+        queue = self.queue(service)
+        with queue.condition:
+            queue.paused_until = max(queue.paused_until, time.monotonic() + seconds)
+            queue.condition.notify_all()
+
+# Shared scheduler used by every API wrapper
+default_scheduler = RequestScheduler()
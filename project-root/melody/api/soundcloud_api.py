@@ -1,17 +1,32 @@
-import soundcloud
-from soundcloud.resource import Resource
-import requests
+from melody.api.clients import clients
+from melody.api.scheduler import default_scheduler
+from melody.utils.cache import resolution_cache
+from melody.utils.source_router import canonical_key
 
 class SoundCloudAPI:
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, cache=None, scheduler=None):
         self.client_id = client_id
         self.client_secret = client_secret
-        self.client = soundcloud.Client(client_id=self.client_id, client_secret=self.client_secret)
+        self.cache = cache if cache is not None else resolution_cache
+        self.scheduler = scheduler or default_scheduler
+        self.client = clients.soundcloud(self.client_id, self.client_secret)
+
+    def request(self, path, **params):
+        """Makes a GET request once the SoundCloud budget allows, retrying if rate limited."""
+        return self.scheduler.call("soundcloud", self.client.get, path, **params)
+
+    def resolve(self, url):
+        """Resolves a SoundCloud URL to its resource, serving repeat lookups from the shared cache."""
+        return self.cache.get_or_load(
+            f"soundcloud:resolve:{canonical_key(url)}",
+            lambda: self.request('/resolve', url=url),
+            source="soundcloud",
+        )
 
     def search_track(self, query):
         """Searches for a track on SoundCloud."""
         try:
-            tracks = self.client.get('/tracks', q=query)
+            tracks = self.request('/tracks', q=query)
             return tracks
         except Exception as e:
             print(f"Error searching for track on SoundCloud: {e}")
@@ -20,7 +35,7 @@ class SoundCloudAPI:
     def get_track_info(self, track_url):
         """Retrieves detailed information about a track."""
         try:
-            track = self.client.get('/resolve', url=track_url)
+            track = self.resolve(track_url)
             return track
         except Exception as e:
             print(f"Error retrieving track information from SoundCloud: {e}")
@@ -29,7 +44,7 @@ class SoundCloudAPI:
     def get_playlist_tracks(self, playlist_url):
         """Retrieves tracks from a SoundCloud playlist."""
         try:
-            playlist = self.client.get('/resolve', url=playlist_url)
+            playlist = self.request('/resolve', url=playlist_url)
             tracks = playlist.tracks
             return tracks
         except Exception as e:
@@ -39,7 +54,7 @@ class SoundCloudAPI:
     def get_user_playlists(self, user_id):
         """Retrieves playlists belonging to a user."""
         try:
-            playlists = self.client.get(f'/users/{user_id}/playlists')
+            playlists = self.request(f'/users/{user_id}/playlists')
             return playlists
         except Exception as e:
             print(f"Error retrieving playlists from SoundCloud user: {e}")
@@ -48,7 +63,7 @@ class SoundCloudAPI:
     def get_track_audio_url(self, track_url):
         """Retrieves the audio URL for a SoundCloud track."""
         try:
-            track = self.client.get('/resolve', url=track_url)
+            track = self.resolve(track_url)
             audio_url = track.stream_url
             return audio_url
         except Exception as e:
@@ -1,18 +1,35 @@
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-import requests
+from melody.api.clients import clients
+from melody.api.scheduler import default_scheduler
+from melody.utils.cache import resolution_cache
+
+# Only the track fields the player needs, which keeps large playlist pages small
+PLAYLIST_PAGE_FIELDS = "total,items(track(id,name,duration_ms,is_local,type,artists(name)))"
 
 class SpotifyAPI:
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, cache=None, scheduler=None):
         self.client_id = client_id
         self.client_secret = client_secret
-        self.client_credentials_manager = SpotifyClientCredentials(client_id=self.client_id, client_secret=self.client_secret)
-        self.sp = spotipy.Spotify(client_credentials_manager=self.client_credentials_manager)
+        self.cache = cache if cache is not None else resolution_cache
+        self.scheduler = scheduler or default_scheduler
+        self.sp = clients.spotify(self.client_id, self.client_secret)
+        self.client_credentials_manager = self.sp.client_credentials_manager
+
+    def request(self, method, *args, key=None, **kwargs):
+        """Calls a spotipy method once the Spotify budget allows, retrying if rate limited."""
+        return self.scheduler.call("spotify", method, *args, key=key, **kwargs)
+
+    def get_cached_track(self, track_id):
+        """Fetches a track object, serving repeat lookups from the shared cache."""
+        return self.cache.get_or_load(f"spotify:track:{track_id}", lambda: self.request(self.sp.track, track_id), source="spotify")
 
     def search_track(self, query):
         """Searches for a track on Spotify based on a query."""
         try:
-            results = self.sp.search(q=query, type='track', limit=1)
+            results = self.cache.get_or_load(
+                f"spotify:search:{query.strip().lower()}",
+                lambda: self.request(self.sp.search, q=query, type='track', limit=1),
+                source="spotify",
+            )
             if results['tracks']['items']:
                 track_info = results['tracks']['items'][0]
                 return track_info
@@ -25,7 +42,7 @@ class SpotifyAPI:
     def get_track_info(self, track_id):
         """Retrieves detailed information about a track."""
         try:
-            track_info = self.sp.track(track_id)
+            track_info = self.get_cached_track(track_id)
             return track_info
         except Exception as e:
             print(f"Error retrieving track information from Spotify: {e}")
@@ -34,16 +51,43 @@ class SpotifyAPI:
     def get_playlist_tracks(self, playlist_id):
         """Retrieves tracks from a Spotify playlist."""
         try:
-            tracks = self.sp.playlist_tracks(playlist_id)
+            tracks = self.request(self.sp.playlist_tracks, playlist_id)
             return tracks['items']
         except Exception as e:
             print(f"Error retrieving tracks from Spotify playlist: {e}")
             return None
 
+    def get_playlist_page(self, playlist_id, offset=0, limit=100):
+        """Retrieves one page of a Spotify playlist's tracks, trimmed to the fields needed for queueing."""
+        try:
+            page = self.request(
+                self.sp.playlist_items,
+                playlist_id,
+                fields=PLAYLIST_PAGE_FIELDS,
+                limit=limit,
+                offset=offset,
+                additional_types=('track',),
+                # Players queueing the same playlist at once share each page
+                key=f"playlist:{playlist_id}:{offset}:{limit}",
+            )
+            return page
+        except Exception as e:
+            print(f"Error retrieving page of Spotify playlist: {e}")
+            return None
+
+    def get_album_page(self, album_id, offset=0, limit=50):
+        """Retrieves one page of a Spotify album's tracks."""
+        try:
+            page = self.request(self.sp.album_tracks, album_id, limit=limit, offset=offset, key=f"album:{album_id}:{offset}:{limit}")
+            return page
+        except Exception as e:
+            print(f"Error retrieving page of Spotify album: {e}")
+            return None
+
     def get_user_playlists(self, user_id):
         """Retrieves playlists belonging to a user."""
         try:
-            playlists = self.sp.user_playlists(user_id)
+            playlists = self.request(self.sp.user_playlists, user_id)
             return playlists['items']
         except Exception as e:
             print(f"Error retrieving playlists from Spotify user: {e}")
@@ -52,7 +96,7 @@ class SpotifyAPI:
     def get_track_audio_url(self, track_id):
         """Retrieves the audio URL for a Spotify track."""
         try:
-            track_info = self.sp.track(track_id)
+            track_info = self.get_cached_track(track_id)
             audio_url = track_info['preview_url']
             return audio_url
         except Exception as e:
@@ -62,7 +106,7 @@ class SpotifyAPI:
     def get_artist_info(self, artist_id):
         """Retrieves detailed information about an artist."""
         try:
-            artist_info = self.sp.artist(artist_id)
+            artist_info = self.request(self.sp.artist, artist_id)
             return artist_info
         except Exception as e:
             print(f"Error retrieving artist information from Spotify: {e}")
@@ -71,7 +115,7 @@ class SpotifyAPI:
     def get_artist_albums(self, artist_id):
         """Retrieves albums by an artist."""
         try:
-            albums = self.sp.artist_albums(artist_id)
+            albums = self.request(self.sp.artist_albums, artist_id)
             return albums['items']
         except Exception as e:
             print(f"Error retrieving albums from Spotify artist: {e}")
@@ -80,7 +124,7 @@ class SpotifyAPI:
     def get_album_tracks(self, album_id):
         """Retrieves tracks from an album."""
         try:
-            tracks = self.sp.album_tracks(album_id)
+            tracks = self.request(self.sp.album_tracks, album_id)
             return tracks['items']
         except Exception as e:
             print(f"Error retrieving tracks from Spotify album: {e}")
@@ -89,7 +133,7 @@ class SpotifyAPI:
     def get_related_artists(self, artist_id):
         """Retrieves related artists."""
         try:
-            artists = self.sp.artist_related_artists(artist_id)
+            artists = self.request(self.sp.artist_related_artists, artist_id)
             return artists['artists']
         except Exception as e:
             print(f"Error retrieving related artists from Spotify: {e}")
@@ -98,7 +142,7 @@ class SpotifyAPI:
     def get_user_profile(self, user_id):
         """Retrieves a user's profile information."""
         try:
-            profile = self.sp.user(user_id)
+            profile = self.request(self.sp.user, user_id)
             return profile
         except Exception as e:
             print(f"Error retrieving user profile from Spotify: {e}")
@@ -107,7 +151,7 @@ class SpotifyAPI:
     def get_user_top_tracks(self, user_id, time_range='medium_term'):
         """Retrieves a user's top tracks."""
         try:
-            top_tracks = self.sp.current_user_top_tracks(time_range=time_range, limit=50)
+            top_tracks = self.request(self.sp.current_user_top_tracks, time_range=time_range, limit=50)
             return top_tracks['items']
         except Exception as e:
             print(f"Error retrieving user's top tracks from Spotify: {e}")
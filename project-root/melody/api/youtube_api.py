@@ -1,21 +1,37 @@
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import requests
+
+from melody.api.clients import clients
+from melody.api.scheduler import RateLimited, default_scheduler
+from melody.utils.cache import resolution_cache
 
 class YouTubeAPI:
-    def __init__(self, api_key):
+    def __init__(self, api_key, cache=None, scheduler=None):
         self.api_key = api_key
-        self.youtube = build('youtube', 'v3', developerKey=self.api_key)
+        self.cache = cache if cache is not None else resolution_cache
+        self.scheduler = scheduler or default_scheduler
+
+    @property
+    def youtube(self):
+        # One pooled client per worker thread, shared by every YouTubeAPI
+        return clients.youtube(self.api_key)
+
+    def request(self, request):
+        """Executes an API request once the YouTube budget allows, retrying if rate limited."""
+        return self.scheduler.call("youtube", request.execute)
 
     def search_video(self, query):
         """Searches for a video on YouTube based on a query."""
         try:
-            search_response = self.youtube.search().list(
-                q=query,
-                part='id,snippet',
-                maxResults=1,
-                type='video'
-            ).execute()
+            search_response = self.cache.get_or_load(
+                f"youtube:search:{query.strip().lower()}",
+                lambda: self.request(self.youtube.search().list(
+                    q=query,
+                    part='id,snippet',
+                    maxResults=1,
+                    type='video'
+                )),
+                source="youtube",
+            )
 
             if search_response['items']:
                 video_id = search_response['items'][0]['id']['videoId']
@@ -23,17 +39,21 @@ class YouTubeAPI:
             else:
                 return None
 
-        except HttpError as e:
+        except (HttpError, RateLimited) as e:
             print(f'Error searching for video on YouTube: {e}')
             return None
 
     def get_video_info(self, video_id):
         """Retrieves detailed information about a YouTube video."""
         try:
-            video_response = self.youtube.videos().list(
-                part='snippet,contentDetails',
-                id=video_id
-            ).execute()
+            video_response = self.cache.get_or_load(
+                f"youtube:video:{video_id}",
+                lambda: self.request(self.youtube.videos().list(
+                    part='snippet,contentDetails',
+                    id=video_id
+                )),
+                source="youtube",
+            )
 
             if video_response['items']:
                 video_info = video_response['items'][0]
@@ -41,7 +61,7 @@ class YouTubeAPI:
             else:
                 return None
 
-        except HttpError as e:
+        except (HttpError, RateLimited) as e:
             print(f'Error retrieving video information from YouTube: {e}')
             return None
 
@@ -1,44 +1,203 @@
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
+import asyncio
+import functools
+import math
 import os
 
+from melody.database.async_database import AsyncDatabase
+from melody.database.cached_database import CachedDatabase
 from melody.music_player.music_player import MusicPlayer
+from melody.music_player.registry import GuildPlayerRegistry
+from melody.music_player.track_search import default_track_search
+from melody.utils.loudness import track_gains
+from melody.utils.lyrics_handler import LyricsHandler
+from melody.utils.synced_lyrics import KaraokeSession
+from melody.utils.opus_cache import default_opus_cache
+from melody.utils.source_router import route
 
 load_dotenv()
 
 # Get the Discord bot token from the environment variable
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 
-# Create an instance of the bot client
-bot = commands.Bot(command_prefix="!", intents=discord.Intents.all())
+# Seconds a guild's player may sit idle before it is evicted
+PLAYER_IDLE_TIMEOUT = float(os.getenv("PLAYER_IDLE_TIMEOUT", "600"))
 
-# Initialize the music player
-music_player = MusicPlayer()
+# Hand Opus from FFmpeg straight to Discord instead of encoding PCM in Python;
+# volume changes then take effect from the next song
+OPUS_PASSTHROUGH = os.getenv("OPUS_PASSTHROUGH", "false").lower() in ("1", "true", "yes")
 
-@bot.event
-async def on_ready():
+# Play every song at the same loudness; servers can still turn it off with !normalize
+NORMALIZE_LOUDNESS = os.getenv("NORMALIZE_LOUDNESS", "true").lower() in ("1", "true", "yes")
+
+# MongoDB settings; playlists and user data are unavailable without a URI
+MONGODB_URI = os.getenv("MONGODB_URI")
+MONGODB_DATABASE = os.getenv("MONGODB_DATABASE", "melody")
+MONGODB_POOL_SIZE = int(os.getenv("MONGODB_POOL_SIZE", "100"))
+
+# Seconds that user data and playlist additions may wait in memory before
+# being written to MongoDB; at most this much is lost if the process dies
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "5"))
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "10000"))
+
+# Seconds between a cluster's reports to the launcher's shared stats
+CLUSTER_STATS_INTERVAL = float(os.getenv("CLUSTER_STATS_INTERVAL", "30"))
+
+def create_intents():
     """
-    Event handler for when the bot is ready and connected to Discord.
+    Subscribes only to the gateway events the bot uses: guilds, voice states
+    and guild messages (with their content, for prefix commands). Presence and
+    member events, by far the heaviest, are never sent.
     """
-    print(f"Melody is online! Logged in as {bot.user}")
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    intents.message_content = True
+    return intents
 
-@bot.event
-async def on_message(message):
+class MelodyBot(commands.AutoShardedBot):
     """
-    Event handler for when a message is received from a user.
+    The bot client, which writes pending database changes before shutting down.
+
+    When run by the launcher, it handles a cluster of the bot's shards and
+    reports its stats to the other clusters through `cluster_stats`, a
+    dictionary shared by the launcher's manager process.
     """
-    # Ignore messages from the bot itself
-    if message.author == bot.user:
-        return
+    def __init__(self, *args, cluster_id=None, cluster_stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cluster_id = cluster_id
+        self.cluster_stats = cluster_stats
+        self.stats_task = None
+
+    async def on_ready(self):
+        """
+        Event handler for when the bot is ready and connected to Discord.
+        """
+        global eviction_task, database_connected
+        if eviction_task is None:
+            eviction_task = self.loop.create_task(players.run_eviction())
+            # Indexes the audio cache before the first song looks something up in it
+            self.loop.run_in_executor(None, default_opus_cache.load)
+        if database and not database_connected:
+            database_connected = True
+            await database.connect()
+            # Move playlists saved in the old embedded format in the background
+            self.loop.create_task(database.migrate_embedded_playlists())
+            # Searches for tracks played before resolve locally once they are indexed
+            self.loop.create_task(default_track_search.load())
+        if self.cluster_stats is not None and self.stats_task is None:
+            self.stats_task = self.loop.create_task(self.report_stats())
+        print(f"Melody is online! Logged in as {self.user} (shards {self.shard_ids or 'all'})")
+
+    async def on_message(self, message):
+        """
+        Event handler for when a message is received from a user.
+        """
+        # Ignore messages from the bot itself
+        if message.author == self.user:
+            return
+
+        # Process commands
+        await self.process_commands(message)
+
+    def local_stats(self):
+        """
+        Returns this process's guild, player and latency figures.
+        """
+        return {
+            "pid": os.getpid(),
+            "shards": list(self.shard_ids or sorted(self.shards)),
+            "guilds": len(self.guilds),
+            "players": len(players),
+            "playing": sum(1 for player in players if player.is_playing),
+            # NaN until the first heartbeat
+            "latency_ms": round(self.latency * 1000, 1) if math.isfinite(self.latency) else None,
+        }
+
+    async def report_stats(self):
+        """
+        Publishes this cluster's stats to the launcher every CLUSTER_STATS_INTERVAL seconds.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # The shared dictionary is a proxy; every access is a round-trip to the manager
+                await loop.run_in_executor(None, self.cluster_stats.__setitem__, self.cluster_id, self.local_stats())
+            except Exception as e:
+                print(f"Error reporting cluster stats: {e}")
+            await asyncio.sleep(CLUSTER_STATS_INTERVAL)
+
+    async def all_stats(self):
+        """
+        Returns the stats of every cluster, keyed by cluster ID (just this process outside the launcher).
+        """
+        if self.cluster_stats is None:
+            return {0: self.local_stats()}
+        loop = asyncio.get_running_loop()
+        stats = await loop.run_in_executor(None, dict, self.cluster_stats)
+        # This cluster's own figures needn't wait for its next report
+        stats[self.cluster_id] = self.local_stats()
+        return stats
 
-    # Process commands
-    await bot.process_commands(message)
+    async def close(self):
+        if self.stats_task:
+            self.stats_task.cancel()
+        if database and database_connected:
+            await database.close()
+        await super().close()
 
-@bot.command()
+# Plain lyrics need a Genius API key; synced lyrics for !karaoke don't
+GENIUS_API_KEY = os.getenv("GENIUS_API_KEY")
+lyrics_handler = LyricsHandler(GENIUS_API_KEY)
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+
+# The live lyrics task of each guild running !karaoke
+karaoke_tasks = {}
+
+# Disk cache of encoded audio for repeat plays; disabled without a directory
+OPUS_CACHE_DIR = os.getenv("OPUS_CACHE_DIR")
+OPUS_CACHE_SIZE_MB = int(os.getenv("OPUS_CACHE_SIZE_MB", "2048"))
+default_opus_cache.configure(OPUS_CACHE_DIR, max_bytes=OPUS_CACHE_SIZE_MB * 1024 * 1024)
+
+# One music player per guild, created on demand
+players = GuildPlayerRegistry(
+    idle_timeout=PLAYER_IDLE_TIMEOUT,
+    player_factory=functools.partial(
+        MusicPlayer,
+        opus_passthrough=OPUS_PASSTHROUGH,
+        normalize=NORMALIZE_LOUDNESS,
+        lyrics=lyrics_handler,
+    ),
+)
+eviction_task = None
+
+database = CachedDatabase(
+    AsyncDatabase(MONGODB_URI, MONGODB_DATABASE, max_pool_size=MONGODB_POOL_SIZE),
+    max_entries=DB_CACHE_SIZE,
+    flush_interval=DB_FLUSH_INTERVAL,
+) if MONGODB_URI else None
+database_connected = False
+
+# Measured track loudness, fetched lyrics and searchable tracks outlive restarts when there is a database to keep them in
+track_gains.configure(database)
+lyrics_handler.configure(database)
+default_track_search.configure(database)
+
+async def guild_only(ctx):
+    """
+    Music commands only make sense inside a guild.
+    """
+    return ctx.guild is not None
+
+@commands.command()
 async def play(ctx, *, query):
     """
-    Plays a song from YouTube, Spotify, or SoundCloud.
+    Plays a song from a YouTube, Spotify, or SoundCloud link, or searches for one.
     """
     # Join the voice channel if not already joined
     if not ctx.author.voice:
@@ -46,80 +205,301 @@ async def play(ctx, *, query):
         return
 
     voice_channel = ctx.author.voice.channel
-    if not bot.voice_clients:
+    if not ctx.voice_client:
         await voice_channel.connect()
-    else:
-        await bot.voice_clients[0].move_to(voice_channel)
+    elif ctx.voice_client.channel != voice_channel:
+        await ctx.voice_client.move_to(voice_channel)
 
     # Play the song
+    music_player = players.get(ctx.guild.id)
+    music_player.voice_client = ctx.voice_client
     await music_player.play(ctx, query)
 
-@bot.command()
+@commands.command()
 async def pause(ctx):
     """
     Pauses the current song.
     """
-    await music_player.pause(ctx)
+    await players.get(ctx.guild.id).pause(ctx)
 
-@bot.command()
+@commands.command()
 async def resume(ctx):
     """
     Resumes playback.
     """
-    await music_player.resume(ctx)
+    await players.get(ctx.guild.id).resume(ctx)
 
-@bot.command()
+@commands.command()
 async def skip(ctx):
     """
     Skips to the next song in the queue.
     """
-    await music_player.skip(ctx)
+    await players.get(ctx.guild.id).skip(ctx)
 
-@bot.command()
+@commands.command()
 async def stop(ctx):
     """
     Stops playback and clears the queue.
     """
-    await music_player.stop(ctx)
+    await players.get(ctx.guild.id).stop(ctx)
 
-@bot.command()
-async def queue(ctx):
+@commands.command()
+async def queue(ctx, page: int = 1):
     """
-    Shows the current song queue.
+    Shows a page of the current song queue.
     """
-    queue = music_player.get_queue(ctx)
-    if queue:
-        await ctx.send(f"**Queue:**\n{', '.join([song.title for song in queue])}")
-    else:
-        await ctx.send("The queue is empty.")
+    await ctx.send(players.get(ctx.guild.id).render_queue(ctx, page))
 
-@bot.command()
+@commands.command()
 async def volume(ctx, volume: int):
     """
     Adjusts the playback volume.
     """
-    await music_player.set_volume(ctx, volume)
+    await players.get(ctx.guild.id).set_volume(ctx, volume)
+
+@commands.command()
+async def loop(ctx, mode: str = None):
+    """
+    Toggles looping, or sets it to off, one (current song) or all (queue).
+    """
+    await players.get(ctx.guild.id).loop(ctx, mode.lower() if mode else None)
+
+@commands.command()
+async def bassboost(ctx, level: int):
+    """
+    Sets the bass boost from 0 (off) to 10.
+    """
+    await players.get(ctx.guild.id).set_bass_boost(ctx, level)
+
+@commands.command()
+async def normalize(ctx, mode: str):
+    """
+    Turns loudness normalization on or off.
+    """
+    await players.get(ctx.guild.id).set_normalize(ctx, mode.lower() in ("on", "true", "yes"))
+
+@commands.command()
+async def crossfade(ctx, seconds: float):
+    """
+    Sets how many seconds skipped songs fade into the next one (0 disables).
+    """
+    await players.get(ctx.guild.id).set_crossfade(ctx, seconds)
+
+@commands.command()
+async def shuffle(ctx):
+    """
+    Shuffles the queue.
+    """
+    await players.get(ctx.guild.id).shuffle(ctx)
+
+@commands.command()
+async def remove(ctx, position: int):
+    """
+    Removes the song at a queue position.
+    """
+    await players.get(ctx.guild.id).remove(ctx, position)
+
+@commands.command()
+async def move(ctx, source: int, destination: int):
+    """
+    Moves a song to a different queue position.
+    """
+    await players.get(ctx.guild.id).move(ctx, source, destination)
 
-@bot.command()
-async def loop(ctx):
+async def require_database(ctx):
     """
-    Toggles looping for the current song or queue.
+    Tells the user when playlists are unavailable because no database is configured.
     """
-    await music_player.loop(ctx)
+    if database is None:
+        await ctx.send("Playlists are not available on this bot.")
+        return False
+    return True
 
-@bot.command()
+@commands.command()
+async def createplaylist(ctx, *, name):
+    """
+    Creates a personal playlist.
+    """
+    if await require_database(ctx):
+        await database.create_playlist(name, ctx.author.id)
+        await ctx.send(f"Playlist '{name}' is ready.")
+
+@commands.command()
+async def addsong(ctx, name, url):
+    """
+    Adds a YouTube, Spotify, or SoundCloud link to one of your playlists.
+    """
+    if not await require_database(ctx):
+        return
+    key = route(url)
+    if not key or key.kind != "track":
+        await ctx.send("Invalid song source. Please provide a valid YouTube, Spotify, or SoundCloud link.")
+    elif await database.add_songs_to_playlist(name, [{"title": key.url, "url": key.url}], ctx.author.id):
+        await ctx.send(f"Added to playlist '{name}'.")
+    else:
+        await ctx.send(f"You don't have a playlist named '{name}'.")
+
+@commands.command()
+async def loadplaylist(ctx, *, name):
+    """
+    Queues one of your playlists.
+    """
+    if not await require_database(ctx):
+        return
+    if not ctx.author.voice:
+        await ctx.send("You are not connected to a voice channel.")
+        return
+
+    voice_channel = ctx.author.voice.channel
+    if not ctx.voice_client:
+        await voice_channel.connect()
+    elif ctx.voice_client.channel != voice_channel:
+        await ctx.voice_client.move_to(voice_channel)
+
+    # Songs are streamed from the database and queued batch by batch
+    music_player = players.get(ctx.guild.id)
+    music_player.voice_client = ctx.voice_client
+    await music_player.load_playlist(ctx, name, database.iter_playlist_songs(name, ctx.author.id))
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    Splits text into messages no longer than `limit`, breaking between lines where possible.
+    """
+    messages = []
+    current = ""
+    for line in text.splitlines():
+        while len(line) > limit:
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            messages.append(current)
+            candidate = line
+        current = candidate
+    if current:
+        messages.append(current)
+    return messages
+
+@commands.command()
+async def lyrics(ctx):
+    """
+    Shows the lyrics of the current song.
+    """
+    if lyrics_handler.genius is None:
+        await ctx.send("Lyrics are not available on this bot.")
+        return
+    song = players.get(ctx.guild.id).get_current_song(ctx)
+    if song is None:
+        await ctx.send("No song is currently playing.")
+        return
+    text = await lyrics_handler.fetch_lyrics(song.title)
+    if not text:
+        await ctx.send(f"Couldn't find lyrics for {song.title}.")
+        return
+    for message in split_message(f"**{song.title}**\n{text}"):
+        await ctx.send(message)
+
+@commands.command()
+async def karaoke(ctx):
+    """
+    Shows the current song's lyrics line by line as it plays.
+    """
+    player = players.get(ctx.guild.id)
+    song = player.get_current_song(ctx)
+    if song is None or player.playback_position() is None:
+        await ctx.send("No song is currently playing.")
+        return
+    synced = await lyrics_handler.fetch_synced_lyrics(song.title, duration=song.duration)
+    if synced is None:
+        await ctx.send(f"Couldn't find synced lyrics for {song.title}. Try `!lyrics` instead.")
+        return
+    previous = karaoke_tasks.pop(ctx.guild.id, None)
+    if previous:
+        previous.cancel()
+
+    def position():
+        # The session ends once another song starts
+        return player.playback_position() if player.get_current_song(ctx) is song else None
+
+    message = await ctx.send(f"**{song.title}**")
+    task = karaoke_tasks[ctx.guild.id] = asyncio.ensure_future(
+        KaraokeSession(message, synced, position, title=song.title).run()
+    )
+    task.add_done_callback(lambda _: karaoke_tasks.pop(ctx.guild.id, None) if karaoke_tasks.get(ctx.guild.id) is task else None)
+
+@commands.command()
 async def connect(ctx):
     """
     Joins the voice channel you're in.
     """
-    await music_player.connect_voice(ctx)
+    await players.get(ctx.guild.id).connect_voice(ctx)
 
-@bot.command()
+@commands.command()
 async def disconnect(ctx):
     """
     Disconnects from the voice channel.
     """
-    await music_player.disconnect_voice(ctx)
+    await players.get(ctx.guild.id).disconnect_voice(ctx)
+
+@commands.command()
+async def stats(ctx):
+    """
+    Shows how many servers and players each cluster of the bot is handling.
+    """
+    clusters = await ctx.bot.all_stats()
+    lines = [
+        f"Cluster {cluster_id} (shards {', '.join(map(str, cluster['shards']))}): "
+        f"{cluster['guilds']} servers, {cluster['playing']}/{cluster['players']} players active, "
+        f"{'connecting' if cluster['latency_ms'] is None else str(cluster['latency_ms']) + 'ms'}"
+        for cluster_id, cluster in sorted(clusters.items())
+    ]
+    total_guilds = sum(cluster["guilds"] for cluster in clusters.values())
+    total_playing = sum(cluster["playing"] for cluster in clusters.values())
+    lines.append(f"Total: {total_guilds} servers, {total_playing} playing")
+    await ctx.send("\n".join(lines))
+
+COMMANDS = [
+    play, pause, resume, skip, stop, queue, volume, loop, bassboost, normalize, crossfade,
+    shuffle, remove, move, createplaylist, addsong, loadplaylist, lyrics, karaoke, connect, disconnect, stats,
+]
+
+def create_bot(shard_ids=None, shard_count=None, cluster_id=None, cluster_stats=None, cluster_count=1):
+    """
+    Creates the bot client with every command registered.
+
+    Args:
+        shard_ids (list, optional): The shards this process connects; all of them by default.
+        shard_count (int, optional): The bot's total shard count; Discord's recommendation by default.
+        cluster_id (int, optional): Identifies this process's shards to the launcher.
+        cluster_stats (dict, optional): The launcher's shared stats dictionary.
+        cluster_count (int, optional): How many clusters the launcher runs.
+
+    Returns:
+        MelodyBot: The bot, ready to run.
+    """
+    bot = MelodyBot(
+        command_prefix="!",
+        intents=create_intents(),
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        cluster_id=cluster_id,
+        cluster_stats=cluster_stats,
+    )
+    if cluster_id is not None and OPUS_CACHE_DIR:
+        # Clusters can't see each other's cache index, so each keeps its own
+        # directory and share of the disk space rather than evicting the others' files
+        default_opus_cache.configure(
+            os.path.join(OPUS_CACHE_DIR, f"cluster-{cluster_id}"),
+            max_bytes=OPUS_CACHE_SIZE_MB * 1024 * 1024 // max(cluster_count, 1),
+        )
+    bot.add_check(guild_only)
+    for command in COMMANDS:
+        bot.add_command(command)
+    return bot
 
-# Run the bot
-bot.run(DISCORD_TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    # A single process running every shard; see melody.launcher for clusters
+    create_bot().run(DISCORD_TOKEN)
\ No newline at end of file
@@ -0,0 +1,150 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from melody.database.database import PLAYLIST_BATCH_SIZE, TRACK_BATCH_SIZE, Database
+
+class AsyncDatabase:
+    """
+    An asyncio front end for Database.
+
+    Each call runs the blocking pymongo operation on a dedicated thread pool
+    sized to the connection pool, so command handlers never block the event
+    loop and never queue for more connections than the client holds. Method
+    names, arguments and return values match Database.
+    """
+    def __init__(self, database_uri, database_name, max_pool_size=100, max_workers=None):
+        self.database = Database(database_uri, database_name, max_pool_size=max_pool_size)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or min(max_pool_size, 32),
+            thread_name_prefix="melody-database",
+        )
+
+    async def _run(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args))
+
+    async def connect(self):
+        """Connects to the MongoDB database and makes sure its indexes exist."""
+        return await self._run(self.database.connect)
+
+    async def ensure_indexes(self):
+        """Creates the indexes every playlist query relies on."""
+        return await self._run(self.database.ensure_indexes)
+
+    async def create_playlist(self, playlist_name, user_id):
+        """Creates a new playlist in the database."""
+        return await self._run(self.database.create_playlist, playlist_name, user_id)
+
+    async def add_song_to_playlist(self, playlist_name, song_title, song_url, user_id):
+        """Adds a song to an existing playlist."""
+        return await self._run(self.database.add_song_to_playlist, playlist_name, song_title, song_url, user_id)
+
+    async def add_songs_to_playlist(self, playlist_name, songs, user_id):
+        """Appends many songs to a playlist."""
+        return await self._run(self.database.add_songs_to_playlist, playlist_name, songs, user_id)
+
+    async def remove_songs_from_playlist(self, playlist_name, positions, user_id):
+        """Removes the songs at the given 0-based positions."""
+        return await self._run(self.database.remove_songs_from_playlist, playlist_name, positions, user_id)
+
+    async def move_songs_in_playlist(self, playlist_name, moves, user_id):
+        """Applies a sequence of (from, to) 0-based moves, in order."""
+        return await self._run(self.database.move_songs_in_playlist, playlist_name, moves, user_id)
+
+    async def get_playlist_summary(self, playlist_name, user_id):
+        """Retrieves a playlist's name and song count without loading its songs."""
+        return await self._run(self.database.get_playlist_summary, playlist_name, user_id)
+
+    async def get_playlist_names(self, user_id):
+        """Lists the names of a user's playlists without loading their songs."""
+        return await self._run(self.database.get_playlist_names, user_id)
+
+    async def get_playlist_songs(self, playlist_name, user_id, start=0, limit=100):
+        """Retrieves a slice of a playlist's songs without loading the rest."""
+        return await self._run(self.database.get_playlist_songs, playlist_name, user_id, start, limit)
+
+    async def _iter(self, batches):
+        # Advances a blocking generator on the worker pool
+        fetch = None
+        try:
+            while True:
+                fetch = self.executor.submit(next, batches, None)
+                batch = await asyncio.wrap_future(fetch)
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            if fetch is None or fetch.done():
+                batches.close()
+            else:
+                # Cancelled while a worker is still inside the generator, which
+                # can only be closed once that worker is done with it
+                fetch.add_done_callback(lambda _: batches.close())
+
+    def iter_playlist_songs(self, playlist_name, user_id, batch_size=PLAYLIST_BATCH_SIZE):
+        """Streams a playlist's songs in batches, fetching each batch on the worker pool."""
+        return self._iter(self.database.iter_playlist_songs(playlist_name, user_id, batch_size))
+
+    async def migrate_embedded_playlists(self):
+        """Moves playlists still storing their songs inline to the entries collection."""
+        return await self._run(self.database.migrate_embedded_playlists)
+
+    async def get_playlist(self, playlist_name, user_id):
+        """Retrieves a playlist based on its name, with all of its songs."""
+        return await self._run(self.database.get_playlist, playlist_name, user_id)
+
+    async def delete_playlist(self, playlist_name, user_id):
+        """Deletes a playlist and its songs."""
+        return await self._run(self.database.delete_playlist, playlist_name, user_id)
+
+    async def save_user_data(self, user_id, user_data):
+        """Saves user data (e.g., preferences) to the database."""
+        return await self._run(self.database.save_user_data, user_id, user_data)
+
+    async def save_many_user_data(self, updates):
+        """Saves data for many users in one round-trip."""
+        return await self._run(self.database.save_many_user_data, updates)
+
+    async def add_songs_to_playlists(self, additions):
+        """Appends songs to many playlists, inserting every entry in one round-trip."""
+        return await self._run(self.database.add_songs_to_playlists, additions)
+
+    async def get_user_data(self, user_id):
+        """Retrieves user data from the database."""
+        return await self._run(self.database.get_user_data, user_id)
+
+    async def save_track_gain(self, track_key, measurement):
+        """Stores the loudness measurement of a track."""
+        return await self._run(self.database.save_track_gain, track_key, measurement)
+
+    async def save_lyrics(self, lyrics_key, lyrics, expires_at=None):
+        """Stores a song's lyrics."""
+        return await self._run(self.database.save_lyrics, lyrics_key, lyrics, expires_at)
+
+    async def get_lyrics(self, lyrics_key):
+        """Retrieves stored lyrics."""
+        return await self._run(self.database.get_lyrics, lyrics_key)
+
+    async def get_track_gain(self, track_key):
+        """Retrieves the loudness measurement of a track."""
+        return await self._run(self.database.get_track_gain, track_key)
+
+    async def save_track(self, track_key, track, query=None):
+        """Records a resolved track for the search index."""
+        return await self._run(self.database.save_track, track_key, track, query)
+
+    def iter_tracks(self, batch_size=TRACK_BATCH_SIZE):
+        """Streams every recorded track in batches, fetching each batch on the worker pool."""
+        return self._iter(self.database.iter_tracks(batch_size))
+
+    async def close(self):
+        """Waits for running operations, then stops the worker threads and closes the MongoDB client."""
+        loop = asyncio.get_running_loop()
+        # Joining the workers blocks until the last write is done, so it happens off the loop
+        await loop.run_in_executor(None, self._shutdown)
+
+    def _shutdown(self):
+        self.executor.shutdown(wait=True)
+        if self.database.client:
+            self.database.client.close()
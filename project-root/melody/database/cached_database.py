@@ -0,0 +1,320 @@
+import asyncio
+import collections
+import copy
+import time
+
+from melody.database.database import PLAYLIST_BATCH_SIZE, TRACK_BATCH_SIZE
+from melody.utils import metrics
+
+class CachedDatabase:
+    """
+    A write-behind cache in front of AsyncDatabase.
+
+    User data and playlists are served from bounded in-memory LRU caches.
+    Preference saves and song additions are applied to the cached copies right
+    away and coalesced per user or playlist, then written to MongoDB in one
+    batched round-trip every `flush_interval` seconds, which is also the
+    longest window of writes that a crash can lose. Other playlist mutations
+    flush the pending writes for that playlist first and then write through.
+
+    Writes that are still pending are overlaid on anything read from MongoDB,
+    so reads always reflect them, even after their entry was evicted. While a
+    flush is writing a user or playlist, MongoDB may or may not include the
+    write yet, so reads of it wait for the flush to finish.
+    """
+    def __init__(self, database, max_entries=10000, flush_interval=5.0, max_pending=1000, max_playlist_songs=1000):
+        """
+        Args:
+            database (AsyncDatabase): The database to read from and flush to.
+            max_entries (int, optional): Maximum cached users and playlists, each.
+            max_playlist_songs (int, optional): Larger playlists are streamed from MongoDB instead of cached.
+            flush_interval (float, optional): Seconds between flushes; the durability window.
+            max_pending (int, optional): Flush early once this many users or playlists have pending writes.
+        """
+        self.database = database
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_playlist_songs = max_playlist_songs
+        self.users = collections.OrderedDict()
+        self.playlists = collections.OrderedDict()
+        self.pending_users = {}
+        self.pending_songs = {}
+        # The batch the running flush is writing
+        self.inflight_users = {}
+        self.inflight_songs = {}
+        self.flushes = 0
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.hits = metrics.counter("database_cache_hits")
+        self.misses = metrics.counter("database_cache_misses")
+        self.flush_latency = metrics.histogram("database_flush_ms")
+
+    # Pass-through methods that don't touch cached state
+
+    async def connect(self):
+        """Connects to the database and starts the periodic flush."""
+        await self.database.connect()
+        self.start()
+
+    async def get_playlist_names(self, user_id):
+        """Lists the names of a user's playlists without loading their songs."""
+        return await self.database.get_playlist_names(user_id)
+
+    async def migrate_embedded_playlists(self):
+        """Moves playlists still storing their songs inline to the entries collection."""
+        return await self.database.migrate_embedded_playlists()
+
+    # Track gains, lyrics and searchable tracks are cached by their handlers and written once per track
+
+    async def save_track_gain(self, track_key, measurement):
+        """Stores the loudness measurement of a track."""
+        return await self.database.save_track_gain(track_key, measurement)
+
+    async def get_track_gain(self, track_key):
+        """Retrieves the loudness measurement of a track."""
+        return await self.database.get_track_gain(track_key)
+
+    async def save_lyrics(self, lyrics_key, lyrics, expires_at=None):
+        """Stores a song's lyrics."""
+        return await self.database.save_lyrics(lyrics_key, lyrics, expires_at)
+
+    async def get_lyrics(self, lyrics_key):
+        """Retrieves stored lyrics."""
+        return await self.database.get_lyrics(lyrics_key)
+
+    async def save_track(self, track_key, track, query=None):
+        """Records a resolved track for the search index."""
+        return await self.database.save_track(track_key, track, query)
+
+    async def iter_tracks(self, batch_size=TRACK_BATCH_SIZE):
+        """Streams every recorded track in batches."""
+        async for batch in self.database.iter_tracks(batch_size):
+            yield batch
+
+    # User data
+
+    async def get_user_data(self, user_id):
+        """Retrieves user data, from memory when cached."""
+        user_data = self._cache_get(self.users, user_id)
+        if user_data is None:
+            user_data = await self._read_through(self.inflight_users, user_id, self.database.get_user_data, user_id)
+            if user_data is None and user_id not in self.pending_users:
+                return None
+            user_data = dict(user_data or {"_id": user_id}, **self.pending_users.get(user_id, {}))
+            self._cache_put(self.users, user_id, user_data)
+        return copy.deepcopy(user_data)
+
+    async def save_user_data(self, user_id, user_data):
+        """Saves user data; the write reaches MongoDB on the next flush."""
+        cached = self.users.get(user_id)
+        if cached is not None:
+            cached.update(user_data)
+        self.pending_users.setdefault(user_id, {}).update(user_data)
+        self._flush_if_full()
+
+    # Playlists
+
+    async def get_playlist(self, playlist_name, user_id):
+        """Retrieves a playlist, from memory when cached."""
+        playlist = await self._load_playlist(playlist_name, user_id)
+        return copy.deepcopy(playlist)
+
+    async def add_song_to_playlist(self, playlist_name, song_title, song_url, user_id):
+        """Adds a song to an existing playlist; the write reaches MongoDB on the next flush."""
+        return await self.add_songs_to_playlist(playlist_name, [{"title": song_title, "url": song_url}], user_id)
+
+    async def add_songs_to_playlist(self, playlist_name, songs, user_id):
+        """Appends songs to an existing playlist; the write reaches MongoDB on the next flush.
+
+        Returns:
+            int: The number of songs added, or 0 if the playlist does not exist.
+        """
+        key = (playlist_name, user_id)
+        playlist = self._cache_get(self.playlists, key)
+        if playlist is None and key not in self.pending_songs and key not in self.inflight_songs:
+            if await self.database.get_playlist_summary(playlist_name, user_id) is None:
+                print(f"Playlist '{playlist_name}' not found.")
+                return 0
+        songs = list(songs)
+        if playlist is not None:
+            playlist["songs"].extend(copy.deepcopy(songs))
+        self.pending_songs.setdefault(key, []).extend(songs)
+        self._flush_if_full()
+        return len(songs)
+
+    async def create_playlist(self, playlist_name, user_id):
+        """Creates a new playlist in the database."""
+        await self.database.create_playlist(playlist_name, user_id)
+        self.playlists.pop((playlist_name, user_id), None)
+
+    async def delete_playlist(self, playlist_name, user_id):
+        """Deletes a playlist, discarding any pending additions to it."""
+        key = (playlist_name, user_id)
+        await self._settle(self.inflight_songs, key)
+        self.pending_songs.pop(key, None)
+        self.playlists.pop(key, None)
+        await self.database.delete_playlist(playlist_name, user_id)
+
+    async def remove_songs_from_playlist(self, playlist_name, positions, user_id):
+        """Removes the songs at the given 0-based positions."""
+        return await self._write_through(self.database.remove_songs_from_playlist, playlist_name, positions, user_id)
+
+    async def move_songs_in_playlist(self, playlist_name, moves, user_id):
+        """Applies a sequence of (from, to) 0-based moves."""
+        return await self._write_through(self.database.move_songs_in_playlist, playlist_name, moves, user_id)
+
+    async def get_playlist_summary(self, playlist_name, user_id):
+        """Retrieves a playlist's name and song count, from memory when cached."""
+        key = (playlist_name, user_id)
+        playlist = self._cache_get(self.playlists, key)
+        if playlist is not None:
+            return {"name": playlist_name, "user_id": user_id, "song_count": len(playlist["songs"])}
+        summary = await self._read_through(self.inflight_songs, key, self.database.get_playlist_summary, playlist_name, user_id)
+        if summary is not None:
+            summary["song_count"] += len(self.pending_songs.get(key, ()))
+        return summary
+
+    async def get_playlist_songs(self, playlist_name, user_id, start=0, limit=100):
+        """Retrieves a slice of a playlist's songs, from memory when cached."""
+        key = (playlist_name, user_id)
+        playlist = self._cache_get(self.playlists, key)
+        if playlist is not None:
+            return copy.deepcopy(playlist["songs"][start:start + limit])
+        if key in self.pending_songs or key in self.inflight_songs:
+            await self.flush()
+        return await self.database.get_playlist_songs(playlist_name, user_id, start, limit)
+
+    async def iter_playlist_songs(self, playlist_name, user_id, batch_size=PLAYLIST_BATCH_SIZE):
+        """Streams a playlist's songs in batches, from memory when cached."""
+        key = (playlist_name, user_id)
+        playlist = self._cache_get(self.playlists, key)
+        if playlist is not None:
+            songs = copy.deepcopy(playlist["songs"])
+            for start in range(0, len(songs), batch_size):
+                yield songs[start:start + batch_size]
+            return
+        if key in self.pending_songs or key in self.inflight_songs:
+            await self.flush()
+        async for batch in self.database.iter_playlist_songs(playlist_name, user_id, batch_size):
+            yield batch
+
+    async def _load_playlist(self, playlist_name, user_id):
+        key = (playlist_name, user_id)
+        playlist = self._cache_get(self.playlists, key)
+        if playlist is None:
+            playlist = await self._read_through(self.inflight_songs, key, self.database.get_playlist, playlist_name, user_id)
+            if playlist is None:
+                return None
+            playlist["songs"] = playlist.get("songs", []) + copy.deepcopy(self.pending_songs.get(key, []))
+            if len(playlist["songs"]) <= self.max_playlist_songs:
+                self._cache_put(self.playlists, key, playlist)
+        return playlist
+
+    async def _write_through(self, method, playlist_name, changes, user_id):
+        key = (playlist_name, user_id)
+        # Positions refer to the playlist including pending additions
+        if key in self.pending_songs or key in self.inflight_songs:
+            await self.flush()
+        self.playlists.pop(key, None)
+        return await method(playlist_name, changes, user_id)
+
+    async def _read_through(self, inflight, key, read, *args):
+        # Reads from MongoDB once no flush is writing `key`, so that overlaying
+        # the pending writes on the result counts each write exactly once
+        while True:
+            await self._settle(inflight, key)
+            flushes = self.flushes
+            result = await read(*args)
+            # A flush that started meanwhile may have moved writes out of pending
+            if flushes == self.flushes:
+                return result
+
+    async def _settle(self, inflight, key):
+        # Waits until the running flush has written `key`
+        while key in inflight:
+            async with self.flush_lock:
+                pass
+
+    # Flushing
+
+    async def flush(self):
+        """Writes every pending change to MongoDB in batched round-trips."""
+        async with self.flush_lock:
+            users, self.pending_users = self.pending_users, {}
+            songs, self.pending_songs = self.pending_songs, {}
+            if not users and not songs:
+                return
+            self.inflight_users.update(users)
+            self.inflight_songs.update(songs)
+            self.flushes += 1
+            users_saved = songs_saved = False
+            started = time.perf_counter()
+            try:
+                users_saved = await self.database.save_many_user_data(users)
+                songs_saved = await self.database.add_songs_to_playlists(songs)
+                self.flush_latency.record((time.perf_counter() - started) * 1000)
+            finally:
+                # Keep failed writes for the next flush, ahead of anything newer
+                if not users_saved:
+                    for user_id, user_data in users.items():
+                        self.pending_users[user_id] = dict(user_data, **self.pending_users.get(user_id, {}))
+                if not songs_saved:
+                    for key, pending in songs.items():
+                        self.pending_songs[key] = pending + self.pending_songs.get(key, [])
+                self.inflight_users.clear()
+                self.inflight_songs.clear()
+
+    def start(self):
+        """Starts flushing every `flush_interval` seconds."""
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing database cache: {e}")
+
+    def _flush_if_full(self):
+        if len(self.pending_users) + len(self.pending_songs) >= self.max_pending and not self.flush_lock.locked():
+            asyncio.ensure_future(self.flush())
+
+    async def close(self):
+        """Stops the periodic flush and writes everything still pending."""
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        await self.database.close()
+
+    # LRU helpers
+
+    def _cache_get(self, cache, key):
+        value = cache.get(key)
+        if value is None:
+            self.misses.increment()
+            return None
+        cache.move_to_end(key)
+        self.hits.increment()
+        return value
+
+    def _cache_put(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    def stats(self):
+        """Returns cache sizes, hit rate, pending writes and flush latency."""
+        hits, misses = self.hits.value, self.misses.value
+        return {
+            "users": len(self.users),
+            "playlists": len(self.playlists),
+            "pending_users": len(self.pending_users),
+            "pending_playlists": len(self.pending_songs),
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+            "flush_ms": self.flush_latency.summary(),
+        }
@@ -1,59 +1,289 @@
+import functools
+
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+# Playlist entries are appended this far apart, leaving room to move an entry
+# between two neighbours without renumbering the rest of the playlist
+POSITION_GAP = 1024
+
+# Songs per batch when streaming a playlist
+PLAYLIST_BATCH_SIZE = 500
+
+# Tracks per batch when loading the search index
+TRACK_BATCH_SIZE = 5000
 
 class Database:
-    def __init__(self, database_uri, database_name):
+    def __init__(self, database_uri, database_name, max_pool_size=100):
         self.database_uri = database_uri
         self.database_name = database_name
+        self.max_pool_size = max_pool_size
         self.client = None
         self.db = None
 
     def connect(self):
-        """Connects to the MongoDB database."""
+        """Connects to the MongoDB database and makes sure its indexes exist."""
         try:
-            self.client = MongoClient(self.database_uri)
+            self.client = MongoClient(self.database_uri, maxPoolSize=self.max_pool_size)
             self.db = self.client[self.database_name]
             print(f"Connected to MongoDB database: {self.database_name}")
         except Exception as e:
             print(f"Error connecting to MongoDB: {e}")
+            return
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """Creates the indexes the playlist and lyrics queries rely on; one failing doesn't skip the others."""
+        try:
+            # Every playlist lookup filters on user and name, and a user can't have two playlists with the same name
+            self._create_playlist_name_index()
+        except Exception as e:
+            print(f"Error creating playlist name index: {e}")
+        try:
+            # Entries are always read, sliced and located in playlist order
+            self.db.playlist_entries.create_index(
+                [("playlist_id", pymongo.ASCENDING), ("position", pymongo.ASCENDING)],
+                unique=True,
+                name="playlist_id_position_unique",
+            )
+        except Exception as e:
+            print(f"Error creating playlist entry index: {e}")
+        try:
+            # Cached "no lyrics" results carry an expiry; found lyrics are kept
+            self.db.lyrics.create_index("expires_at", expireAfterSeconds=0, name="expires_at_ttl")
+        except Exception as e:
+            print(f"Error creating lyrics expiry index: {e}")
+
+    def _create_playlist_name_index(self):
+        create_index = functools.partial(
+            self.db.playlists.create_index,
+            [("user_id", pymongo.ASCENDING), ("name", pymongo.ASCENDING)],
+            unique=True,
+            name="user_id_name_unique",
+        )
+        try:
+            create_index()
+        except DuplicateKeyError:
+            # Names weren't always unique; existing duplicates are merged first
+            self.merge_duplicate_playlists()
+            create_index()
+
+    def merge_duplicate_playlists(self):
+        """
+        Merges playlists that share a user and name into the oldest of them,
+        appending the songs of the others in the order they were created.
+
+        Returns:
+            int: The number of playlists merged away.
+        """
+        duplicates = self.db.playlists.aggregate([
+            {"$group": {"_id": {"user_id": "$user_id", "name": "$name"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ])
+        merged = 0
+        for group in duplicates:
+            playlist_ids = sorted(group["ids"])
+            for playlist in self.db.playlists.find({"_id": {"$in": playlist_ids}, "song_count": {"$exists": False}}):
+                self._migrate_playlist(playlist)
+            kept = playlist_ids[0]
+            for playlist_id in playlist_ids[1:]:
+                songs = list(self._entries(playlist_id))
+                if songs:
+                    playlist = self.db.playlists.find_one_and_update(
+                        {"_id": kept},
+                        {"$inc": {"song_count": len(songs), "next_position": len(songs) * POSITION_GAP}},
+                        {"next_position": 1},
+                        return_document=ReturnDocument.AFTER
+                    )
+                    self._insert_entries({kept: (playlist["next_position"] - len(songs) * POSITION_GAP, songs)})
+                self.db.playlist_entries.delete_many({"playlist_id": playlist_id})
+                self.db.playlists.delete_one({"_id": playlist_id})
+                merged += 1
+        if merged:
+            print(f"Merged {merged} duplicate playlists")
+        return merged
 
     def create_playlist(self, playlist_name, user_id):
-        """Creates a new playlist in the database."""
+        """Creates a new playlist in the database, leaving an existing one untouched."""
         try:
-            playlist = {
-                "name": playlist_name,
-                "user_id": user_id,
-                "songs": []
-            }
-            self.db.playlists.insert_one(playlist)
-            print(f"Created playlist: {playlist_name}")
+            result = self.db.playlists.update_one(
+                {"name": playlist_name, "user_id": user_id},
+                {"$setOnInsert": {"name": playlist_name, "user_id": user_id, "song_count": 0, "next_position": 0}},
+                upsert=True
+            )
+            if result.upserted_id is not None:
+                print(f"Created playlist: {playlist_name}")
+            else:
+                print(f"Playlist '{playlist_name}' already exists.")
         except Exception as e:
             print(f"Error creating playlist: {e}")
 
     def add_song_to_playlist(self, playlist_name, song_title, song_url, user_id):
         """Adds a song to an existing playlist."""
+        song = {
+            "title": song_title,
+            "url": song_url
+        }
+        if self.add_songs_to_playlist(playlist_name, [song], user_id):
+            print(f"Added song '{song_title}' to playlist: {playlist_name}")
+
+    def add_songs_to_playlist(self, playlist_name, songs, user_id):
+        """Appends many songs (dicts with "title" and "url") to a playlist.
+
+        Positions are reserved on the playlist document and the songs inserted
+        as entries, so the cost depends on the number of songs added, not on
+        the size of the playlist.
+
+        Returns:
+            int: The number of songs added, or 0 if the playlist does not exist.
+        """
+        songs = list(songs)
+        entries = {}
         try:
-            playlist = self.db.playlists.find_one({"name": playlist_name, "user_id": user_id})
-            if playlist:
-                song = {
-                    "title": song_title,
-                    "url": song_url
-                }
-                self.db.playlists.update_one(
-                    {"name": playlist_name, "user_id": user_id},
-                    {"$push": {"songs": song}}
-                )
-                print(f"Added song '{song_title}' to playlist: {playlist_name}")
-            else:
+            reserved = self._reserve_positions(playlist_name, user_id, len(songs))
+            if reserved is None:
                 print(f"Playlist '{playlist_name}' not found.")
+                return 0
+            playlist_id, first_position = reserved
+            entries[playlist_id] = (first_position, songs)
+            self._insert_entries(entries)
+            return len(songs)
+        except Exception as e:
+            print(f"Error adding songs to playlist: {e}")
+            self._release_positions(entries)
+            return 0
+
+    def add_songs_to_playlists(self, additions):
+        """Appends songs to many playlists, inserting every entry in one round-trip.
+
+        Args:
+            additions (dict): Maps each (playlist_name, user_id) pair to the songs to append.
+
+        A batch that fails is undone, so writing it again adds every song exactly once.
+
+        Returns:
+            bool: True if the batch was written.
+        """
+        if not additions:
+            return True
+        entries = {}
+        try:
+            for (playlist_name, user_id), songs in additions.items():
+                reserved = self._reserve_positions(playlist_name, user_id, len(songs))
+                # Additions to a playlist deleted in the meantime are dropped
+                if reserved is not None:
+                    playlist_id, first_position = reserved
+                    entries[playlist_id] = (first_position, songs)
+            self._insert_entries(entries)
+            return True
+        except Exception as e:
+            print(f"Error adding songs to playlists: {e}")
+            self._release_positions(entries)
+            return False
+
+    def remove_songs_from_playlist(self, playlist_name, positions, user_id):
+        """Removes the songs at the given 0-based positions.
+
+        Positions refer to the playlist as it was before any removal.
+        """
+        positions = sorted(position for position in set(positions) if position >= 0)
+        if not positions:
+            return 0
+        try:
+            playlist = self._find_playlist(playlist_name, user_id, {"_id": 1})
+            if playlist is None:
+                print(f"Playlist '{playlist_name}' not found.")
+                return 0
+            stored = self._entry_positions(playlist["_id"], positions[-1] + 1)
+            removed = [stored[position] for position in positions if position < len(stored)]
+            result = self.db.playlist_entries.delete_many({"playlist_id": playlist["_id"], "position": {"$in": removed}})
+            self.db.playlists.update_one({"_id": playlist["_id"]}, {"$inc": {"song_count": -result.deleted_count}})
+            return result.deleted_count
+        except Exception as e:
+            print(f"Error removing songs from playlist: {e}")
+            return 0
+
+    def move_songs_in_playlist(self, playlist_name, moves, user_id):
+        """Applies a sequence of (from, to) 0-based moves, in order.
+
+        A move only rewrites the position of the moved entry, so songs are
+        never read back to the bot.
+        """
+        moves = list(moves)
+        if not moves:
+            return 0
+        try:
+            playlist = self._find_playlist(playlist_name, user_id, {"_id": 1})
+            if playlist is None:
+                print(f"Playlist '{playlist_name}' not found.")
+                return 0
+            return sum(self._move_entry(playlist["_id"], source, destination) for source, destination in moves)
+        except Exception as e:
+            print(f"Error reordering playlist: {e}")
+            return 0
+
+    def get_playlist_summary(self, playlist_name, user_id):
+        """Retrieves a playlist's name and song count without loading its songs."""
+        try:
+            return self._find_playlist(playlist_name, user_id, {"_id": 0, "name": 1, "user_id": 1})
+        except Exception as e:
+            print(f"Error getting playlist summary: {e}")
+            return None
+
+    def get_playlist_names(self, user_id):
+        """Lists the names of a user's playlists without loading their songs."""
+        try:
+            playlists = self.db.playlists.find({"user_id": user_id}, {"_id": 0, "name": 1})
+            return [playlist["name"] for playlist in playlists]
+        except Exception as e:
+            print(f"Error getting playlist names: {e}")
+            return []
+
+    def get_playlist_songs(self, playlist_name, user_id, start=0, limit=100):
+        """Retrieves a slice of a playlist's songs without loading the rest."""
+        try:
+            playlist = self._find_playlist(playlist_name, user_id, {"_id": 1})
+            if playlist is None:
+                return None
+            return list(self._entries(playlist["_id"]).skip(start).limit(limit))
         except Exception as e:
-            print(f"Error adding song to playlist: {e}")
+            print(f"Error getting playlist songs: {e}")
+            return None
+
+    def iter_playlist_songs(self, playlist_name, user_id, batch_size=PLAYLIST_BATCH_SIZE):
+        """
+        Streams a playlist's songs in order from a cursor.
+
+        Args:
+            playlist_name (str): The playlist to read.
+            user_id (int): The playlist's owner.
+            batch_size (int, optional): Songs per yielded batch and per cursor round-trip.
+
+        Yields:
+            list: Batches of song dicts; nothing if the playlist does not exist.
+        """
+        try:
+            playlist = self._find_playlist(playlist_name, user_id, {"_id": 1})
+            if playlist is None:
+                return
+            batch = []
+            for song in self._entries(playlist["_id"]).batch_size(batch_size):
+                batch.append(song)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        except Exception as e:
+            print(f"Error streaming playlist songs: {e}")
 
     def get_playlist(self, playlist_name, user_id):
-        """Retrieves a playlist based on its name."""
+        """Retrieves a playlist based on its name, with all of its songs."""
         try:
-            playlist = self.db.playlists.find_one({"name": playlist_name, "user_id": user_id})
+            playlist = self._find_playlist(playlist_name, user_id)
             if playlist:
+                playlist["songs"] = list(self._entries(playlist["_id"]))
                 return playlist
             else:
                 return None
@@ -61,16 +291,172 @@ class Database:
             print(f"Error getting playlist: {e}")
 
     def delete_playlist(self, playlist_name, user_id):
-        """Deletes a playlist."""
+        """Deletes a playlist and its songs."""
         try:
-            result = self.db.playlists.delete_one({"name": playlist_name, "user_id": user_id})
-            if result.deleted_count > 0:
+            playlist = self.db.playlists.find_one_and_delete({"name": playlist_name, "user_id": user_id}, {"_id": 1})
+            if playlist:
+                self.db.playlist_entries.delete_many({"playlist_id": playlist["_id"]})
                 print(f"Deleted playlist: {playlist_name}")
             else:
                 print(f"Playlist '{playlist_name}' not found.")
         except Exception as e:
             print(f"Error deleting playlist: {e}")
 
+    def migrate_embedded_playlists(self):
+        """
+        Moves every playlist still storing its songs in an embedded `songs` array
+        to the entries collection. Playlists are also migrated one at a time
+        when first used, so running this is optional.
+
+        Returns:
+            int: The number of playlists migrated.
+        """
+        migrated = 0
+        try:
+            for playlist in self.db.playlists.find({"songs": {"$exists": True}}):
+                self._migrate_playlist(playlist)
+                migrated += 1
+        except Exception as e:
+            print(f"Error migrating playlists: {e}")
+        if migrated:
+            print(f"Migrated {migrated} playlists to the entries collection")
+        return migrated
+
+    def _find_playlist(self, playlist_name, user_id, projection=None):
+        # Finds a playlist document, migrating it first if it still embeds its songs
+        query = {"name": playlist_name, "user_id": user_id}
+        projection = dict(projection, song_count=1) if projection is not None else {"songs": 0}
+        playlist = self.db.playlists.find_one(query, projection)
+        if playlist is not None and "song_count" not in playlist:
+            self._migrate_playlist(self.db.playlists.find_one(query))
+            playlist = self.db.playlists.find_one(query, projection)
+        return playlist
+
+    def _migrate_playlist(self, playlist):
+        songs = playlist.get("songs") or []
+        # Entries left behind by an interrupted migration are replaced
+        self.db.playlist_entries.delete_many({"playlist_id": playlist["_id"]})
+        if songs:
+            self.db.playlist_entries.insert_many([
+                self._entry(playlist["_id"], index * POSITION_GAP, song) for index, song in enumerate(songs)
+            ])
+        self.db.playlists.update_one(
+            {"_id": playlist["_id"]},
+            {"$set": {"song_count": len(songs), "next_position": len(songs) * POSITION_GAP}, "$unset": {"songs": ""}}
+        )
+
+    def _reserve_positions(self, playlist_name, user_id, count):
+        # Returns (playlist_id, first position) for `count` new entries, or None if the playlist does not exist
+        query = {"name": playlist_name, "user_id": user_id, "song_count": {"$exists": True}}
+        update = {"$inc": {"song_count": count, "next_position": count * POSITION_GAP}}
+        playlist = self.db.playlists.find_one_and_update(query, update, {"next_position": 1}, return_document=ReturnDocument.AFTER)
+        if playlist is None and self._find_playlist(playlist_name, user_id, {"_id": 1}) is not None:
+            # The playlist was still embedded and has just been migrated
+            playlist = self.db.playlists.find_one_and_update(query, update, {"next_position": 1}, return_document=ReturnDocument.AFTER)
+        if playlist is None:
+            return None
+        return playlist["_id"], playlist["next_position"] - count * POSITION_GAP
+
+    def _insert_entries(self, entries):
+        # Inserts songs at reserved positions: {playlist_id: (first position, songs)}
+        documents = [
+            self._entry(playlist_id, first_position + index * POSITION_GAP, song)
+            for playlist_id, (first_position, songs) in entries.items()
+            for index, song in enumerate(songs)
+        ]
+        if not documents:
+            return
+        try:
+            self.db.playlist_entries.insert_many(documents, ordered=False)
+        except Exception:
+            # insert_many gave every document an _id; remove the ones that made it in
+            self.db.playlist_entries.delete_many({"_id": {"$in": [document["_id"] for document in documents if "_id" in document]}})
+            raise
+
+    def _release_positions(self, entries):
+        # Undoes reservations whose songs were not inserted: {playlist_id: (first position, songs)}
+        for playlist_id, (first_position, songs) in entries.items():
+            end = first_position + len(songs) * POSITION_GAP
+            try:
+                # The positions themselves can only be handed back if nothing was reserved after them
+                result = self.db.playlists.update_one(
+                    {"_id": playlist_id, "next_position": end},
+                    {"$inc": {"song_count": -len(songs)}, "$set": {"next_position": first_position}}
+                )
+                if not result.matched_count:
+                    self.db.playlists.update_one({"_id": playlist_id}, {"$inc": {"song_count": -len(songs)}})
+            except Exception as e:
+                print(f"Error releasing playlist positions: {e}")
+
+    def _entry(self, playlist_id, position, song):
+        return dict(song, playlist_id=playlist_id, position=position)
+
+    def _entries(self, playlist_id):
+        # Cursor over a playlist's songs in order, without the storage fields
+        return self.db.playlist_entries.find(
+            {"playlist_id": playlist_id},
+            {"_id": 0, "playlist_id": 0, "position": 0}
+        ).sort("position", pymongo.ASCENDING)
+
+    def _entry_positions(self, playlist_id, count):
+        # Stored positions of the first `count` entries, read from the index alone
+        cursor = self.db.playlist_entries.find(
+            {"playlist_id": playlist_id},
+            {"_id": 0, "position": 1}
+        ).sort("position", pymongo.ASCENDING).limit(count)
+        return [entry["position"] for entry in cursor]
+
+    def _move_entry(self, playlist_id, source, destination, renumbered=False):
+        if source < 0 or destination < 0 or source == destination:
+            return 0
+        positions = self._entry_positions(playlist_id, max(source, destination) + 2)
+        if source >= len(positions):
+            return 0
+        moved = positions.pop(source)
+        destination = min(destination, len(positions))
+        before = positions[destination - 1] if destination > 0 else None
+        after = positions[destination] if destination < len(positions) else None
+        if after is None:
+            # Moving to the end takes a fresh position, like an append
+            playlist = self.db.playlists.find_one_and_update(
+                {"_id": playlist_id},
+                {"$inc": {"next_position": POSITION_GAP}},
+                {"next_position": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            position = playlist["next_position"] - POSITION_GAP
+        elif before is None:
+            position = after - POSITION_GAP
+        elif after - before > 1:
+            position = (before + after) // 2
+        elif not renumbered:
+            # No room left between the neighbours
+            self._renumber(playlist_id)
+            return self._move_entry(playlist_id, source, destination, renumbered=True)
+        else:
+            return 0
+        result = self.db.playlist_entries.update_one({"playlist_id": playlist_id, "position": moved}, {"$set": {"position": position}})
+        return result.modified_count
+
+    def _renumber(self, playlist_id):
+        # Spreads the entries POSITION_GAP apart again in a freshly reserved range above every
+        # existing position, so no update can collide with an entry that hasn't moved yet
+        count = self.db.playlist_entries.count_documents({"playlist_id": playlist_id})
+        playlist = self.db.playlists.find_one_and_update(
+            {"_id": playlist_id},
+            {"$inc": {"next_position": (count + 1) * POSITION_GAP}},
+            {"next_position": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        first_position = playlist["next_position"] - (count + 1) * POSITION_GAP
+        entries = self.db.playlist_entries.find({"playlist_id": playlist_id}, {"_id": 1}).sort("position", pymongo.ASCENDING).limit(count)
+        operations = [
+            UpdateOne({"_id": entry["_id"]}, {"$set": {"position": first_position + index * POSITION_GAP}})
+            for index, entry in enumerate(entries)
+        ]
+        if operations:
+            self.db.playlist_entries.bulk_write(operations, ordered=True)
+
     def save_user_data(self, user_id, user_data):
         """Saves user data (e.g., preferences) to the database."""
         try:
@@ -83,10 +469,103 @@ class Database:
         except Exception as e:
             print(f"Error saving user data: {e}")
 
+    def save_many_user_data(self, updates):
+        """Saves data for many users in one round-trip.
+
+        Args:
+            updates (dict): Maps each user ID to the fields to set.
+
+        Returns:
+            bool: True if the batch was written.
+        """
+        if not updates:
+            return True
+        try:
+            self.db.users.bulk_write([
+                UpdateOne({"_id": user_id}, {"$set": user_data}, upsert=True)
+                for user_id, user_data in updates.items()
+            ], ordered=False)
+            return True
+        except Exception as e:
+            print(f"Error saving user data batch: {e}")
+            return False
+
     def get_user_data(self, user_id):
         """Retrieves user data from the database."""
         try:
             user_data = self.db.users.find_one({"_id": user_id})
             return user_data
         except Exception as e:
-            print(f"Error getting user data: {e}")
\ No newline at end of file
+            print(f"Error getting user data: {e}")
+
+    def save_track_gain(self, track_key, measurement):
+        """Stores the loudness measurement of a track (a dict with "loudness", "peak" and "gain_db")."""
+        try:
+            self.db.track_gains.update_one(
+                {"_id": track_key},
+                {"$set": measurement},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"Error saving track gain: {e}")
+
+    def save_lyrics(self, lyrics_key, lyrics, expires_at=None):
+        """Stores a song's lyrics, or None for a song without lyrics, until `expires_at` (a datetime) if given."""
+        try:
+            document = {"lyrics": lyrics}
+            if expires_at is not None:
+                document["expires_at"] = expires_at
+            self.db.lyrics.replace_one({"_id": lyrics_key}, document, upsert=True)
+        except Exception as e:
+            print(f"Error saving lyrics: {e}")
+
+    def get_lyrics(self, lyrics_key):
+        """Retrieves stored lyrics as a document with a "lyrics" field, or None if nothing is stored."""
+        try:
+            return self.db.lyrics.find_one({"_id": lyrics_key})
+        except Exception as e:
+            print(f"Error getting lyrics: {e}")
+
+    def get_track_gain(self, track_key):
+        """Retrieves the loudness measurement of a track, or None if it hasn't been measured."""
+        try:
+            return self.db.track_gains.find_one({"_id": track_key})
+        except Exception as e:
+            print(f"Error getting track gain: {e}")
+
+    def save_track(self, track_key, track, query=None):
+        """
+        Records a resolved track for the search index.
+
+        Args:
+            track_key (str): The track's canonical key, e.g. "youtube:track:dQw4w9WgXcQ".
+            track (dict): The track's "url" and "source", and its "title" once known.
+            query (str, optional): A search query that resolved to the track.
+        """
+        try:
+            update = {"$set": track}
+            if query:
+                update["$addToSet"] = {"queries": query}
+            self.db.tracks.update_one({"_id": track_key}, update, upsert=True)
+        except Exception as e:
+            print(f"Error saving track: {e}")
+
+    def iter_tracks(self, batch_size=TRACK_BATCH_SIZE):
+        """
+        Streams every recorded track from a cursor.
+
+        Yields:
+            list: Batches of track dicts with the canonical key as "_id", "url", "source" and,
+                when known, "title" and "queries".
+        """
+        try:
+            batch = []
+            for track in self.db.tracks.find().batch_size(batch_size):
+                batch.append(track)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        except Exception as e:
+            print(f"Error streaming tracks: {e}")
@@ -0,0 +1,132 @@
+import multiprocessing
+import os
+import time
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+
+# Total shards across all clusters; 0 asks Discord for its recommendation
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+# Processes to spread the shards over; 0 runs one per CPU core
+CLUSTER_COUNT = int(os.getenv("CLUSTER_COUNT", "0"))
+
+# Discord allows one shard to identify every 5 seconds, so clusters start staggered
+IDENTIFY_INTERVAL = 5.0
+# Seconds between checks for clusters that need restarting
+SUPERVISE_INTERVAL = 5.0
+# Seconds a cluster is given to flush and disconnect when the launcher stops
+SHUTDOWN_TIMEOUT = 30.0
+
+def recommended_shard_count(token):
+    """
+    Asks Discord how many shards the bot should run.
+
+    Args:
+        token (str): The bot token.
+
+    Returns:
+        int: The recommended shard count.
+    """
+    response = requests.get(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}"},
+        timeout=10,
+    )
+    response.raise_for_status()
+    return response.json()["shards"]
+
+def plan_clusters(shard_count, cluster_count):
+    """
+    Splits the shards into contiguous, evenly sized ranges, one per cluster.
+
+    Args:
+        shard_count (int): The bot's total shard count.
+        cluster_count (int): The number of processes; capped at one per shard.
+
+    Returns:
+        list: The shard IDs of each cluster.
+    """
+    cluster_count = max(1, min(cluster_count, shard_count))
+    size, extra = divmod(shard_count, cluster_count)
+    clusters = []
+    start = 0
+    for cluster_id in range(cluster_count):
+        end = start + size + (1 if cluster_id < extra else 0)
+        clusters.append(list(range(start, end)))
+        start = end
+    return clusters
+
+def run_cluster(cluster_id, shard_ids, shard_count, cluster_stats, delay=0.0, cluster_count=1):
+    """
+    Runs one cluster of shards. This is the entry point of each cluster process.
+    """
+    time.sleep(delay)
+    # Imported here so each cluster builds its own players, caches and database client
+    from melody.bot import DISCORD_TOKEN, create_bot
+    create_bot(shard_ids, shard_count, cluster_id, cluster_stats, cluster_count).run(DISCORD_TOKEN)
+
+class Launcher:
+    """
+    Runs the bot's shards as clusters of AutoShardedBot processes, restarting
+    any cluster that exits, and shares a stats dictionary between them.
+    """
+    def __init__(self, token, shard_count, cluster_count):
+        self.token = token
+        self.shard_count = shard_count
+        self.clusters = plan_clusters(shard_count, cluster_count)
+        # Spawned processes don't inherit the parent's sockets, threads or event loop
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = {}
+        self.cluster_stats = None
+
+    def start(self, cluster_id, delay=0.0):
+        process = self.context.Process(
+            target=run_cluster,
+            args=(cluster_id, self.clusters[cluster_id], self.shard_count, self.cluster_stats, delay, len(self.clusters)),
+            name=f"melody-cluster-{cluster_id}",
+        )
+        process.start()
+        self.processes[cluster_id] = process
+
+    def run(self):
+        """Starts every cluster and supervises them until interrupted."""
+        with self.context.Manager() as manager:
+            self.cluster_stats = manager.dict()
+            delay = 0.0
+            for cluster_id, shard_ids in enumerate(self.clusters):
+                print(f"Starting cluster {cluster_id} with shards {shard_ids[0]}-{shard_ids[-1]}")
+                self.start(cluster_id, delay)
+                delay += IDENTIFY_INTERVAL * len(shard_ids)
+            try:
+                self.supervise()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.stop()
+
+    def supervise(self):
+        while True:
+            time.sleep(SUPERVISE_INTERVAL)
+            for cluster_id, process in list(self.processes.items()):
+                if not process.is_alive():
+                    print(f"Cluster {cluster_id} exited with code {process.exitcode}; restarting")
+                    self.cluster_stats.pop(cluster_id, None)
+                    self.start(cluster_id)
+
+    def stop(self):
+        # Clusters received the interrupt too and are closing; give them time to flush
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for process in self.processes.values():
+            process.join(max(deadline - time.monotonic(), 0))
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+if __name__ == "__main__":
+    shard_count = SHARD_COUNT or recommended_shard_count(DISCORD_TOKEN)
+    Launcher(DISCORD_TOKEN, shard_count, CLUSTER_COUNT or os.cpu_count() or 1).run()
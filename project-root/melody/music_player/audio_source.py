@@ -0,0 +1,224 @@
+import collections
+import time
+
+import discord
+
+from melody.utils.audio_effects import EffectsAudioSource, FrameProcessor
+from melody.utils.opus_cache import DecodedOpusSource
+
+# Reconnect options let FFmpeg resume remote streams instead of ending the song
+# on a dropped connection; the small probe size lets playback start as soon as
+# the first packets arrive rather than after analysing the stream.
+FFMPEG_BEFORE_OPTIONS = (
+    "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 "
+    "-probesize 32k -analyzeduration 0"
+)
+
+# Output is always 48kHz stereo, which is what Discord's encoder expects
+FFMPEG_SAMPLE_RATE = 48000
+FFMPEG_CHANNELS = 2
+
+DEFAULT_AUDIO_FILTERS = "lowpass=f=4000"
+
+# Matches the bitrate discord.py encodes PCM sources at
+OPUS_BITRATE = 128
+
+# discord.py reads 20ms frames
+FRAMES_PER_SECOND = 50
+
+def build_ffmpeg_options(audio_filters=DEFAULT_AUDIO_FILTERS):
+    """
+    Builds the output options for the single FFmpeg process that streams a song.
+
+    Args:
+        audio_filters (str, optional): An FFmpeg `-af` filter chain.
+
+    Returns:
+        str: The FFmpeg output options.
+    """
+    options = f"-vn -ac {FFMPEG_CHANNELS} -ar {FFMPEG_SAMPLE_RATE}"
+    if audio_filters:
+        options += f" -af {audio_filters}"
+    return options
+
+class BufferedAudioSource(discord.AudioSource):
+    """
+    Wraps an audio source, serving any pre-read frames first and reporting
+    when the first packet is handed to the voice client.
+
+    Recorders (an OpusCacheWriter, a LoudnessAnalyzer) are handed every frame
+    before volume is applied, and committed once the source ends. Frames are
+    counted as they are played, which gives the playback position.
+    """
+    def __init__(self, source, frames=None, on_first_packet=None, recorders=()):
+        self.source = source
+        self.frames = frames if frames is not None else collections.deque()
+        self.on_first_packet = on_first_packet
+        self.recorders = [recorder for recorder in recorders if recorder]
+        self.started = False
+        self.frames_played = 0
+
+    @property
+    def position(self):
+        """Seconds of audio handed to the voice client so far."""
+        return self.frames_played / FRAMES_PER_SECOND
+
+    def read(self):
+        if self.frames:
+            frame = self.frames.popleft()
+        else:
+            frame = self.source.read()
+        if frame:
+            self.frames_played += 1
+        if self.recorders:
+            if frame:
+                for recorder in self.recorders:
+                    recorder.write(frame)
+            else:
+                for recorder in self.recorders:
+                    recorder.commit()
+                self.recorders = []
+        if not self.started:
+            self.started = True
+            if self.on_first_packet:
+                self.on_first_packet(time.perf_counter())
+        return frame
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        # Stopped before the end; a partial track is never cached or measured
+        for recorder in self.recorders:
+            recorder.abort()
+        self.recorders = []
+        self.frames.clear()
+        self.source.cleanup()
+
+def create_ffmpeg_source(stream_url, audio_filters=DEFAULT_AUDIO_FILTERS):
+    """
+    Creates the FFmpeg process that streams and resamples a resolved URL.
+
+    FFmpeg reads the stream incrementally and performs resampling and filtering
+    in the same process, so memory stays bounded regardless of track length.
+
+    Args:
+        stream_url (str or file): The resolved audio stream URL, or a readable
+            file object (such as AudioHandler.convert_stream's output) to pipe
+            into FFmpeg.
+        audio_filters (str, optional): An FFmpeg `-af` filter chain.
+
+    Returns:
+        discord.FFmpegPCMAudio: The raw PCM source.
+    """
+    if hasattr(stream_url, "read"):
+        # Reconnecting only applies to URLs
+        return discord.FFmpegPCMAudio(stream_url, pipe=True, options=build_ffmpeg_options(audio_filters))
+    return discord.FFmpegPCMAudio(
+        stream_url,
+        before_options=FFMPEG_BEFORE_OPTIONS,
+        options=build_ffmpeg_options(audio_filters),
+    )
+
+def warm_audio_source(stream_url, seconds, audio_filters=DEFAULT_AUDIO_FILTERS):
+    """
+    Starts streaming a URL and reads its first `seconds` of audio into a ring buffer.
+
+    This blocks while FFmpeg connects and must run in a worker thread.
+
+    Args:
+        stream_url (str): The resolved audio stream URL.
+        seconds (float): How much audio to buffer ahead of playback.
+        audio_filters (str, optional): An FFmpeg `-af` filter chain.
+
+    Returns:
+        BufferedAudioSource: A source that plays the buffered frames before reading on.
+    """
+    source = create_ffmpeg_source(stream_url, audio_filters)
+    frame_count = int(seconds * FRAMES_PER_SECOND)
+    frames = collections.deque(maxlen=frame_count)
+    while len(frames) < frame_count:
+        frame = source.read()
+        if not frame:
+            break
+        frames.append(frame)
+    return BufferedAudioSource(source, frames)
+
+def create_audio_source(stream_url, volume=0.5, audio_filters=DEFAULT_AUDIO_FILTERS, source=None,
+                        on_first_packet=None, recorders=(), processor=None):
+    """
+    Creates a streaming audio source for a resolved stream URL.
+
+    Args:
+        stream_url (str or file): The resolved audio stream URL, or a readable file object.
+        volume (float, optional): The initial playback volume (1.0 is 100%), unless a processor is given.
+        audio_filters (str, optional): An FFmpeg `-af` filter chain.
+        source (BufferedAudioSource, optional): A pre-warmed source to play instead of starting FFmpeg.
+        on_first_packet (callable, optional): Called with a perf_counter timestamp when playback starts.
+        recorders (list, optional): Handed the unprocessed frames, e.g. to cache or measure the track.
+        processor (FrameProcessor, optional): The volume and effects to apply.
+
+    Returns:
+        EffectsAudioSource: The audio source to hand to the voice client.
+        Its `original` attribute is the underlying BufferedAudioSource.
+    """
+    if source is None:
+        source = BufferedAudioSource(create_ffmpeg_source(stream_url, audio_filters))
+    source.on_first_packet = on_first_packet
+    source.recorders = [recorder for recorder in recorders if recorder]
+    return EffectsAudioSource(source, processor or FrameProcessor(volume=volume))
+
+def create_opus_audio_source(stream_url, codec=None, gain=1.0, audio_filters=DEFAULT_AUDIO_FILTERS, on_first_packet=None):
+    """
+    Creates an audio source that FFmpeg delivers as Opus packets.
+
+    An Opus stream played at unity gain is only remuxed, so it is never
+    decoded or encoded and the audio filters are skipped. Anything else is
+    filtered, scaled by `gain` and encoded inside FFmpeg. Either way Python
+    does no per-frame work, and the gain is fixed for the whole track.
+
+    Args:
+        stream_url (str): The resolved audio stream URL.
+        codec (str, optional): The stream's audio codec, if known.
+        gain (float, optional): The playback volume (1.0 is 100%).
+        audio_filters (str, optional): An FFmpeg `-af` filter chain, used when transcoding.
+        on_first_packet (callable, optional): Called with a perf_counter timestamp when playback starts.
+
+    Returns:
+        BufferedAudioSource: The Opus audio source to hand to the voice client.
+    """
+    if codec == "opus" and gain == 1.0:
+        source = discord.FFmpegOpusAudio(stream_url, codec="copy", before_options=FFMPEG_BEFORE_OPTIONS, options="-vn")
+    else:
+        filters = [audio_filters] if audio_filters else []
+        if gain != 1.0:
+            filters.append(f"volume={gain}")
+        options = "-vn" + (f" -af {','.join(filters)}" if filters else "")
+        source = discord.FFmpegOpusAudio(
+            stream_url,
+            bitrate=OPUS_BITRATE,
+            before_options=FFMPEG_BEFORE_OPTIONS,
+            options=options,
+        )
+    return BufferedAudioSource(source, on_first_packet=on_first_packet)
+
+def create_cached_audio_source(cached, processor=None, on_first_packet=None, recorders=()):
+    """
+    Creates an audio source for a track served from the Opus cache.
+
+    Without a processor the cached packets go to the voice client untouched;
+    otherwise they are decoded so the volume and effects can be applied.
+
+    Args:
+        cached (CachedOpusSource): The cached track.
+        processor (FrameProcessor, optional): The volume and effects to apply.
+        on_first_packet (callable, optional): Called with a perf_counter timestamp when playback starts.
+        recorders (list, optional): Handed the decoded frames; ignored when the packets go out untouched.
+
+    Returns:
+        discord.AudioSource: The audio source to hand to the voice client.
+    """
+    if processor is None:
+        return BufferedAudioSource(cached, on_first_packet=on_first_packet)
+    source = BufferedAudioSource(DecodedOpusSource(cached), on_first_packet=on_first_packet, recorders=recorders)
+    return EffectsAudioSource(source, processor)
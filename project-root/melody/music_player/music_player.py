@@ -1,96 +1,102 @@
-import discord
-from discord.ext import commands
 import asyncio
-import youtube_dl
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-import soundcloud
-from soundcloud.resource import Resource
-import ffmpeg
-from pydub import AudioSegment
-
-# Suppress noisy youtube_dl logging
-youtube_dl.utils.bug_reports_message = lambda: ''
-
-class Song:
-    def __init__(self, title, url, source):
-        self.title = title
-        self.url = url
-        self.source = source
-
-    async def get_audio_stream(self):
-        if self.source == "youtube":
-            return await self.get_youtube_audio_stream()
-        elif self.source == "spotify":
-            return await self.get_spotify_audio_stream()
-        elif self.source == "soundcloud":
-            return await self.get_soundcloud_audio_stream()
-
-    async def get_youtube_audio_stream(self):
-        try:
-            # Use youtube-dl to download and extract the audio stream
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-                'noplaylist': True,
-                'nocheckcertificate': True,
-                'ignoreerrors': True,
-                'logtostderr': False,
-                'quiet': True,
-                'no_warnings': True,
-                'default_search': 'auto',
-            }
-            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(self.url, download=False)
-                audio_url = info['formats'][0]['url']
-            return audio_url
-        except Exception as e:
-            print(f"Error getting YouTube audio stream: {e}")
-            return None
+import itertools
+import time
 
-    async def get_spotify_audio_stream(self):
-        try:
-            # Use spotipy to get track information and audio URL
-            client_credentials_manager = SpotifyClientCredentials(
-                client_id="your_spotify_client_id",
-                client_secret="your_spotify_client_secret"
-            )
-            sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
-            track_info = sp.search(q=self.url, type='track', limit=1)
-            track_uri = track_info['tracks']['items'][0]['uri']
-            audio_features = sp.audio_features(track_uri)
-            audio_url = audio_features[0]['preview_url']
-            return audio_url
-        except Exception as e:
-            print(f"Error getting Spotify audio stream: {e}")
-            return None
+from melody.api.scheduler import PRIORITY_NOW_PLAYING, request_priority
+from melody.music_player.audio_source import (
+    BufferedAudioSource,
+    create_audio_source,
+    create_cached_audio_source,
+    create_opus_audio_source,
+)
+from melody.music_player.playlist_expander import default_expander
+from melody.music_player.prefetcher import Prefetcher
+from melody.music_player.queue_view import QueueView
+from melody.music_player.resolver import default_resolver
+from melody.music_player.song import Song
+from melody.music_player.song_queue import REPEAT_ALL, REPEAT_MODES, REPEAT_OFF, SongQueue
+from melody.music_player.track_search import default_track_search
+from melody.utils import metrics
+from melody.utils.audio_effects import EffectsAudioSource, FrameProcessor
+from melody.utils.loudness import track_gains
+from melody.utils.opus_cache import default_opus_cache
+from melody.utils.source_router import follow_link, route
 
-    async def get_soundcloud_audio_stream(self):
-        try:
-            # Use soundcloud-python to get track information and audio URL
-            client = soundcloud.Client(client_id="your_soundcloud_client_id", client_secret="your_soundcloud_client_secret")
-            track = client.get('/resolve', url=self.url)
-            audio_url = track.stream_url
-            return audio_url
-        except Exception as e:
-            print(f"Error getting SoundCloud audio stream: {e}")
-            return None
+# Milliseconds between one track ending and the next track's first packet
+inter_track_gap = metrics.histogram("inter_track_gap_ms")
+
+# Links that expand to many songs, as (source, kind)
+COLLECTION_KINDS = {("spotify", "playlist"), ("spotify", "album"), ("soundcloud", "playlist")}
 
 class MusicPlayer:
-    def __init__(self):
-        self.queue = []
+    __slots__ = (
+        "guild_id", "queue", "current_song", "voice_client",
+        "is_playing", "resolve_task", "last_active", "volume",
+        "prefetcher", "track_ended_at", "expansion_task", "skipping", "queue_view",
+        "opus_passthrough", "bass_boost", "normalize", "crossfade_seconds", "lyrics",
+    )
+
+    def __init__(self, guild_id=None, opus_passthrough=False, normalize=False, lyrics=None):
+        self.guild_id = guild_id
+        # A LyricsHandler; lyrics for the playing and next songs are fetched ahead of `!lyrics`
+        self.lyrics = lyrics
+        # Let FFmpeg deliver Opus instead of scaling and encoding PCM in Python;
+        # volume changes then apply from the next song
+        self.opus_passthrough = opus_passthrough
+        self.queue = SongQueue()
+        self.queue_view = QueueView(self.queue)
         self.current_song = None
         self.voice_client = None
         self.is_playing = False
-        self.is_looping = False
+        self.resolve_task = None
+        self.last_active = 0.0
+        # Passthrough starts at full volume, where Opus streams are remuxed rather
+        # than transcoded; listeners can still turn the bot down in their client
+        self.volume = 1.0 if opus_passthrough else 0.5
+        self.prefetcher = Prefetcher()
+        self.track_ended_at = None
+        self.expansion_task = None
+        self.skipping = False
+        self.bass_boost = 0.0
+        self.normalize = normalize
+        self.crossfade_seconds = 0.0
+
+    @property
+    def is_looping(self):
+        return self.queue.repeat != REPEAT_OFF
 
     async def play(self, ctx, query):
-        # Identify the source of the query (YouTube, Spotify, SoundCloud)
-        source = self.get_source(query)
+        # Identify what the query links to (YouTube, Spotify, SoundCloud)
+        key = route(query)
+        if key and key.kind == "link":
+            # Short links only say what they point to once followed
+            target = await default_resolver.resolve(key.source, follow_link, key.id)
+            key = route(target) if target else None
+
+        # Playlists and albums are expanded into many songs
+        if key and (key.source, key.kind) in COLLECTION_KINDS:
+            collection = key.id if key.source == "spotify" else key.url
+            self.expansion_task = asyncio.ensure_future(self.enqueue_collection(ctx, key.source, key.kind, collection))
+            try:
+                await self.expansion_task
+            except asyncio.CancelledError:
+                # Playback was stopped while the playlist was loading
+                pass
+            return
+
+        source = None
+        if key and key.kind == "track":
+            title = url = key.url
+            source = key.source
+        elif key is None and "://" not in query:
+            # Plain search terms; known tracks are found locally, the rest are searched for
+            match = await default_track_search.search(query)
+            if match:
+                url, source, title = match
 
         if source:
             # Create a Song object
-            song = Song(title=query, url=query, source=source)
+            song = Song(title=title, url=url, source=source)
 
             # Add the song to the queue
             self.queue.append(song)
@@ -98,25 +104,189 @@ class MusicPlayer:
             # Start playback if the queue is empty
             if not self.is_playing:
                 await self.queue_next(ctx)
+            else:
+                self.prefetcher.schedule(self.queue)
+        elif key:
+            # e.g. an artist page or a YouTube playlist
+            await ctx.send("That link can't be played. Please link a song, a Spotify playlist or album, or a SoundCloud set.")
         else:
-            await ctx.send("Invalid song source. Please provide a valid YouTube, Spotify, or SoundCloud link or search term.")
+            await ctx.send("No song found. Please provide a valid YouTube, Spotify, or SoundCloud link or search term.")
+
+    async def enqueue_collection(self, ctx, source, kind, collection):
+        """
+        Queues every song of a playlist or album as unresolved placeholders.
 
-    async def queue_next(self, ctx):
-        if self.voice_client and self.queue:
+        Playback starts as soon as the first page is queued; later pages keep
+        loading in the background.
+        """
+        await self.enqueue_batches(ctx, default_expander.expand(source, kind, collection), f"the {kind}")
+
+    async def load_playlist(self, ctx, playlist_name, batches):
+        """
+        Queues a saved playlist streamed from the database in batches of song dicts.
+
+        Like linked playlists, playback starts with the first batch while the
+        rest is still being read.
+        """
+        songs = (
+            [song for song in map(self.saved_song, batch) if song]
+            async for batch in batches
+        )
+        self.expansion_task = asyncio.ensure_future(self.enqueue_batches(ctx, songs, f"playlist '{playlist_name}'"))
+        try:
+            await self.expansion_task
+        except asyncio.CancelledError:
+            # Playback was stopped while the playlist was loading
+            pass
+
+    async def enqueue_batches(self, ctx, batches, description):
+        """Queues batches of songs from an async iterator, starting playback with the first."""
+        count = 0
+        async for songs in batches:
+            self.queue.extend(songs)
+            count += len(songs)
+            if not self.is_playing:
+                # Claim playback now so later batches don't start a second track
+                self.is_playing = True
+                asyncio.ensure_future(self.queue_next(ctx))
+            else:
+                self.prefetcher.schedule(self.queue)
+        if count:
+            await ctx.send(f"Queued {count} songs from {description}.")
+        else:
+            await ctx.send(f"Could not load any songs from {description}.")
+
+    async def queue_next(self, ctx, crossfade=False):
+        skipping, self.skipping = self.skipping, False
+        # Songs that can't be resolved are skipped; a full pass of them (e.g. a
+        # looped queue of dead links) ends playback instead of retrying forever
+        attempts = len(self.queue) + 1
+        while attempts and self.voice_client:
+            next_song = self.queue.advance(self.current_song, skip=skipping)
+            if not next_song:
+                break
+            attempts -= 1
             self.is_playing = True
-            self.current_song = self.queue.pop(0)
-            audio_stream = await self.current_song.get_audio_stream()
-            if audio_stream:
-                # Convert to audio segment
-                audio_segment = AudioSegment.from_file(audio_stream)
-                audio_segment = audio_segment.set_frame_rate(48000)  # Set to a consistent frame rate
-                audio_source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(audio_stream, before_options="-vn -ac 2 -af lowpass=f=4000"), volume=0.5)
-                self.voice_client.play(audio_source, after=lambda e: asyncio.run_coroutine_threadsafe(self.queue_next(ctx), loop=ctx.bot.loop))
-                await ctx.send(f"Now playing: {self.current_song.title}")
+            self.current_song = next_song
+            started = await self.start_song(ctx, crossfade)
+            if started is not False:
+                # Playing, or the lookup was cancelled by whoever moved playback on
+                return
+            # Nothing was started, so no after callback will advance past this song
+            skipping = True
+        # A song being crossfaded out keeps playing, and advances the queue when it ends
+        self.is_playing = bool(self.voice_client and self.voice_client.is_playing())
+
+    async def start_song(self, ctx, crossfade=False):
+        """
+        Starts playing `current_song`.
+
+        Returns:
+            bool: True once playback started, False if the song couldn't be
+                resolved, or None if its lookup was cancelled.
+        """
+        warm_source = self.current_song.take_warm_source()
+        self.prefetcher.schedule(self.queue)
+        track_key = self.current_song.track_key
+        # Measured on an earlier play; otherwise this play measures it
+        track_gain = await track_gains.get(track_key)
+        analyzer = track_gains.analyzer(track_key) if track_gain is None else None
+        # Indexing the cache directory on first use and mapping the file both hit the disk
+        cached = await asyncio.get_running_loop().run_in_executor(None, default_opus_cache.open, track_key)
+        if cached:
+            # Played before: served from disk with no lookup, download or FFmpeg
+            if warm_source:
+                warm_source.cleanup()
+            # The lookup that would have named a song queued by URL is skipped
+            self.current_song.update_info(cached.metadata)
+            # Packets go out untouched unless something has to be applied to the audio
+            untouched = self.volume == 1.0 and not self.bass_boost and not self.normalize and not crossfade
+            processor = None if untouched else self.create_processor(track_gain)
+            audio_source = create_cached_audio_source(
+                cached,
+                processor=processor,
+                on_first_packet=self.on_first_packet,
+                recorders=[analyzer],
+            )
+        else:
+            with request_priority(PRIORITY_NOW_PLAYING):
+                resolve_task = self.resolve_task = asyncio.ensure_future(self.current_song.get_audio_stream())
+            try:
+                audio_stream = await resolve_task
+            except asyncio.CancelledError:
+                # The song was skipped or playback stopped while resolving
+                if warm_source:
+                    warm_source.cleanup()
+                return None
+            finally:
+                if self.resolve_task is resolve_task:
+                    self.resolve_task = None
+            if not audio_stream:
+                if warm_source:
+                    warm_source.cleanup()
+                await ctx.send(f"Error playing {self.current_song.title}. Skipping to the next song.")
+                return False
+            if self.opus_passthrough and not crossfade:
+                # Pre-buffered PCM can't be used for an Opus stream
+                if warm_source:
+                    warm_source.cleanup()
+                gain = self.volume * track_gain if self.normalize and track_gain is not None else self.volume
+                audio_source = create_opus_audio_source(
+                    audio_stream,
+                    codec=self.current_song.codec,
+                    gain=gain,
+                    on_first_packet=self.on_first_packet,
+                )
             else:
-                await ctx.send("Error playing the song. Please try again later.")
+                # Stream straight through FFmpeg; nothing is downloaded up front
+                audio_source = create_audio_source(
+                    audio_stream,
+                    volume=self.volume,
+                    source=warm_source,
+                    on_first_packet=self.on_first_packet,
+                    recorders=[default_opus_cache.writer(track_key, self.current_song.info), analyzer],
+                    processor=self.create_processor(track_gain),
+                )
+        playing = self.voice_client.source if crossfade and self.voice_client.is_playing() else None
+        if isinstance(playing, EffectsAudioSource) and isinstance(audio_source, EffectsAudioSource):
+            # Fade the new song in over the one being skipped; the after
+            # callback of the running source now fires when the new song ends
+            playing.crossfade_to(audio_source.original, self.crossfade_seconds)
+            playing.processor.track_gain = track_gain
         else:
-            self.is_playing = False
+            self.voice_client.play(audio_source, after=lambda e: self.on_track_end(ctx))
+        default_track_search.record(self.current_song)
+        if self.lyrics:
+            self.lyrics.prefetch([self.current_song, *itertools.islice(self.queue, 1)])
+        await ctx.send(f"Now playing: {self.current_song.title}")
+        return True
+
+    def on_track_end(self, ctx):
+        # Called from the voice client's audio thread
+        self.track_ended_at = time.perf_counter()
+        asyncio.run_coroutine_threadsafe(self.advance_after_track(ctx), loop=ctx.bot.loop)
+
+    async def advance_after_track(self, ctx):
+        # A crossfading skip that is still resolving the next song will start it itself
+        if self.resolve_task is None:
+            await self.queue_next(ctx)
+
+    def create_processor(self, track_gain=None):
+        """Creates the frame processor applying this player's volume and effects."""
+        return FrameProcessor(volume=self.volume, bass_boost=self.bass_boost, normalize=self.normalize, track_gain=track_gain)
+
+    def on_first_packet(self, started_at):
+        # Called from the voice client's audio thread
+        if self.track_ended_at is not None:
+            inter_track_gap.record((started_at - self.track_ended_at) * 1000)
+            self.track_ended_at = None
+
+    def playback_position(self):
+        """Returns how far into the current song playback is, in seconds, or None if nothing is playing."""
+        source = self.voice_client.source if self.voice_client else None
+        # Effects wrap the song's source; after a crossfade it is the incoming song's
+        source = getattr(source, "original", source)
+        return source.position if isinstance(source, BufferedAudioSource) else None
 
     def get_queue(self, ctx):
         return self.queue
@@ -124,6 +294,9 @@ class MusicPlayer:
     def get_current_song(self, ctx):
         return self.current_song
 
+    def render_queue(self, ctx, page=1):
+        return self.queue_view.render(page, self.current_song)
+
     async def pause(self, ctx):
         if self.voice_client and self.voice_client.is_playing():
             self.voice_client.pause()
@@ -138,17 +311,40 @@ class MusicPlayer:
         else:
             await ctx.send("The song is not paused.")
 
+    def cancel_resolve(self):
+        """Cancels the stream lookup for the song about to play, if any."""
+        if self.resolve_task and not self.resolve_task.done():
+            self.resolve_task.cancel()
+            # The lookup is shared with the prefetcher and only stops once neither waits on it
+            self.prefetcher.drop(self.current_song)
+            return True
+        return False
+
     async def skip(self, ctx):
-        if self.voice_client and self.voice_client.is_playing():
-            self.voice_client.stop()
+        if self.cancel_resolve():
+            self.skipping = True
             await ctx.send("Skipped to the next song.")
             await self.queue_next(ctx)
+        elif self.voice_client and self.voice_client.is_playing():
+            self.skipping = True
+            if self.crossfade_seconds and self.queue and isinstance(self.voice_client.source, EffectsAudioSource):
+                await ctx.send("Skipped to the next song.")
+                await self.queue_next(ctx, crossfade=True)
+            else:
+                # Stopping fires the after callback, which advances the queue
+                self.voice_client.stop()
+                await ctx.send("Skipped to the next song.")
         else:
             await ctx.send("No song is currently playing.")
 
     async def stop(self, ctx):
-        if self.voice_client and self.voice_client.is_playing():
-            self.voice_client.stop()
+        resolving = self.cancel_resolve()
+        if resolving or (self.voice_client and self.voice_client.is_playing()):
+            if self.voice_client:
+                self.voice_client.stop()
+            if self.expansion_task:
+                self.expansion_task.cancel()
+            self.prefetcher.cancel()
             self.queue.clear()
             self.current_song = None
             self.is_playing = False
@@ -158,17 +354,90 @@ class MusicPlayer:
 
     async def set_volume(self, ctx, volume):
         if self.voice_client:
-            self.voice_client.source.volume = volume / 100
-            await ctx.send(f"Volume set to {volume}%")
+            self.volume = volume / 100
+            source = self.voice_client.source
+            if source and not source.is_opus():
+                source.volume = self.volume
+                await ctx.send(f"Volume set to {volume}%")
+            else:
+                # Opus sources have their gain fixed when the song starts
+                await ctx.send(f"Volume set to {volume}%, starting with the next song.")
         else:
             await ctx.send("Not connected to a voice channel.")
 
-    async def loop(self, ctx):
-        self.is_looping = not self.is_looping
-        if self.is_looping:
-            await ctx.send("Looping enabled.")
-        else:
+    def playing_effects(self):
+        """Returns the processor of the PCM source playing now, if any."""
+        source = self.voice_client.source if self.voice_client else None
+        return source.processor if isinstance(source, EffectsAudioSource) else None
+
+    async def set_bass_boost(self, ctx, level):
+        """Sets the bass boost from 0 (off) to 10."""
+        if not 0 <= level <= 10:
+            await ctx.send("Bass boost must be between 0 and 10.")
+            return
+        self.bass_boost = level * 0.15
+        processor = self.playing_effects()
+        if processor:
+            processor.bass_boost = self.bass_boost
+        await ctx.send(f"Bass boost set to {level}." if level else "Bass boost disabled.")
+
+    async def set_normalize(self, ctx, enabled):
+        """Turns loudness normalization on or off."""
+        self.normalize = enabled
+        processor = self.playing_effects()
+        if processor:
+            processor.normalize = enabled
+        await ctx.send("Loudness normalization enabled." if enabled else "Loudness normalization disabled.")
+
+    async def set_crossfade(self, ctx, seconds):
+        """Sets how long skipped songs fade into the next one (0 disables)."""
+        if not 0 <= seconds <= 10:
+            await ctx.send("Crossfade must be between 0 and 10 seconds.")
+            return
+        self.crossfade_seconds = seconds
+        await ctx.send(f"Crossfade set to {seconds:g} seconds." if seconds else "Crossfade disabled.")
+
+    async def loop(self, ctx, mode=None):
+        """Sets the repeat mode ("off", "one" or "all"); without a mode, toggles looping the queue."""
+        if mode is None:
+            mode = REPEAT_OFF if self.is_looping else REPEAT_ALL
+        if mode not in REPEAT_MODES:
+            await ctx.send("Loop mode must be one of: off, one, all.")
+            return
+        self.queue.repeat = mode
+        if mode == REPEAT_OFF:
             await ctx.send("Looping disabled.")
+        elif mode == REPEAT_ALL:
+            await ctx.send("Looping the queue.")
+        else:
+            await ctx.send("Looping the current song.")
+
+    async def shuffle(self, ctx):
+        if self.queue:
+            self.queue.shuffle()
+            self.prefetcher.schedule(self.queue)
+            await ctx.send("Queue shuffled.")
+        else:
+            await ctx.send("The queue is empty.")
+
+    async def remove(self, ctx, position):
+        """Removes the song at a 1-based queue position."""
+        if 1 <= position <= len(self.queue):
+            song = self.queue.pop(position - 1)
+            self.prefetcher.schedule(self.queue)
+            await ctx.send(f"Removed: {song.title}")
+        else:
+            await ctx.send("There is no song at that position.")
+
+    async def move(self, ctx, source, destination):
+        """Moves a song between 1-based queue positions."""
+        if 1 <= source <= len(self.queue) and 1 <= destination <= len(self.queue):
+            song = self.queue[source - 1]
+            self.queue.move(source - 1, destination - 1)
+            self.prefetcher.schedule(self.queue)
+            await ctx.send(f"Moved {song.title} to position {destination}.")
+        else:
+            await ctx.send("There is no song at that position.")
 
     async def connect_voice(self, ctx):
         if ctx.author.voice:
@@ -185,12 +454,13 @@ class MusicPlayer:
         else:
             await ctx.send("Not connected to a voice channel.")
 
-    def get_source(self, query):
-        if "youtube.com" in query or "youtu.be" in query:
-            return "youtube"
-        elif "open.spotify.com" in query:
-            return "spotify"
-        elif "soundcloud.com" in query:
-            return "soundcloud"
-        else:
-            return None
\ No newline at end of file
+    def saved_song(self, song):
+        """Returns a Song for a song dict saved in a playlist, or None if its URL isn't a playable track."""
+        key = route(song.get("url", ""))
+        if not key or key.kind != "track":
+            return None
+        # Songs saved before they were played are titled with their URL until resolved
+        title = song.get("title")
+        if not title or title == song["url"]:
+            title = key.url
+        return Song(title=title, url=key.url, source=key.source)
\ No newline at end of file
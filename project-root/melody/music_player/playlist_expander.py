@@ -0,0 +1,99 @@
+import asyncio
+import os
+
+from melody.api.soundcloud_api import SoundCloudAPI
+from melody.api.spotify_api import SpotifyAPI
+from melody.music_player.song import Song
+from melody.music_player.resolver import default_resolver
+
+SPOTIFY_PLAYLIST_PAGE_SIZE = 100
+SPOTIFY_ALBUM_PAGE_SIZE = 50
+
+class PlaylistExpander:
+    """
+    Expands playlists and albums into unresolved Song placeholders.
+
+    Pages are fetched concurrently through the resolver (bounded by its
+    per-source limits) and handed back in order as soon as each is ready, so
+    the first songs can be queued and played while later pages load. Stream
+    URLs are only resolved once a song nears playback.
+    """
+    def __init__(self, spotify_api=None, soundcloud_api=None, resolver=None):
+        self._spotify_api = spotify_api
+        self._soundcloud_api = soundcloud_api
+        self.resolver = resolver or default_resolver
+
+    @property
+    def spotify_api(self):
+        if self._spotify_api is None:
+            self._spotify_api = SpotifyAPI(os.getenv("SPOTIFY_CLIENT_ID"), os.getenv("SPOTIFY_CLIENT_SECRET"))
+        return self._spotify_api
+
+    @property
+    def soundcloud_api(self):
+        if self._soundcloud_api is None:
+            self._soundcloud_api = SoundCloudAPI(os.getenv("SOUNDCLOUD_CLIENT_ID"), os.getenv("SOUNDCLOUD_CLIENT_SECRET"))
+        return self._soundcloud_api
+
+    async def expand(self, source, kind, collection):
+        """
+        Yields batches of Song placeholders for a playlist or album, in order.
+
+        Args:
+            source (str): "spotify" or "soundcloud".
+            kind (str): "playlist" or "album".
+            collection (str): The Spotify ID or the SoundCloud set URL.
+        """
+        if source == "spotify" and kind == "playlist":
+            pages = self.spotify_pages(self.spotify_api.get_playlist_page, collection, SPOTIFY_PLAYLIST_PAGE_SIZE)
+            async for page in pages:
+                yield [self.spotify_song(item.get("track")) for item in page["items"] if self.is_playable(item.get("track"))]
+        elif source == "spotify" and kind == "album":
+            pages = self.spotify_pages(self.spotify_api.get_album_page, collection, SPOTIFY_ALBUM_PAGE_SIZE)
+            async for page in pages:
+                yield [self.spotify_song(track) for track in page["items"] if self.is_playable(track)]
+        elif source == "soundcloud":
+            tracks = await self.resolver.resolve("soundcloud", self.soundcloud_api.get_playlist_tracks, collection)
+            if tracks:
+                yield [self.soundcloud_song(track) for track in tracks if self.soundcloud_url(track)]
+
+    async def spotify_pages(self, fetch_page, collection_id, page_size):
+        """Fetches the first page, then every remaining page concurrently, yielding them in order."""
+        first = await self.resolver.resolve("spotify", fetch_page, collection_id, 0, page_size)
+        if not first:
+            return
+        yield first
+        tasks = [
+            asyncio.ensure_future(self.resolver.resolve("spotify", fetch_page, collection_id, offset, page_size))
+            for offset in range(page_size, first.get("total", 0), page_size)
+        ]
+        try:
+            for task in tasks:
+                page = await task
+                if page:
+                    yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def is_playable(self, track):
+        return bool(track) and track.get("id") and not track.get("is_local") and track.get("type", "track") == "track"
+
+    def spotify_song(self, track):
+        artists = ", ".join(artist["name"] for artist in track.get("artists") or ())
+        title = f"{artists} - {track['name']}" if artists else track["name"]
+        song = Song(title=title, url=f"https://open.spotify.com/track/{track['id']}", source="spotify", resolver=self.resolver)
+        song.duration = track["duration_ms"] / 1000 if track.get("duration_ms") else None
+        return song
+
+    def soundcloud_url(self, track):
+        return track.get("permalink_url") if isinstance(track, dict) else getattr(track, "permalink_url", None)
+
+    def soundcloud_song(self, track):
+        get = track.get if isinstance(track, dict) else lambda name: getattr(track, name, None)
+        song = Song(title=get("title") or self.soundcloud_url(track), url=self.soundcloud_url(track), source="soundcloud", resolver=self.resolver)
+        song.duration = get("duration") / 1000 if get("duration") else None
+        return song
+
+# Shared expander used by every player
+default_expander = PlaylistExpander()
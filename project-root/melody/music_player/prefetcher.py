@@ -0,0 +1,136 @@
+import asyncio
+import itertools
+import time
+
+from melody.api.scheduler import PRIORITY_BACKGROUND, request_priority
+from melody.music_player.audio_source import warm_audio_source
+from melody.utils.opus_cache import default_opus_cache
+
+class Prefetcher:
+    """
+    Resolves stream URLs for the next few queued songs while the current one
+    plays, so the next track can start without waiting on a lookup.
+    """
+    def __init__(self, depth=3, refresh_margin=120.0, warm_seconds=0.0, opus_cache=None):
+        """
+        Args:
+            depth (int, optional): How many upcoming songs to resolve ahead of time.
+            refresh_margin (float, optional): Re-resolve URLs this many seconds before they expire.
+            warm_seconds (float, optional): Seconds of audio to pre-buffer for the next song (0 disables).
+            opus_cache (OpusCache, optional): Songs already in this cache are neither resolved nor buffered.
+        """
+        self.depth = depth
+        self.opus_cache = opus_cache if opus_cache is not None else default_opus_cache
+        self.refresh_margin = refresh_margin
+        self.warm_seconds = warm_seconds
+        self.tasks = {}
+        self.warmed = set()
+        self.head = None
+        self.queue = None
+        self.refresh_handle = None
+
+    def schedule(self, queue):
+        """
+        Starts lookups for upcoming songs that are unresolved or about to expire.
+
+        Must be called from the event loop whenever the queue or current song changes.
+        """
+        self.queue = queue
+        # Cached songs play from disk and need neither a URL nor buffered audio
+        upcoming = [song for song in itertools.islice(queue, self.depth) if song.track_key not in self.opus_cache]
+        self.head = upcoming[0] if upcoming and queue and upcoming[0] is queue[0] else None
+        for song in upcoming:
+            if song not in self.tasks and song.needs_resolve(self.refresh_margin):
+                self.track(song, self.prefetch(song))
+        if self.head is not None and self.head not in self.tasks:
+            self.warm(self.head)
+
+        # Songs that left the head of the queue no longer need their buffered audio
+        for song in list(self.warmed):
+            if song is not self.head:
+                self.warmed.discard(song)
+                song.discard_warm_source()
+
+        self.schedule_refresh(queue, upcoming)
+
+    def schedule_refresh(self, queue, upcoming):
+        """Arranges for `schedule` to run again just before the earliest URL expires."""
+        if self.refresh_handle:
+            self.refresh_handle.cancel()
+            self.refresh_handle = None
+        expiries = [song.expires_at for song in upcoming if song.stream_url]
+        if expiries:
+            delay = max(min(expiries) - self.refresh_margin - time.time(), 1.0)
+            loop = asyncio.get_running_loop()
+            self.refresh_handle = loop.call_later(delay, self.schedule, queue)
+
+    def track(self, song, coroutine):
+        # API calls made ahead of time wait behind those for songs being played now
+        with request_priority(PRIORITY_BACKGROUND):
+            task = asyncio.ensure_future(coroutine)
+        self.tasks[song] = task
+
+        def forget(_):
+            if self.tasks.get(song) is task:
+                del self.tasks[song]
+
+        task.add_done_callback(forget)
+
+    async def prefetch(self, song):
+        try:
+            stream_url = await song.get_audio_stream(self.refresh_margin)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error prefetching {song.title}: {e}")
+            return
+        # Resolving may have revealed the song's title and duration
+        self.queue.refresh_song(song)
+        if stream_url and song is self.head:
+            self.warm(song)
+
+    def warm(self, song):
+        """Pre-buffers the opening seconds of an already resolved song."""
+        if self.warm_seconds <= 0 or song in self.warmed or song.stream_url is None:
+            return
+        self.warmed.add(song)
+        self.track(song, self.warm_song(song))
+
+    async def warm_song(self, song):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            song.resolver.executor, warm_audio_source, song.stream_url, self.warm_seconds
+        )
+        try:
+            warm_source = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Stop FFmpeg once the worker thread finishes buffering
+            future.add_done_callback(lambda f: f.cancelled() or f.exception() or f.result().cleanup())
+            raise
+        except Exception as e:
+            print(f"Error buffering {song.title}: {e}")
+            self.warmed.discard(song)
+            return
+        if song in self.warmed:
+            song.warm_source = warm_source
+        else:
+            # The song left the head of the queue while buffering
+            warm_source.cleanup()
+
+    def drop(self, song):
+        """Cancels the lookup or buffering started for `song`, e.g. once it is skipped."""
+        task = self.tasks.pop(song, None)
+        if task:
+            task.cancel()
+
+    def cancel(self):
+        """Cancels all pending lookups and releases buffered audio."""
+        for task in list(self.tasks.values()):
+            task.cancel()
+        self.tasks.clear()
+        for song in self.warmed:
+            song.discard_warm_source()
+        self.warmed.clear()
+        if self.refresh_handle:
+            self.refresh_handle.cancel()
+            self.refresh_handle = None
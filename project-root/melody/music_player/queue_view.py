@@ -0,0 +1,90 @@
+import collections
+import itertools
+
+# Discord rejects messages longer than this
+MAX_MESSAGE_LENGTH = 2000
+MAX_TITLE_LENGTH = 80
+
+def format_duration(seconds):
+    """Formats seconds as M:SS or H:MM:SS."""
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+class QueueView:
+    """
+    Renders a SongQueue one page at a time.
+
+    Only the songs on the requested page are visited, starting from an indexed
+    iterator, and rendered pages are cached until the queue's version changes.
+    The total duration comes from the queue's running total, so no song is
+    resolved or walked to display it.
+    """
+    def __init__(self, queue, page_size=10, max_cached_pages=16):
+        self.queue = queue
+        self.page_size = page_size
+        self.max_cached_pages = max_cached_pages
+        self.pages = collections.OrderedDict()
+
+    def page_count(self):
+        return max((len(self.queue) + self.page_size - 1) // self.page_size, 1)
+
+    def render(self, page=1, current_song=None):
+        """
+        Renders one page of the queue as a Discord message.
+
+        Args:
+            page (int, optional): The 1-based page number, clamped to the valid range.
+            current_song (Song, optional): The song playing now, shown above the list.
+
+        Returns:
+            str: The message text, always shorter than Discord's limit.
+        """
+        page = min(max(page, 1), self.page_count())
+        # The playing song isn't in the queue, so its title and duration are part of the key
+        key = (
+            page, self.queue.version, id(current_song),
+            getattr(current_song, "title", None), getattr(current_song, "duration", None),
+        )
+        cached = self.pages.get(key)
+        if cached is not None:
+            self.pages.move_to_end(key)
+            return cached
+
+        text = self._render(page, current_song)
+        self.pages[key] = text
+        # Renders of older queue versions are the least recently used, so they go first
+        while len(self.pages) > self.max_cached_pages:
+            self.pages.popitem(last=False)
+        return text
+
+    def _render(self, page, current_song):
+        queue = self.queue
+        lines = []
+        if current_song is not None:
+            lines.append(f"**Now playing:** {self._format_song(current_song)}")
+        if not queue:
+            lines.append("The queue is empty.")
+            return "\n".join(lines)
+
+        total = format_duration(queue.total_duration)
+        if queue.unknown_durations:
+            total += f" + {queue.unknown_durations} of unknown length"
+        lines.append(f"**Queue:** {len(queue)} songs, {total} (page {page}/{self.page_count()})")
+
+        start = (page - 1) * self.page_size
+        songs = itertools.islice(queue.iter_from(start), self.page_size)
+        for position, song in enumerate(songs, start + 1):
+            lines.append(f"{position}. {self._format_song(song)}")
+
+        text = "\n".join(lines)
+        return text[:MAX_MESSAGE_LENGTH]
+
+    def _format_song(self, song):
+        title = song.title if len(song.title) <= MAX_TITLE_LENGTH else song.title[:MAX_TITLE_LENGTH - 1] + "…"
+        if song.duration is not None:
+            return f"{title} ({format_duration(song.duration)})"
+        return title
@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+from melody.music_player.music_player import MusicPlayer
+
+class GuildPlayerRegistry:
+    """
+    Holds one MusicPlayer per guild, creating players on first use and
+    evicting them once they have been idle for `idle_timeout` seconds.
+    """
+    def __init__(self, idle_timeout=600.0, player_factory=MusicPlayer):
+        self.idle_timeout = idle_timeout
+        self.player_factory = player_factory
+        self.players = {}
+
+    def get(self, guild_id):
+        """Returns the player for a guild, creating it if needed."""
+        player = self.players.get(guild_id)
+        if player is None:
+            player = self.players[guild_id] = self.player_factory(guild_id)
+        player.last_active = time.monotonic()
+        return player
+
+    def peek(self, guild_id):
+        """Returns the player for a guild without creating or touching it."""
+        return self.players.get(guild_id)
+
+    def remove(self, guild_id):
+        """Forgets the player for a guild."""
+        return self.players.pop(guild_id, None)
+
+    def idle_guilds(self, now=None):
+        """Lists the guilds whose players have been idle past the timeout."""
+        now = time.monotonic() if now is None else now
+        return [
+            guild_id for guild_id, player in self.players.items()
+            if not player.is_playing and now - player.last_active >= self.idle_timeout
+        ]
+
+    async def evict_idle(self):
+        """Disconnects and drops idle players, returning how many were evicted."""
+        evicted = 0
+        for guild_id in self.idle_guilds():
+            # Another task may have removed it while a disconnect was awaited
+            player = self.players.pop(guild_id, None)
+            if player is None:
+                continue
+            # Nothing may keep resolving songs for a player no one can reach
+            player.cancel_resolve()
+            if player.expansion_task:
+                player.expansion_task.cancel()
+            player.prefetcher.cancel()
+            if player.voice_client:
+                try:
+                    await player.voice_client.disconnect()
+                except Exception as e:
+                    print(f"Error disconnecting idle player for guild {guild_id}: {e}")
+            evicted += 1
+        return evicted
+
+    async def run_eviction(self, interval=60.0):
+        """Evicts idle players every `interval` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.evict_idle()
+
+    def __len__(self):
+        return len(self.players)
+
+    def __iter__(self):
+        return iter(self.players.values())
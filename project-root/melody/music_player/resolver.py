@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+from melody.api.scheduler import current_priority, request_deadline
+
+# Maximum number of lookups allowed in flight at once for each source
+DEFAULT_SOURCE_LIMITS = {
+    "youtube": 8,
+    "spotify": 4,
+    "soundcloud": 4,
+}
+
+# How long a resolved stream URL is trusted when it carries no expiry of its own
+DEFAULT_STREAM_TTLS = {
+    "youtube": 6 * 60 * 60,
+    "spotify": 60 * 60,
+    "soundcloud": 30 * 60,
+}
+
+def get_stream_expiry(source, stream_url, now=None):
+    """
+    Works out when a resolved stream URL stops being valid.
+
+    Signed googlevideo URLs carry an `expire` query parameter and other CDNs use
+    `Expires`; those are honoured when present, otherwise the per-source default
+    TTL applies.
+
+    Args:
+        source (str): The source the URL was resolved from.
+        stream_url (str): The resolved stream URL.
+        now (float, optional): The current Unix time.
+
+    Returns:
+        float: The Unix time after which the URL should be resolved again.
+    """
+    now = time.time() if now is None else now
+    expires_at = now + DEFAULT_STREAM_TTLS.get(source, 30 * 60)
+    try:
+        query = parse_qs(urlparse(stream_url).query)
+        signed = query.get("expire") or query.get("Expires")
+        if signed:
+            expires_at = min(expires_at, float(signed[0]))
+    except (TypeError, ValueError):
+        pass
+    return expires_at
+
+class PrioritySemaphore:
+    """
+    An asyncio semaphore that admits waiters by request priority, then in
+    arrival order, so the song about to play doesn't queue behind prefetches.
+    """
+    def __init__(self, value):
+        self.value = value
+        # (priority, arrival, future) of each waiting task
+        self.waiters = []
+        self._arrivals = itertools.count()
+
+    async def acquire(self, priority):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self._arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Admitted just as the task was cancelled; hand the slot on
+            if not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            # Cancelled waiters are left in the heap and skipped here
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+    @contextlib.asynccontextmanager
+    async def hold(self, priority):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+class StreamResolver:
+    """
+    Runs blocking stream lookups (youtube_dl, spotipy, soundcloud) in a bounded
+    thread pool so they never stall the event loop.
+
+    Lookups waiting for their source's limit are started in order of the
+    caller's request priority (see melody.api.scheduler).
+    """
+    def __init__(self, max_workers=16, source_limits=None, timeout=20.0):
+        self.max_workers = max_workers
+        self.source_limits = dict(DEFAULT_SOURCE_LIMITS, **(source_limits or {}))
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="melody-resolver")
+        self._semaphores = {}
+
+    def _get_semaphore(self, source):
+        semaphore = self._semaphores.get(source)
+        if semaphore is None:
+            semaphore = PrioritySemaphore(self.source_limits.get(source, self.max_workers))
+            self._semaphores[source] = semaphore
+        return semaphore
+
+    async def resolve(self, source, func, *args, timeout=None):
+        """
+        Runs `func(*args)` in the resolver pool, honouring the per-source limit.
+
+        Args:
+            source (str): The source the lookup belongs to (e.g. "youtube").
+            func (callable): The blocking function to run.
+            timeout (float, optional): Overrides the default timeout in seconds.
+
+        Returns:
+            The result of `func`, or None if the lookup timed out.
+
+        Cancelling the awaiting task drops the lookup: queued work never starts
+        and the result of work already running in a thread is discarded.
+        """
+        timeout = timeout or self.timeout
+        async with self._get_semaphore(source).hold(current_priority.get()):
+            loop = asyncio.get_running_loop()
+            # Carries the caller's request priority into the worker thread, and
+            # stops the thread waiting on rate limits once the lookup has timed out
+            context = contextvars.copy_context()
+            context.run(request_deadline.set, time.monotonic() + timeout)
+            future = loop.run_in_executor(self.executor, functools.partial(context.run, func, *args))
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                print(f"Timed out resolving {source} stream after {timeout}s")
+                return None
+
+    def shutdown(self):
+        """Stops the worker threads, dropping any lookups that have not started."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# Shared resolver used by songs that are not given one explicitly
+default_resolver = StreamResolver()
@@ -0,0 +1,197 @@
+import asyncio
+import functools
+import time
+import youtube_dl
+
+from melody.api.clients import clients
+from melody.api.scheduler import default_scheduler
+from melody.music_player.resolver import default_resolver, get_stream_expiry
+from melody.utils.cache import resolution_cache
+from melody.utils.source_router import canonical_key, route
+
+# Suppress noisy youtube_dl logging
+youtube_dl.utils.bug_reports_message = lambda: ''
+
+class Song:
+    __slots__ = (
+        "title", "url", "source", "resolver", "duration", "queued_duration",
+        "stream_url", "expires_at", "pending", "waiters", "warm_source", "codec",
+    )
+
+    def __init__(self, title, url, source, resolver=None):
+        self.title = title
+        self.url = url
+        self.source = source
+        self.resolver = resolver or default_resolver
+        self.duration = None
+        self.queued_duration = None
+        self.stream_url = None
+        self.expires_at = 0.0
+        self.pending = None
+        # Callers awaiting `pending`; the lookup is cancelled once none are left
+        self.waiters = 0
+        self.warm_source = None
+        # Audio codec of the resolved stream, when the source reports it
+        self.codec = None
+
+    @property
+    def track_key(self):
+        """Identifies the track across every way of linking it, e.g. "youtube:track:dQw4w9WgXcQ"."""
+        return canonical_key(self.url)
+
+    def needs_resolve(self, margin=0.0):
+        """Returns True if the stream URL is missing or expires within `margin` seconds."""
+        return self.stream_url is None or time.time() + margin >= self.expires_at
+
+    async def get_audio_stream(self, margin=0.0):
+        """
+        Returns the stream URL, resolving it unless a fresh one is already known.
+
+        Concurrent callers (the player and the prefetcher) share one lookup,
+        which is cancelled when the last of them is (e.g. on !skip or !stop).
+        """
+        if not self.needs_resolve(margin):
+            return self.stream_url
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self.resolve_audio_stream())
+        pending = self.pending
+        self.waiters += 1
+        try:
+            return await asyncio.shield(pending)
+        finally:
+            self.waiters -= 1
+            if not self.waiters and not pending.done():
+                pending.cancel()
+                # A caller arriving before the cancellation lands starts a fresh lookup
+                if self.pending is pending:
+                    self.pending = None
+
+    async def resolve_audio_stream(self):
+        try:
+            stream_url = await self.lookup_audio_stream()
+        finally:
+            if self.pending is asyncio.current_task():
+                self.pending = None
+        if stream_url:
+            self.stream_url = stream_url
+            self.expires_at = get_stream_expiry(self.source, stream_url)
+        return stream_url
+
+    def take_warm_source(self):
+        """Hands over the pre-buffered audio source, if one was prepared."""
+        warm_source, self.warm_source = self.warm_source, None
+        return warm_source
+
+    def discard_warm_source(self):
+        """Stops the FFmpeg process behind an unused pre-buffered source."""
+        warm_source = self.take_warm_source()
+        if warm_source:
+            warm_source.cleanup()
+
+    async def lookup_audio_stream(self):
+        if self.source == "youtube":
+            return await self.get_youtube_audio_stream()
+        elif self.source == "spotify":
+            return await self.get_spotify_audio_stream()
+        elif self.source == "soundcloud":
+            return await self.get_soundcloud_audio_stream()
+
+    async def get_youtube_audio_stream(self):
+        return await self.load_track("youtube", self.extract_youtube_track)
+
+    async def get_spotify_audio_stream(self):
+        return await self.load_track("spotify", self.extract_spotify_track)
+
+    async def get_soundcloud_audio_stream(self):
+        return await self.load_track("soundcloud", self.extract_soundcloud_track)
+
+    async def load_track(self, source, extract):
+        """
+        Resolves track metadata and the stream URL through the shared cache.
+
+        Returns:
+            str: The stream URL, or None if it could not be resolved.
+        """
+        load = functools.partial(
+            resolution_cache.get_or_load,
+            f"track:{self.track_key}",
+            extract,
+            source=source,
+            expires_at=lambda track: get_stream_expiry(source, track["stream_url"]),
+        )
+        track = await self.resolver.resolve(source, load)
+        if not track:
+            return None
+        self.update_info(track)
+        self.codec = track.get("codec")
+        return track["stream_url"]
+
+    @property
+    def info(self):
+        """The title, if known beyond the URL, and the duration, as stored with cached audio."""
+        return {"title": self.title if self.title != self.url else None, "duration": self.duration}
+
+    def update_info(self, info):
+        """Fills in the title of a song queued by URL, and its duration, from a track or cache entry."""
+        if self.title == self.url and info.get("title"):
+            self.title = info["title"]
+        if info.get("duration"):
+            self.duration = info["duration"]
+
+    # The extract_* methods block on network I/O and must only be called from
+    # the resolver's worker threads. Each returns a dictionary with the
+    # `stream_url`, `title` and `duration` of the track, plus its `codec` if
+    # known, or None.
+
+    def extract_youtube_track(self):
+        try:
+            # Use youtube-dl to download and extract the audio stream
+            ydl_opts = {
+                # Prefer Opus (usually WebM) so passthrough playback can skip transcoding
+                'format': 'bestaudio[acodec=opus]/bestaudio/best',
+                'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+                'noplaylist': True,
+                'nocheckcertificate': True,
+                'ignoreerrors': True,
+                'logtostderr': False,
+                'quiet': True,
+                'no_warnings': True,
+                'default_search': 'auto',
+            }
+            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(self.url, download=False)
+                audio_url = info.get('url') or info['formats'][0]['url']
+            return {"stream_url": audio_url, "title": info.get('title'), "duration": info.get('duration'), "codec": info.get('acodec')}
+        except Exception as e:
+            print(f"Error getting YouTube audio stream: {e}")
+            return None
+
+    def extract_spotify_track(self):
+        try:
+            # Use the shared spotipy client to get track information and audio URL
+            sp = clients.spotify()
+            key = route(self.url)
+            if key and key.kind == "track":
+                track = default_scheduler.call("spotify", sp.track, key.id)
+            else:
+                track_info = default_scheduler.call("spotify", sp.search, q=self.url, type='track', limit=1)
+                track = track_info['tracks']['items'][0]
+            audio_url = track['preview_url']
+            if not audio_url:
+                return None
+            title = f"{track['artists'][0]['name']} - {track['name']}" if track.get('artists') else track['name']
+            return {"stream_url": audio_url, "title": title, "duration": track['duration_ms'] / 1000}
+        except Exception as e:
+            print(f"Error getting Spotify audio stream: {e}")
+            return None
+
+    def extract_soundcloud_track(self):
+        try:
+            # Use the shared soundcloud-python client to get track information and audio URL
+            client = clients.soundcloud()
+            track = default_scheduler.call("soundcloud", client.get, '/resolve', url=self.url)
+            audio_url = track.stream_url
+            return {"stream_url": audio_url, "title": track.title, "duration": track.duration / 1000}
+        except Exception as e:
+            print(f"Error getting SoundCloud audio stream: {e}")
+            return None
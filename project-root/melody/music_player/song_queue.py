@@ -0,0 +1,265 @@
+import itertools
+import random
+
+REPEAT_OFF = "off"
+REPEAT_ONE = "one"
+REPEAT_ALL = "all"
+REPEAT_MODES = (REPEAT_OFF, REPEAT_ONE, REPEAT_ALL)
+
+class SongQueue:
+    """
+    An indexed song queue built from fixed-capacity blocks.
+
+    Songs live in a list of blocks of at most `2 * block_size` entries, with a
+    Fenwick tree over the block lengths to find the block holding any position.
+    That gives amortized O(1) `append` and `popleft`, O(log n) indexed access,
+    `insert`, `pop` and `move` (plus an O(block_size) memmove inside one block),
+    and an O(n) in-place `shuffle`.
+
+    The queue also owns the repeat mode, which `advance` honours when picking
+    the next song to play.
+
+    `version` increases on every mutation so views can cache renders, and the
+    total duration of queued songs is kept up to date incrementally. Each
+    queued song remembers the duration it was counted with in
+    `queued_duration` (-1.0 while unknown, None once it leaves the queue).
+    """
+
+    BLOCK_SIZE = 512
+
+    def __init__(self, songs=(), block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.blocks = []
+        self.length = 0
+        self.repeat = REPEAT_OFF
+        self.version = 0
+        self.total_duration = 0.0
+        self.unknown_durations = 0
+        # Fenwick tree over block lengths; None when the block layout changed
+        self._tree = None
+        self.extend(songs)
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from block
+
+    def __getitem__(self, index):
+        block_index, offset = self._locate(index)
+        return self.blocks[block_index][offset]
+
+    def __setitem__(self, index, song):
+        block_index, offset = self._locate(index)
+        self._uncount(self.blocks[block_index][offset])
+        self._count(song)
+        self.blocks[block_index][offset] = song
+        self.version += 1
+
+    def iter_from(self, start):
+        """Iterates from position `start` without walking the songs before it."""
+        if start >= self.length:
+            return iter(())
+        block_index, offset = self._locate(start)
+        head = itertools.islice(self.blocks[block_index], offset, None)
+        rest = itertools.chain.from_iterable(itertools.islice(self.blocks, block_index + 1, None))
+        return itertools.chain(head, rest)
+
+    def append(self, song):
+        """Adds a song to the end of the queue."""
+        if self.blocks and len(self.blocks[-1]) < self.block_size:
+            self.blocks[-1].append(song)
+            self._tree_add(len(self.blocks) - 1, 1)
+        else:
+            self.blocks.append([song])
+            self._tree = None
+        self.length += 1
+        self._count(song)
+        self.version += 1
+
+    def extend(self, songs):
+        """Adds many songs to the end of the queue."""
+        for song in songs:
+            self.append(song)
+
+    def popleft(self):
+        """Removes and returns the song at the front of the queue."""
+        if not self.length:
+            raise IndexError("pop from an empty queue")
+        first = self.blocks[0]
+        song = first.pop(0)
+        if first:
+            self._tree_add(0, -1)
+        else:
+            del self.blocks[0]
+            self._tree = None
+        self.length -= 1
+        self._uncount(song)
+        self.version += 1
+        return song
+
+    def pop(self, index=-1):
+        """Removes and returns the song at `index`."""
+        if index == 0:
+            return self.popleft()
+        block_index, offset = self._locate(index)
+        block = self.blocks[block_index]
+        song = block.pop(offset)
+        if block:
+            self._tree_add(block_index, -1)
+        else:
+            del self.blocks[block_index]
+            self._tree = None
+        self.length -= 1
+        self._uncount(song)
+        self.version += 1
+        return song
+
+    def insert(self, index, song):
+        """Inserts a song before position `index`."""
+        if index < 0:
+            index = max(self.length + index, 0)
+        if index >= self.length:
+            self.append(song)
+            return
+        block_index, offset = self._locate(index)
+        block = self.blocks[block_index]
+        block.insert(offset, song)
+        self.length += 1
+        self._count(song)
+        self.version += 1
+        if len(block) > 2 * self.block_size:
+            self.blocks[block_index:block_index + 1] = [block[:self.block_size], block[self.block_size:]]
+            self._tree = None
+        else:
+            self._tree_add(block_index, 1)
+
+    def move(self, source, destination):
+        """Moves the song at position `source` to position `destination`."""
+        self.insert(destination, self.pop(source))
+
+    def clear(self):
+        """Removes every song."""
+        for song in self:
+            song.queued_duration = None
+        self.blocks = []
+        self.length = 0
+        self.total_duration = 0.0
+        self.unknown_durations = 0
+        self._tree = None
+        self.version += 1
+
+    def shuffle(self, rng=random):
+        """Shuffles the queue in place in O(n)."""
+        # Even out the blocks so every position maps to its block with divmod
+        songs = iter(self)
+        size = self.block_size
+        self.blocks = [block for block in iter(lambda: list(itertools.islice(songs, size)), [])]
+        self._tree = None
+        blocks = self.blocks
+        for i in range(self.length - 1, 0, -1):
+            j = rng.randrange(i + 1)
+            bi, oi = divmod(i, size)
+            bj, oj = divmod(j, size)
+            blocks[bi][oi], blocks[bj][oj] = blocks[bj][oj], blocks[bi][oi]
+        self.version += 1
+
+    def refresh_song(self, song):
+        """Records that resolving a queued song may have changed its title or duration."""
+        counted = song.queued_duration
+        if counted is None:
+            return
+        # Renders of the queue show the song's title, even when its duration is unchanged
+        self.version += 1
+        if song.duration is None:
+            return
+        if counted < 0:
+            self.unknown_durations -= 1
+        else:
+            self.total_duration -= counted
+        song.queued_duration = song.duration
+        self.total_duration += song.duration
+
+    def _count(self, song):
+        if song.duration is None:
+            song.queued_duration = -1.0
+            self.unknown_durations += 1
+        else:
+            song.queued_duration = song.duration
+            self.total_duration += song.duration
+
+    def _uncount(self, song):
+        counted = song.queued_duration
+        if counted is None:
+            return
+        if counted < 0:
+            self.unknown_durations -= 1
+        else:
+            self.total_duration -= counted
+        song.queued_duration = None
+
+    def advance(self, current, skip=False):
+        """
+        Picks the next song to play according to the repeat mode.
+
+        Args:
+            current (Song): The song that just finished, or None.
+            skip (bool, optional): True if the user skipped, which overrides repeat-one.
+
+        Returns:
+            Song: The song to play next, or None if there is nothing left.
+        """
+        if current is not None:
+            if self.repeat == REPEAT_ONE and not skip:
+                return current
+            if self.repeat == REPEAT_ALL:
+                self.append(current)
+        return self.popleft() if self.length else None
+
+    def _locate(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("queue index out of range")
+        first = len(self.blocks[0])
+        if index < first:
+            return 0, index
+        last = len(self.blocks[-1])
+        if index >= self.length - last:
+            return len(self.blocks) - 1, index - (self.length - last)
+        tree = self._get_tree()
+        # Descend the Fenwick tree to the block containing `index`
+        position = 0
+        remaining = index
+        step = 1 << (len(self.blocks).bit_length() - 1)
+        while step:
+            next_position = position + step
+            if next_position <= len(self.blocks) and tree[next_position] <= remaining:
+                position = next_position
+                remaining -= tree[next_position]
+            step >>= 1
+        return position, remaining
+
+    def _get_tree(self):
+        if self._tree is None:
+            tree = [0] * (len(self.blocks) + 1)
+            for i, block in enumerate(self.blocks, 1):
+                tree[i] += len(block)
+                parent = i + (i & -i)
+                if parent < len(tree):
+                    tree[parent] += tree[i]
+            self._tree = tree
+        return self._tree
+
+    def _tree_add(self, block_index, delta):
+        tree = self._tree
+        if tree is None:
+            return
+        i = block_index + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
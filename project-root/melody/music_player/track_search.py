@@ -0,0 +1,136 @@
+import asyncio
+import os
+
+from melody.api.spotify_api import SpotifyAPI
+from melody.api.youtube_api import YouTubeAPI
+from melody.music_player.resolver import default_resolver
+from melody.utils import metrics
+from melody.utils.search_index import SearchIndex, normalize_text
+from melody.utils.source_router import canonical_key
+
+# Tracks indexed between yields to the event loop while loading
+LOAD_SLICE = 250
+
+class TrackSearch:
+    """
+    Turns search terms into a track to play.
+
+    Every track the bot resolves is added to a local SearchIndex (and, once a
+    database is configured, to its `tracks` collection, from which the index
+    is rebuilt on startup). Searches are answered from the index when a known
+    title matches; only the rest cost a YouTube or Spotify API call, and
+    concurrent searches for the same terms share one call.
+    """
+    def __init__(self, youtube_api=None, spotify_api=None, resolver=None):
+        self._youtube_api = youtube_api
+        self._spotify_api = spotify_api
+        self.resolver = resolver or default_resolver
+        self.index = SearchIndex()
+        self.database = None
+        self.pending = {}
+        self.local_hits = metrics.counter("track_search_local_hits")
+        self.remote_searches = metrics.counter("track_search_remote_searches")
+
+    def configure(self, database):
+        """Persists searchable tracks to `database` (any object with iter_tracks/save_track), or nowhere if None."""
+        self.database = database
+
+    @property
+    def youtube_api(self):
+        if self._youtube_api is None and os.getenv("YOUTUBE_API_KEY"):
+            self._youtube_api = YouTubeAPI(os.getenv("YOUTUBE_API_KEY"))
+        return self._youtube_api
+
+    @property
+    def spotify_api(self):
+        if self._spotify_api is None and os.getenv("SPOTIFY_CLIENT_ID"):
+            self._spotify_api = SpotifyAPI(os.getenv("SPOTIFY_CLIENT_ID"), os.getenv("SPOTIFY_CLIENT_SECRET"))
+        return self._spotify_api
+
+    async def load(self):
+        """
+        Builds the index from the database's recorded tracks.
+
+        Searches keep working while it loads, against whatever has been indexed so far.
+        """
+        if self.database is None:
+            return
+        count = 0
+        async for batch in self.database.iter_tracks():
+            for track in batch:
+                if track.get("title"):
+                    self.index.add(track["url"], track["source"], track["title"], key=track["_id"])
+                for query in track.get("queries", ()):
+                    self.index.add_alias(query, track["url"], track["source"], track.get("title"))
+                count += 1
+                if count % LOAD_SLICE == 0:
+                    # Indexing is CPU-bound; keep the event loop responsive
+                    await asyncio.sleep(0)
+        print(f"Loaded {count} tracks into the search index")
+
+    async def search(self, query):
+        """
+        Finds a track for search terms.
+
+        Args:
+            query (str): Free-text search terms, e.g. "never gonna give you up".
+
+        Returns:
+            tuple: The (url, source, title) of the track, or None if nothing was found.
+        """
+        match = self.index.search(query)
+        if match:
+            self.local_hits.increment()
+            return match
+        text = normalize_text(query)
+        if not text:
+            return None
+        pending = self.pending.get(text)
+        if pending is None:
+            pending = self.pending[text] = asyncio.ensure_future(self.search_remote(query))
+            pending.add_done_callback(lambda _: self.pending.pop(text, None))
+        return await asyncio.shield(pending)
+
+    async def search_remote(self, query):
+        """Searches YouTube, or Spotify without a YouTube API key, and remembers the answer."""
+        self.remote_searches.increment()
+        match = None
+        if self.youtube_api:
+            video_id = await self.resolver.resolve("youtube", self.youtube_api.search_video, query)
+            if video_id:
+                match = (self.youtube_api.get_video_url(video_id), "youtube", None)
+        if match is None and self.spotify_api:
+            track = await self.resolver.resolve("spotify", self.spotify_api.search_track, query)
+            if track:
+                artists = ", ".join(artist["name"] for artist in track.get("artists") or ())
+                title = f"{artists} - {track['name']}" if artists else track["name"]
+                match = (f"https://open.spotify.com/track/{track['id']}", "spotify", title)
+        if match is None:
+            return None
+        url, source, title = match
+        if title:
+            self.index.add(url, source, title)
+        self.index.add_alias(query, url, source, title)
+        self.save(url, source, title, query)
+        return self.index.search(query)
+
+    def record(self, song):
+        """
+        Adds a song to the index once its title is known, e.g. after it was resolved.
+
+        Args:
+            song (Song): The song; ignored while its title is still its URL.
+        """
+        if song.title != song.url and self.index.add(song.url, song.source, song.title):
+            self.save(song.url, song.source, song.title)
+
+    def save(self, url, source, title=None, query=None):
+        if self.database is None:
+            return
+        track = {"url": url, "source": source}
+        if title:
+            track["title"] = title
+        asyncio.ensure_future(self.database.save_track(canonical_key(url), track, query))
+
+# Shared search used by every player
+default_track_search = TrackSearch()
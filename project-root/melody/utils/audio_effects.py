@@ -0,0 +1,217 @@
+import math
+import threading
+
+import discord
+import numpy as np
+
+# discord.py plays 20ms frames of 48kHz 16-bit stereo PCM
+SAMPLES_PER_FRAME = 960
+CHANNELS = 2
+FRAME_SIZE = SAMPLES_PER_FRAME * CHANNELS * 2
+FRAMES_PER_SECOND = 50
+
+class FrameProcessor:
+    """
+    Applies volume, bass boost and loudness normalization to PCM frames.
+
+    Every buffer is allocated up front and each frame is processed in place,
+    so the only per-frame allocation is the bytes object handed back to the
+    voice client. Gain changes (from the volume or the normalizer) are ramped
+    sample by sample, so adjustments never click.
+    """
+    def __init__(self, volume=1.0, bass_boost=0.0, normalize=False, smoothing=0.5,
+                 bass_window=96, target_rms=3000.0, max_gain=4.0, track_gain=None):
+        """
+        Args:
+            volume (float, optional): The playback volume (1.0 is 100%).
+            bass_boost (float, optional): How much low-passed signal to add back (0 disables, 1.0 is +6dB of bass).
+            normalize (bool, optional): Whether to even out loudness, with `track_gain` if known or else towards `target_rms`.
+            smoothing (float, optional): Fraction of the remaining gain change applied per frame.
+            bass_window (int, optional): Samples averaged by the bass low-pass; 96 cuts off around 200Hz.
+            target_rms (float, optional): Loudness the normalizer aims for, as a 16-bit RMS.
+            max_gain (float, optional): The most the normalizer will amplify quiet audio.
+            track_gain (float, optional): The track's measured loudness gain, from TrackGains.
+        """
+        self.volume = volume
+        self.bass_boost = bass_boost
+        self.normalize = normalize
+        self.smoothing = smoothing
+        self.bass_window = bass_window
+        self.target_rms = target_rms
+        self.max_gain = max_gain
+        self.track_gain = track_gain
+        self.gain = volume
+        self.loudness = None
+
+        self.samples = np.zeros((SAMPLES_PER_FRAME, CHANNELS), dtype=np.float32)
+        self.outgoing = np.zeros((SAMPLES_PER_FRAME, CHANNELS), dtype=np.float32)
+        # Position of each sample within the frame, from 1/960 to 1, for ramps
+        self.ramp = (np.arange(1, SAMPLES_PER_FRAME + 1, dtype=np.float32) / SAMPLES_PER_FRAME)[:, None]
+        self.gains = np.empty((SAMPLES_PER_FRAME, 1), dtype=np.float32)
+        self.fade_gains = np.empty((SAMPLES_PER_FRAME, 1), dtype=np.float32)
+        # The bass filter's running sums need the tail of the previous frame
+        self.history = np.zeros((bass_window + SAMPLES_PER_FRAME, CHANNELS), dtype=np.float64)
+        self.sums = np.empty_like(self.history)
+        self.low = np.empty((SAMPLES_PER_FRAME, CHANNELS), dtype=np.float64)
+        self.output_buffer = bytearray(FRAME_SIZE)
+        self.output = np.frombuffer(self.output_buffer, dtype=np.int16).reshape(SAMPLES_PER_FRAME, CHANNELS)
+
+    def process(self, frame):
+        """
+        Processes one frame.
+
+        Args:
+            frame (bytes): 3840 bytes of 16-bit stereo PCM.
+
+        Returns:
+            bytes: The processed frame. Frames of any other size are returned unchanged.
+        """
+        if not self._load(self.samples, frame):
+            return frame
+        return self._render()
+
+    def process_crossfade(self, incoming, outgoing, position, frames):
+        """
+        Mixes one frame of a crossfade and processes the result.
+
+        Args:
+            incoming (bytes): A frame of the track fading in, or b"" if it has none.
+            outgoing (bytes): A frame of the track fading out, or b"" if it has none.
+            position (int): How many frames of the crossfade have already played.
+            frames (int): The length of the crossfade in frames.
+
+        Returns:
+            bytes: The processed frame.
+        """
+        samples, fade_in, fade_out = self.samples, self.gains, self.fade_gains
+        if not self._load(samples, incoming):
+            samples.fill(0)
+        if self._load(self.outgoing, outgoing):
+            np.add(self.ramp, position, out=fade_in)
+            fade_in /= frames
+            np.subtract(1.0, fade_in, out=fade_out)
+            samples *= fade_in
+            self.outgoing *= fade_out
+            samples += self.outgoing
+        return self._render()
+
+    def _load(self, buffer, frame):
+        if len(frame) != FRAME_SIZE:
+            return False
+        np.copyto(buffer, np.frombuffer(frame, dtype=np.int16).reshape(SAMPLES_PER_FRAME, CHANNELS))
+        return True
+
+    def _render(self):
+        samples = self.samples
+        if self.bass_boost > 0:
+            self._boost_bass(samples)
+        target = self.volume
+        if self.normalize:
+            # A measured gain is exact for the whole track; the running estimate is the fallback
+            target *= self.track_gain if self.track_gain is not None else self._normalization_gain(samples)
+        self._apply_gain(samples, target)
+        np.rint(samples, out=samples)
+        np.clip(samples, -32768, 32767, out=samples)
+        np.copyto(self.output, samples, casting="unsafe")
+        return bytes(self.output_buffer)
+
+    def _boost_bass(self, samples):
+        # A boxcar (moving average) low-pass from running sums, added back on top
+        window = self.bass_window
+        history = self.history
+        history[window:] = samples
+        np.cumsum(history, axis=0, out=self.sums)
+        np.subtract(self.sums[window:], self.sums[:SAMPLES_PER_FRAME], out=self.low)
+        self.low *= self.bass_boost / window
+        samples += self.low
+        history[:window] = history[SAMPLES_PER_FRAME:]
+
+    def _normalization_gain(self, samples):
+        power = float(np.vdot(samples, samples)) / samples.size
+        # Near-silence (gaps, fades) shouldn't pull the gain up
+        if power > 1.0:
+            if self.loudness is None:
+                self.loudness = power
+            else:
+                self.loudness += (power - self.loudness) * 0.05
+        if not self.loudness:
+            return 1.0
+        return min(self.target_rms / math.sqrt(self.loudness), self.max_gain)
+
+    def _apply_gain(self, samples, target):
+        start = self.gain
+        end = target if abs(target - start) < 1e-4 else start + (target - start) * self.smoothing
+        self.gain = end
+        if start == end:
+            if end != 1.0:
+                samples *= end
+            return
+        np.multiply(self.ramp, end - start, out=self.gains)
+        self.gains += start
+        samples *= self.gains
+
+class EffectsAudioSource(discord.AudioSource):
+    """
+    Plays a PCM source through a FrameProcessor.
+
+    A drop-in replacement for discord.PCMVolumeTransformer: `volume` can be
+    changed while playing (and is ramped), and `original` is the wrapped
+    source. `crossfade_to` switches to another source mid-stream, fading the
+    current one out underneath it.
+    """
+    def __init__(self, original, processor=None, volume=1.0):
+        self.original = original
+        self.processor = processor or FrameProcessor(volume=volume)
+        self.fading = None
+        self.fade_position = 0
+        self.fade_frames = 0
+        self._lock = threading.Lock()
+
+    @property
+    def volume(self):
+        return self.processor.volume
+
+    @volume.setter
+    def volume(self, value):
+        self.processor.volume = max(value, 0.0)
+
+    def crossfade_to(self, source, seconds):
+        """
+        Starts playing `source` while the current source fades out.
+
+        Args:
+            source (discord.AudioSource): The PCM source to switch to.
+            seconds (float): The length of the crossfade.
+        """
+        with self._lock:
+            if self.fading:
+                self.fading.cleanup()
+            self.fading = self.original
+            self.original = source
+            self.fade_position = 0
+            self.fade_frames = max(int(seconds * FRAMES_PER_SECOND), 1)
+
+    def read(self):
+        with self._lock:
+            frame = self.original.read()
+            if self.fading is None:
+                return self.processor.process(frame) if frame else b""
+            outgoing = self.fading.read()
+            if not frame and not outgoing:
+                return b""
+            mixed = self.processor.process_crossfade(frame, outgoing, self.fade_position, self.fade_frames)
+            self.fade_position += 1
+            if not outgoing or self.fade_position >= self.fade_frames:
+                self.fading.cleanup()
+                self.fading = None
+            return mixed
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        with self._lock:
+            if self.fading:
+                self.fading.cleanup()
+                self.fading = None
+            self.original.cleanup()
@@ -1,11 +1,96 @@
+import asyncio
+import functools
+import inspect
+import io
+import math
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
 import ffmpeg
 from pydub import AudioSegment
 
+from melody.utils.opus_cache import default_opus_cache
+
+# 20ms of 48kHz 16-bit stereo PCM, the frame discord.py encodes
+PCM_FRAME_SIZE = 3840
+
+# Bytes moved per read or write when streaming through FFmpeg; with the OS
+# pipe buffers this bounds the memory a conversion uses, whatever its length
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class ChunkReader(io.RawIOBase):
+    """A read-only file object over an iterator of byte chunks.
+
+    Wraps the output of `AudioHandler.iter_convert` so it can be handed to
+    anything expecting a file, such as the player's audio sources.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = chunk
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if hasattr(self.chunks, "close"):
+            # Stops the FFmpeg process behind a conversion that wasn't read to the end
+            self.chunks.close()
+        super().close()
+
+def _read_chunks(source, chunk_size=STREAM_CHUNK_SIZE):
+    # Iterates a file object or an iterable of byte chunks
+    if hasattr(source, "read"):
+        return iter(functools.partial(source.read, chunk_size), b"")
+    return iter(source)
+
+def _run_job(method, args):
+    # Runs in a worker process, which has its own handler
+    return getattr(AudioHandler(), method)(*args)
+
 class AudioHandler:
-    """Handles audio manipulation tasks like format conversion and volume adjustment."""
+    """Handles audio manipulation tasks like format conversion and volume adjustment.
 
-    def __init__(self):
-        pass
+    Every method has an `_async` variant that runs it off the event loop, and
+    the batch methods (`convert_formats`, `adjust_volumes`,
+    `get_audio_durations`) process many files at once, at most `max_workers`
+    at a time.
+    """
+
+    def __init__(self, max_workers=None):
+        """
+        Args:
+            max_workers (int, optional): Files processed at once by the batch methods; defaults to the CPU count.
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._process_pool = None
+        self._thread_pool = None
+
+    @property
+    def process_pool(self):
+        # Decoding and re-encoding is CPU-bound, so batches of it get their own processes
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._process_pool
+
+    @property
+    def thread_pool(self):
+        # Single files and probes mostly wait on an FFmpeg subprocess, which threads do just as well
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="melody-audio")
+        return self._thread_pool
 
     def convert_format(self, input_file, output_format, output_file=None):
         """Converts audio between different formats using ffmpeg.
@@ -19,7 +104,7 @@ class AudioHandler:
             str: Path to the output audio file.
         """
         if not output_file:
-            output_file = f"{input_file[:-4]}.{output_format}"
+            output_file = f"{os.path.splitext(input_file)[0]}.{output_format}"
 
         try:
             (
@@ -44,20 +129,23 @@ class AudioHandler:
         Returns:
             str: Path to the output audio file.
         """
+        root, extension = os.path.splitext(input_file)
         if not output_file:
-            output_file = f"{input_file[:-4]}_adjusted.{input_file[-3:]}"
+            output_file = f"{root}_adjusted{extension}"
 
         try:
             audio = AudioSegment.from_file(input_file)
-            audio = audio.apply_gain(volume_factor * 10)  # Apply gain in dB
-            audio.export(output_file, format=input_file[-3:])
+            audio = audio.apply_gain(20 * math.log10(volume_factor))  # The factor scales amplitude; pydub takes dB
+            audio.export(output_file, format=os.path.splitext(output_file)[1][1:] or extension[1:])
             return output_file
         except Exception as e:
             print(f"Error adjusting audio volume: {e}")
             return None
 
     def get_audio_duration(self, input_file):
-        """Retrieves the duration of an audio file using pydub.
+        """Retrieves the duration of an audio file with ffprobe.
+
+        Only the container and stream headers are read; the audio is never decoded.
 
         Args:
             input_file (str): Path to the input audio file.
@@ -66,8 +154,419 @@ class AudioHandler:
             float: Duration of the audio in seconds.
         """
         try:
-            audio = AudioSegment.from_file(input_file)
-            return audio.duration_seconds
+            probe = ffmpeg.probe(input_file)
+            duration = probe.get("format", {}).get("duration")
+            if duration is None:
+                # Some containers only report it per stream
+                audio_streams = [stream for stream in probe.get("streams", []) if stream.get("codec_type") == "audio"]
+                duration = audio_streams[0].get("duration") if audio_streams else None
+            return float(duration) if duration is not None else None
         except Exception as e:
             print(f"Error getting audio duration: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def cache_opus(self, input_file, key, opus_cache=default_opus_cache):
+        """Encodes an audio file into the Opus cache so it plays without FFmpeg.
+
+        Args:
+            input_file (str): Path to the input audio file.
+            key (str): The track key to store it under, e.g. a normalized track URL.
+            opus_cache (OpusCache, optional): The cache to fill.
+
+        Returns:
+            bool: True if the file was cached.
+        """
+        writer = opus_cache.writer(key)
+        if writer is None:
+            return key in opus_cache
+        process = None
+        try:
+            # Only errors reach stderr, which is left to the bot's so it never fills an unread pipe
+            process = (
+                ffmpeg
+                .input(input_file)
+                .output("pipe:", format="s16le", ac=2, ar=48000)
+                .global_args("-loglevel", "error")
+                .run_async(pipe_stdout=True)
+            )
+            while True:
+                frame = process.stdout.read(PCM_FRAME_SIZE)
+                if not frame:
+                    break
+                writer.write(frame.ljust(PCM_FRAME_SIZE, b"\0"))
+            if process.wait() != 0:
+                writer.abort()
+                return False
+            writer.commit()
+            return key in opus_cache
+        except Exception as e:
+            print(f"Error caching audio file: {e}")
+            writer.abort()
+            return False
+        finally:
+            if process is not None:
+                if process.poll() is None:
+                    process.kill()
+                process.stdout.close()
+                process.wait()
+
+    # Streams
+
+    def _stream_command(self, output_format, input_format=None, volume_factor=None, output_options=None):
+        stream = ffmpeg.input("pipe:", **({"format": input_format} if input_format else {}))
+        if volume_factor is not None:
+            stream = stream.filter("volume", volume_factor)
+        return stream.output("pipe:", format=output_format, **(output_options or {})).global_args("-loglevel", "error")
+
+    def iter_convert(self, source, output_format, input_format=None, volume_factor=None, output_options=None,
+                     chunk_size=STREAM_CHUNK_SIZE):
+        """Converts audio as it streams through ffmpeg's stdin and stdout.
+
+        Nothing touches the disk and at most a few chunks are held in memory,
+        so inputs of any length can be converted. Closing the generator early
+        stops ffmpeg.
+
+        Args:
+            source (file or iterable): A readable file object or an iterable of byte chunks.
+            output_format (str): The desired output format (e.g., "mp3", "s16le").
+            input_format (str, optional): The input format, for inputs ffmpeg can't detect (e.g., raw PCM).
+            volume_factor (float, optional): Scales the volume (e.g., 1.5 for 150% volume).
+            output_options (dict, optional): Extra ffmpeg output options (e.g., {"ar": 48000, "ac": 2}).
+            chunk_size (int, optional): Bytes read at a time.
+
+        Yields:
+            bytes: The converted audio.
+
+        Raises:
+            ffmpeg.Error: If ffmpeg fails.
+        """
+        command = self._stream_command(output_format, input_format, volume_factor, output_options)
+        process = command.run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+        errors = []
+        # stdin is fed from its own thread so that ffmpeg never waits on the reader to write
+        feeder = threading.Thread(target=self._feed, args=(source, process.stdin, chunk_size), daemon=True)
+        drainer = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+        feeder.start()
+        drainer.start()
+        finished = False
+        try:
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                process.kill()
+            process.stdout.close()
+            returncode = process.wait()
+            drainer.join()
+            if finished:
+                # An abandoned feeder may still be blocked on the source; it exits with the broken pipe
+                feeder.join()
+        if returncode != 0:
+            raise ffmpeg.Error("ffmpeg", None, b"".join(errors))
+
+    def _feed(self, source, stdin, chunk_size):
+        try:
+            for chunk in _read_chunks(source, chunk_size):
+                stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg exited or was stopped early
+            pass
+        except Exception as e:
+            print(f"Error reading audio stream: {e}")
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def convert_stream(self, source, output_format, output=None, input_format=None, volume_factor=None,
+                       output_options=None):
+        """Converts a stream of audio with ffmpeg, without temporary files.
+
+        Args:
+            source (file or iterable): A readable file object or an iterable of byte chunks.
+            output_format (str): The desired output format (e.g., "mp3", "wav").
+            output (file, optional): A writable file object to write the result to.
+            input_format (str, optional): The input format, for inputs ffmpeg can't detect.
+            volume_factor (float, optional): Scales the volume (e.g., 1.5 for 150% volume).
+            output_options (dict, optional): Extra ffmpeg output options.
+
+        Returns:
+            file: `output` once written, or None on failure. Without `output`, a
+            readable file object that converts as it is read.
+        """
+        chunks = self.iter_convert(source, output_format, input_format, volume_factor, output_options)
+        if output is None:
+            return io.BufferedReader(ChunkReader(chunks), STREAM_CHUNK_SIZE)
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+            return output
+        except ffmpeg.Error as e:
+            print(f"Error converting audio stream: {e.stderr.decode(errors='replace').strip() if e.stderr else e}")
+            return None
+
+    def adjust_volume_stream(self, source, volume_factor, output_format, output=None, input_format=None):
+        """Adjusts the volume of a stream of audio with ffmpeg. See `convert_stream`."""
+        return self.convert_stream(source, output_format, output, input_format, volume_factor)
+
+    async def aiter_convert(self, source, output_format, input_format=None, volume_factor=None, output_options=None,
+                            chunk_size=STREAM_CHUNK_SIZE):
+        """Converts audio as it streams through ffmpeg, without blocking the event loop.
+
+        Writes to ffmpeg wait for it to drain, so a fast source is slowed to
+        ffmpeg's pace rather than buffered. See `iter_convert`.
+
+        Args:
+            source (file or iterable): A readable file object, or a sync or async iterable of byte chunks.
+
+        Yields:
+            bytes: The converted audio.
+
+        Raises:
+            ffmpeg.Error: If ffmpeg fails.
+        """
+        command = self._stream_command(output_format, input_format, volume_factor, output_options)
+        process = await asyncio.create_subprocess_exec(
+            *command.compile(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        feeder = asyncio.ensure_future(self._feed_async(source, process.stdin, chunk_size))
+        errors = asyncio.ensure_future(process.stderr.read())
+        finished = False
+        try:
+            while True:
+                chunk = await process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                feeder.cancel()
+                if process.returncode is None:
+                    process.kill()
+            returncode = await process.wait()
+            await asyncio.gather(feeder, errors, return_exceptions=True)
+        if returncode != 0:
+            raise ffmpeg.Error("ffmpeg", None, errors.result())
+
+    async def _feed_async(self, source, stdin, chunk_size):
+        try:
+            if hasattr(source, "__aiter__"):
+                async for chunk in source:
+                    stdin.write(chunk)
+                    await stdin.drain()
+            else:
+                # Reading a plain file or iterator may block, so it happens in a worker thread
+                loop = asyncio.get_running_loop()
+                chunks = _read_chunks(source, chunk_size)
+                while True:
+                    chunk = await loop.run_in_executor(self.thread_pool, next, chunks, None)
+                    if chunk is None:
+                        break
+                    stdin.write(chunk)
+                    await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            print(f"Error reading audio stream: {e}")
+        finally:
+            stdin.close()
+
+    async def convert_stream_async(self, source, output_format, output=None, input_format=None, volume_factor=None,
+                                   output_options=None):
+        """Converts a stream of audio with ffmpeg without blocking the event loop. See `convert_stream`.
+
+        Args:
+            output (file, optional): A file object or stream writer to write the
+                result to; awaitable `write` results are awaited, and `drain` is
+                awaited after each chunk when present.
+
+        Returns:
+            `output` once written, or None on failure. Without `output`, an async
+            iterator over the converted audio.
+        """
+        chunks = self.aiter_convert(source, output_format, input_format, volume_factor, output_options)
+        if output is None:
+            return chunks
+        try:
+            async for chunk in chunks:
+                result = output.write(chunk)
+                if inspect.isawaitable(result):
+                    await result
+                if hasattr(output, "drain"):
+                    await output.drain()
+            return output
+        except ffmpeg.Error as e:
+            print(f"Error converting audio stream: {e.stderr.decode(errors='replace').strip() if e.stderr else e}")
+            return None
+
+    async def adjust_volume_stream_async(self, source, volume_factor, output_format, output=None, input_format=None):
+        """Adjusts the volume of a stream of audio without blocking the event loop. See `convert_stream`."""
+        return await self.convert_stream_async(source, output_format, output, input_format, volume_factor)
+
+    # Batches
+
+    def convert_formats(self, input_files, output_format, progress=None):
+        """Converts many audio files in parallel worker processes.
+
+        Args:
+            input_files (list): Paths to the input audio files.
+            output_format (str): The desired output format (e.g., "mp3", "wav").
+            progress (callable, optional): Called as `progress(completed, total, input_file, result)` after each file.
+
+        Returns:
+            list: The output path (or None on failure) for each input, in order.
+        """
+        return self.run_batch("convert_format", [(input_file, output_format) for input_file in input_files], progress)
+
+    def adjust_volumes(self, input_files, volume_factor, progress=None):
+        """Adjusts the volume of many audio files in parallel worker processes.
+
+        Args:
+            input_files (list): Paths to the input audio files.
+            volume_factor (float): The volume adjustment factor (e.g., 1.5 for 150% volume).
+            progress (callable, optional): Called as `progress(completed, total, input_file, result)` after each file.
+
+        Returns:
+            list: The output path (or None on failure) for each input, in order.
+        """
+        return self.run_batch("adjust_volume", [(input_file, volume_factor) for input_file in input_files], progress)
+
+    def get_audio_durations(self, input_files, progress=None):
+        """Probes the durations of many audio files in parallel.
+
+        Args:
+            input_files (list): Paths to the input audio files.
+            progress (callable, optional): Called as `progress(completed, total, input_file, result)` after each file.
+
+        Returns:
+            list: The duration in seconds (or None on failure) for each input, in order.
+        """
+        return self.run_batch("get_audio_duration", [(input_file,) for input_file in input_files], progress, processes=False)
+
+    def run_batch(self, method, calls, progress=None, processes=True):
+        """Runs one of this handler's methods over many argument tuples, `max_workers` at a time.
+
+        Only `max_workers` calls are handed to the pool at once, so the
+        backlog of a very large batch stays in the caller's list.
+
+        Args:
+            method (str): The name of the method to run.
+            calls (list): An argument tuple per call; the first argument is the input file.
+            progress (callable, optional): Called as `progress(completed, total, input_file, result)` after each call.
+            processes (bool, optional): Whether to use worker processes rather than threads.
+
+        Returns:
+            list: The result of each call, in order.
+        """
+        calls = list(calls)
+        results = [None] * len(calls)
+        running = {}
+        pending = iter(enumerate(calls))
+        completed = 0
+
+        def submit():
+            for index, args in pending:
+                if processes:
+                    future = self.process_pool.submit(_run_job, method, args)
+                else:
+                    future = self.thread_pool.submit(getattr(self, method), *args)
+                running[future] = index
+                if len(running) >= self.max_workers:
+                    return
+
+        submit()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    print(f"Error processing {calls[index][0]}: {e}")
+                completed += 1
+                if progress:
+                    progress(completed, len(calls), calls[index][0], results[index])
+            submit()
+        return results
+
+    # Async variants
+
+    async def _run_async(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.thread_pool, functools.partial(func, *args))
+
+    async def convert_format_async(self, input_file, output_format, output_file=None):
+        """Converts an audio file without blocking the event loop. See `convert_format`."""
+        return await self._run_async(self.convert_format, input_file, output_format, output_file)
+
+    async def adjust_volume_async(self, input_file, volume_factor, output_file=None):
+        """Adjusts the volume of an audio file without blocking the event loop. See `adjust_volume`."""
+        return await self._run_async(self.adjust_volume, input_file, volume_factor, output_file)
+
+    async def get_audio_duration_async(self, input_file):
+        """Probes the duration of an audio file without blocking the event loop. See `get_audio_duration`."""
+        return await self._run_async(self.get_audio_duration, input_file)
+
+    async def cache_opus_async(self, input_file, key, opus_cache=default_opus_cache):
+        """Encodes an audio file into the Opus cache without blocking the event loop. See `cache_opus`."""
+        return await self._run_async(self.cache_opus, input_file, key, opus_cache)
+
+    async def convert_formats_async(self, input_files, output_format, progress=None):
+        """Converts many audio files in parallel worker processes. See `convert_formats`."""
+        return await self.run_batch_async("convert_format", [(input_file, output_format) for input_file in input_files], progress)
+
+    async def adjust_volumes_async(self, input_files, volume_factor, progress=None):
+        """Adjusts the volume of many audio files in parallel worker processes. See `adjust_volumes`."""
+        return await self.run_batch_async("adjust_volume", [(input_file, volume_factor) for input_file in input_files], progress)
+
+    async def get_audio_durations_async(self, input_files, progress=None):
+        """Probes the durations of many audio files in parallel. See `get_audio_durations`."""
+        return await self.run_batch_async("get_audio_duration", [(input_file,) for input_file in input_files], progress, processes=False)
+
+    async def run_batch_async(self, method, calls, progress=None, processes=True):
+        """Runs `run_batch` without blocking the event loop; `progress` is called on the loop.
+
+        Returns:
+            list: The result of each call, in order.
+        """
+        calls = list(calls)
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_workers)
+        completed = 0
+
+        async def run(args):
+            nonlocal completed
+            async with semaphore:
+                if processes:
+                    future = loop.run_in_executor(self.process_pool, _run_job, method, args)
+                else:
+                    future = loop.run_in_executor(self.thread_pool, functools.partial(getattr(self, method), *args))
+                try:
+                    result = await future
+                except Exception as e:
+                    print(f"Error processing {args[0]}: {e}")
+                    result = None
+            completed += 1
+            if progress:
+                progress(completed, len(calls), args[0], result)
+            return result
+
+        return list(await asyncio.gather(*(run(args) for args in calls)))
+
+    def close(self):
+        """Shuts down the worker pools."""
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=True)
+            self._thread_pool = None
@@ -0,0 +1,237 @@
+import collections
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+from melody.api.scheduler import request_deadline
+from melody.utils import metrics
+
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = {"si", "feature", "fbclid", "gclid", "ref", "ref_src", "pp"}
+
+# Default time to live for cached entries, in seconds, per source
+DEFAULT_SOURCE_TTLS = {
+    "youtube": 6 * 60 * 60,
+    "spotify": 24 * 60 * 60,
+    "soundcloud": 60 * 60,
+}
+
+# How long a caller waits for another thread loading the same key, unless its
+# request_deadline (e.g. the resolver's timeout) comes sooner
+MAX_FLIGHT_WAIT = 30.0
+
+def normalize_key(url):
+    """
+    Normalizes a URL so equivalent links share one cache entry.
+
+    Lowercases the scheme and host, drops `www.`/`m.` prefixes, tracking
+    parameters and fragments, and sorts the remaining query parameters.
+
+    Args:
+        url (str): The URL or free-form query to normalize.
+
+    Returns:
+        str: The normalized key.
+    """
+    url = url.strip()
+    parsed = urlparse(url)
+    if not parsed.netloc:
+        return url.lower()
+    host = parsed.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parsed.query)
+        if key not in TRACKING_PARAMS and not key.startswith("utm_")
+    )
+    return urlunparse(("https", host, parsed.path.rstrip("/"), "", urlencode(query), ""))
+
+def estimate_size(value, depth=0):
+    """Roughly estimates the memory held by a cached value, in bytes."""
+    size = sys.getsizeof(value)
+    if depth > 3:
+        return size
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, depth + 1) + estimate_size(v, depth + 1) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(estimate_size(item, depth + 1) for item in value)
+    return size
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "size")
+
+    def __init__(self, value, expires_at, size):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class ResolutionCache:
+    """
+    A thread-safe TTL + LRU cache for resolved stream URLs and track metadata.
+
+    Entries are evicted least-recently-used first once the estimated memory of
+    all entries exceeds `max_bytes`, and are dropped when their TTL passes.
+    Concurrent `get_or_load` calls for the same key share a single lookup.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, source_ttls=None, name="resolution_cache", max_wait=MAX_FLIGHT_WAIT):
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.source_ttls = dict(DEFAULT_SOURCE_TTLS, **(source_ttls or {}))
+        self.name = name
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = metrics.counter(f"{name}_hits")
+        self.misses = metrics.counter(f"{name}_misses")
+        self.evictions = metrics.counter(f"{name}_evictions")
+        self.coalesced = metrics.counter(f"{name}_coalesced")
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns a fresh cached value, or `default` on a miss."""
+        value = self._lookup(key)
+        if value is None:
+            self.misses.increment()
+            return default
+        self.hits.increment()
+        return value
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry.value
+
+    def set(self, key, value, source=None, ttl=None, expires_at=None):
+        """
+        Stores a value.
+
+        Args:
+            key (str): The cache key.
+            value: The value to store.
+            source (str, optional): Selects the per-source default TTL.
+            ttl (float, optional): Overrides the TTL in seconds.
+            expires_at (float, optional): A hard Unix expiry, e.g. from a signed URL; the earlier of this and the TTL wins.
+        """
+        now = time.time()
+        if ttl is None:
+            ttl = self.source_ttls.get(source, 60 * 60)
+        deadline = now + ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        if deadline <= now:
+            return
+        size = estimate_size(key) + estimate_size(value)
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = _Entry(value, deadline, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions.increment()
+
+    def get_or_load(self, key, loader, source=None, ttl=None, expires_at=None):
+        """
+        Returns the cached value for `key`, calling `loader()` on a miss.
+
+        Only one thread runs the loader for a key at a time; others wait for its
+        result, but give up with None once their request_deadline (or
+        `max_wait`) passes so a hung loader can't hold every waiting thread.
+        None results are returned but not cached, so failures are retried.
+
+        Args:
+            key (str): The cache key.
+            loader (callable): Blocking function producing the value.
+            source (str, optional): Selects the per-source default TTL.
+            ttl (float, optional): Overrides the TTL in seconds.
+            expires_at (callable, optional): Called with the loaded value to get a hard Unix expiry.
+
+        Returns:
+            The cached or freshly loaded value.
+        """
+        value = self._lookup(key)
+        if value is not None:
+            self.hits.increment()
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.coalesced.increment()
+            deadline = request_deadline.get()
+            wait = self.max_wait if deadline is None else min(max(deadline - time.monotonic(), 0.0), self.max_wait)
+            if not flight.event.wait(wait):
+                print(f"Timed out waiting for another lookup of {key}")
+                return None
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        self.misses.increment()
+        try:
+            value = flight.value = loader()
+            if value is not None:
+                deadline = expires_at(value) if expires_at else None
+                self.set(key, value, source=source, ttl=ttl, expires_at=deadline)
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+    def invalidate(self, key):
+        """Drops a single entry."""
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.current_bytes -= entry.size
+
+    def stats(self):
+        """Returns entry count, memory use and hit/miss/coalesced/eviction counters."""
+        hits, misses = self.hits.value, self.misses.value
+        return {
+            "entries": len(self.entries),
+            "bytes": self.current_bytes,
+            "hits": hits,
+            "misses": misses,
+            "coalesced": self.coalesced.value,
+            "evictions": self.evictions.value,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+# Shared cache used by songs and the API wrappers
+resolution_cache = ResolutionCache()
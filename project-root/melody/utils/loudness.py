@@ -0,0 +1,268 @@
+import array
+import asyncio
+import collections
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from melody.utils import metrics
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+# Loudness is measured over 400ms blocks overlapping by 75%, built from 100ms sub-blocks
+SUB_BLOCK_SAMPLES = SAMPLE_RATE // 10
+SUB_BLOCKS_PER_BLOCK = 4
+
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+# ReplayGain 2.0 reference level, in LUFS
+TARGET_LOUDNESS = -18.0
+MAX_GAIN_DB = 12.0
+
+# PCM frames collected before a chunk is handed to the worker pool (1 second)
+FRAMES_PER_CHUNK = 50
+
+# ITU-R BS.1770 K-weighting at 48kHz: a high shelf followed by a high-pass
+K_WEIGHTING = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+
+def k_weighting_power(samples):
+    """
+    Returns the squared magnitude of the K-weighting filter at each rfft bin.
+
+    Args:
+        samples (int): The length of the transformed block.
+
+    Returns:
+        numpy.ndarray: One weight per bin.
+    """
+    z = np.exp(-1j * np.pi * np.arange(samples // 2 + 1) / (samples // 2))
+    power = np.ones(len(z))
+    for b, a in K_WEIGHTING:
+        numerator = b[0] + b[1] * z + b[2] * z ** 2
+        denominator = a[0] + a[1] * z + a[2] * z ** 2
+        power *= np.abs(numerator / denominator) ** 2
+    return power
+
+def block_loudness(power):
+    return -0.691 + 10 * math.log10(power) if power > 0 else -math.inf
+
+class LoudnessMeter:
+    """
+    Measures the integrated loudness (ITU-R BS.1770 / EBU R128) of a track incrementally.
+
+    K-weighting is applied in the frequency domain: each 100ms sub-block is
+    transformed once and its weighted power summed (Parseval), then four
+    consecutive sub-blocks make up each gated 400ms block. Only the block
+    powers are kept, so memory grows by 8 bytes per 100ms of audio.
+    """
+    def __init__(self):
+        self.buffer = np.zeros((SUB_BLOCK_SAMPLES, CHANNELS), dtype=np.float32)
+        self.filled = 0
+        # Parseval scaling for a one-sided spectrum of full-scale (±1.0) samples
+        weights = k_weighting_power(SUB_BLOCK_SAMPLES)
+        weights[1:-1] *= 2
+        self.weights = weights / (SUB_BLOCK_SAMPLES ** 2 * 32768.0 ** 2)
+        self.sub_blocks = collections.deque(maxlen=SUB_BLOCKS_PER_BLOCK)
+        self.block_powers = array.array("d")
+        self.peak = 0
+
+    def add(self, pcm):
+        """
+        Adds 16-bit stereo PCM at 48kHz.
+
+        Args:
+            pcm (bytes): Any number of whole samples.
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, CHANNELS)
+        if not len(samples):
+            return
+        self.peak = max(self.peak, int(np.abs(samples, dtype=np.int32).max()))
+        offset = 0
+        while offset < len(samples):
+            count = min(SUB_BLOCK_SAMPLES - self.filled, len(samples) - offset)
+            self.buffer[self.filled:self.filled + count] = samples[offset:offset + count]
+            self.filled += count
+            offset += count
+            if self.filled == SUB_BLOCK_SAMPLES:
+                self._measure_sub_block()
+                self.filled = 0
+
+    def _measure_sub_block(self):
+        spectrum = np.fft.rfft(self.buffer, axis=0)
+        # Mean square of each K-weighted channel, summed over channels (both weigh 1.0)
+        power = float(np.dot(self.weights, (spectrum.real ** 2 + spectrum.imag ** 2).sum(axis=1)))
+        self.sub_blocks.append(power)
+        if len(self.sub_blocks) == SUB_BLOCKS_PER_BLOCK:
+            self.block_powers.append(sum(self.sub_blocks) / SUB_BLOCKS_PER_BLOCK)
+
+    @property
+    def seconds(self):
+        return (len(self.block_powers) + SUB_BLOCKS_PER_BLOCK - 1) * SUB_BLOCK_SAMPLES / SAMPLE_RATE
+
+    def integrated_loudness(self):
+        """
+        Returns the gated integrated loudness in LUFS, or None if nothing rose above the absolute gate.
+        """
+        powers = np.frombuffer(self.block_powers, dtype=np.float64)
+        gated = powers[powers > 10 ** ((ABSOLUTE_GATE + 0.691) / 10)]
+        if not len(gated):
+            return None
+        relative_gate = block_loudness(gated.mean()) + RELATIVE_GATE
+        gated = gated[gated > 10 ** ((relative_gate + 0.691) / 10)]
+        return block_loudness(gated.mean())
+
+    def result(self):
+        """
+        Returns the measurement and the gain that brings the track to TARGET_LOUDNESS.
+
+        Returns:
+            dict: `loudness` (LUFS), `peak` (0-1) and `gain_db`, or None if the track was silent.
+        """
+        loudness = self.integrated_loudness()
+        if loudness is None:
+            return None
+        peak = self.peak / 32768.0
+        gain_db = min(TARGET_LOUDNESS - loudness, MAX_GAIN_DB)
+        # Never amplify past full scale
+        if peak > 0:
+            gain_db = min(gain_db, -20 * math.log10(peak))
+        return {"loudness": loudness, "peak": peak, "gain_db": gain_db}
+
+class LoudnessAnalyzer:
+    """
+    Measures a track while it plays, off the audio thread and the event loop.
+
+    The audio thread hands over every PCM frame (before volume is applied);
+    frames are batched into one-second chunks and measured in order on the
+    worker pool. The result is reported once the track has played to the end.
+    """
+    def __init__(self, executor, on_result):
+        self.executor = executor
+        self.on_result = on_result
+        self.meter = LoudnessMeter()
+        self.frames = []
+        self.chunks = collections.deque()
+        self.draining = False
+        self.finished = False
+        self.done = False
+        self._lock = threading.Lock()
+
+    def write(self, frame):
+        """Adds one PCM frame. Called from the audio thread."""
+        if self.done:
+            return
+        self.frames.append(frame)
+        if len(self.frames) >= FRAMES_PER_CHUNK:
+            self._submit(b"".join(self.frames))
+            self.frames = []
+
+    def commit(self):
+        """Reports the result once every chunk has been measured. Called when the track ends."""
+        if self.done:
+            return
+        self.done = True
+        self._submit(b"".join(self.frames), finished=True)
+        self.frames = []
+
+    def abort(self):
+        """Drops a track that was stopped before its end."""
+        self.done = True
+        self.frames = []
+        with self._lock:
+            self.chunks.clear()
+
+    def _submit(self, chunk, finished=False):
+        with self._lock:
+            self.chunks.append(chunk)
+            self.finished = self.finished or finished
+            if self.draining:
+                return
+            self.draining = True
+        self.executor.submit(self._drain)
+
+    def _drain(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self.chunks:
+                        self.draining = False
+                        finished = self.finished
+                        break
+                    chunk = self.chunks.popleft()
+                started = time.perf_counter()
+                self.meter.add(chunk)
+                analysis_time.record((time.perf_counter() - started) * 1000)
+            result = self.meter.result() if finished else None
+        except Exception as e:
+            print(f"Error measuring loudness: {e}")
+            self.abort()
+            return
+        if result:
+            self.on_result(result)
+
+# Milliseconds of worker time spent per second of audio analysed
+analysis_time = metrics.histogram("loudness_analysis_ms")
+
+class TrackGains:
+    """
+    Per-track gains from LoudnessAnalyzer, kept in memory and, once a database
+    is configured, persisted so later plays (and restarts) need no analysis.
+    """
+    def __init__(self, max_entries=10000, max_workers=2):
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self.gains = collections.OrderedDict()
+        self.database = None
+        self._executor = None
+
+    def configure(self, database):
+        """Persists gains to `database` (any object with get_track_gain/save_track_gain), or nowhere if None."""
+        self.database = database
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="melody-loudness")
+        return self._executor
+
+    async def get(self, key):
+        """
+        Returns the linear gain for a track, or None if it hasn't been measured yet.
+        """
+        if key in self.gains:
+            self.gains.move_to_end(key)
+            return self.gains[key]
+        if self.database is None:
+            return None
+        result = await self.database.get_track_gain(key)
+        if not result:
+            return None
+        return self._remember(key, result)
+
+    def analyzer(self, key):
+        """Returns a LoudnessAnalyzer that stores the track's gain once it has played through."""
+        loop = asyncio.get_running_loop()
+        return LoudnessAnalyzer(self.executor, lambda result: loop.call_soon_threadsafe(self._store, key, result))
+
+    def _store(self, key, result):
+        self._remember(key, result)
+        if self.database is not None:
+            asyncio.ensure_future(self.database.save_track_gain(key, result))
+
+    def _remember(self, key, result):
+        gain = 10 ** (result["gain_db"] / 20)
+        self.gains[key] = gain
+        self.gains.move_to_end(key)
+        while len(self.gains) > self.max_entries:
+            self.gains.popitem(last=False)
+        return gain
+
+# Shared gains; the bot points them at the database once it is connected
+track_gains = TrackGains()
@@ -1,14 +1,81 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from bs4 import BeautifulSoup, SoupStrainer
 from genius_lyrics_api import Genius
 
+from melody.api.clients import clients
+from melody.utils.cache import ResolutionCache
+from melody.utils.synced_lyrics import SyncedLyrics, search_lrclib
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# Only the lyrics containers are built into a tree; the rest of the page is skipped
+LYRICS_CONTAINERS = SoupStrainer("div", attrs={"data-lyrics-container": "true"})
+# Older Genius pages kept the lyrics in a single div
+LEGACY_LYRICS_CONTAINER = SoupStrainer("div", class_="lyrics")
+
+# How long found lyrics, songs without lyrics and failed lookups are remembered, in seconds
+FOUND_TTL = 7 * 24 * 60 * 60
+NOT_FOUND_TTL = 24 * 60 * 60
+ERROR_TTL = 5 * 60
+
+# Decorations in video titles that aren't part of the song's name
+TITLE_NOISE = re.compile(
+    r"[\(\[][^\)\]]*(?:official|lyric|audio|video|visuali[sz]er|remaster|hd|hq|4k)[^\)\]]*[\)\]]"
+    r"|\b(?:feat|ft)\.?\s.*$",
+    re.IGNORECASE,
+)
+
+def clean_title(song_title, artist_name=None):
+    """
+    Strips video decorations from a title, splitting "Artist - Title" when no artist is given.
+
+    Returns:
+        tuple: The title and the artist (or None).
+    """
+    if artist_name is None and " - " in song_title:
+        artist_name, song_title = song_title.split(" - ", 1)
+    song_title = TITLE_NOISE.sub("", song_title).strip() or song_title
+    return song_title, artist_name.strip() if artist_name else None
+
+def lyrics_key(song_title, artist_name=None):
+    """
+    Normalizes a title and artist so every spelling of a song shares one cache entry.
+
+    Returns:
+        str: The cache key.
+    """
+    song_title, artist_name = clean_title(song_title, artist_name)
+    parts = [" ".join(re.sub(r"[^\w\s]", " ", part.lower()).split()) for part in (artist_name or "", song_title)]
+    return f"lyrics:{parts[0]}|{parts[1]}"
+
 class LyricsHandler:
     """
     Handles retrieving song lyrics using Genius API.
+
+    The `fetch_lyrics` coroutine runs lookups on a worker pool and caches the
+    result, including songs that have no lyrics, in memory and (once a
+    database is configured) in MongoDB. Without an API key only synced
+    lyrics, which come from lrclib.net, are available.
     """
-    def __init__(self, api_key):
-        self.genius = Genius(api_key)
+    def __init__(self, api_key, max_workers=4, cache_bytes=16 * 1024 * 1024):
+        self.genius = Genius(api_key) if api_key else None
         self.base_url = "https://genius.com"
+        self.cache = ResolutionCache(max_bytes=cache_bytes, name="lyrics_cache")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="melody-lyrics")
+        self.database = None
+        self.pending = {}
+
+    def configure(self, database):
+        """Persists lyrics to `database` (any object with get_lyrics/save_lyrics), or nowhere if None."""
+        self.database = database
 
     def get_lyrics(self, song_title, artist_name=None):
         """
@@ -22,16 +89,16 @@ class LyricsHandler:
             str: The lyrics of the song, if found. Otherwise, returns None.
         """
         try:
-            song = self.genius.search_song(song_title, artist_name)
-            if song:
-                lyrics = song.lyrics
-                return lyrics
-            else:
-                return None
+            return self.search_genius(song_title, artist_name)
         except Exception as e:
             print(f"Error retrieving lyrics from Genius: {e}")
             return None
 
+    def search_genius(self, song_title, artist_name=None):
+        # Like get_lyrics, but lets errors through so they aren't mistaken for songs without lyrics
+        song = self.genius.search_song(song_title, artist_name)
+        return song.lyrics if song else None
+
     def search_lyrics(self, query):
         """
         Searches for lyrics based on a query string.
@@ -63,14 +130,124 @@ class LyricsHandler:
             str: The lyrics of the song, if found. Otherwise, returns None.
         """
         try:
-            response = requests.get(url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            lyrics_div = soup.find('div', class_='lyrics')
-            if lyrics_div:
-                lyrics = lyrics_div.get_text().strip()
-                return lyrics
-            else:
-                return None
+            response = clients.session("genius").get(url, timeout=clients.timeout)
+            return self.extract_lyrics(response.text)
         except Exception as e:
             print(f"Error retrieving lyrics from Genius URL: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def extract_lyrics(self, html):
+        """
+        Extracts the lyrics from a Genius song page.
+
+        Args:
+            html (str): The page's HTML.
+
+        Returns:
+            str: The lyrics, or None if the page has none.
+        """
+        containers = BeautifulSoup(html, HTML_PARSER, parse_only=LYRICS_CONTAINERS).find_all("div")
+        if not containers:
+            containers = BeautifulSoup(html, HTML_PARSER, parse_only=LEGACY_LYRICS_CONTAINER).find_all("div")
+        # Nested containers would be counted twice
+        containers = [div for div in containers if not div.find_parent("div")]
+        for div in containers:
+            for line_break in div.find_all("br"):
+                line_break.replace_with("\n")
+        lyrics = "\n".join(div.get_text().strip() for div in containers).strip()
+        return lyrics or None
+
+    async def fetch_lyrics(self, song_title, artist_name=None):
+        """
+        Fetches lyrics without blocking the event loop, from the cache when possible.
+
+        Concurrent requests for the same song share one lookup.
+
+        Args:
+            song_title (str): The title of the song, or "Artist - Title".
+            artist_name (str, optional): The name of the artist. Defaults to None.
+
+        Returns:
+            str: The lyrics of the song, if found. Otherwise, returns None.
+        """
+        if self.genius is None:
+            return None
+        song_title, artist_name = clean_title(song_title, artist_name)
+        return await self._fetch(lyrics_key(song_title, artist_name), self.search_genius, (song_title, artist_name))
+
+    async def fetch_synced_lyrics(self, song_title, artist_name=None, duration=None):
+        """
+        Fetches timestamped lyrics from lrclib.net, parsed and cached like `fetch_lyrics`.
+
+        Args:
+            song_title (str): The title of the song, or "Artist - Title".
+            artist_name (str, optional): The name of the artist. Defaults to None.
+            duration (float, optional): The song's length in seconds, to pick the right recording.
+
+        Returns:
+            SyncedLyrics: The lyrics, if found. Otherwise, returns None.
+        """
+        song_title, artist_name = clean_title(song_title, artist_name)
+        key = "synced" + lyrics_key(song_title, artist_name)[len("lyrics"):]
+        return await self._fetch(key, search_lrclib, (song_title, artist_name, duration), SyncedLyrics.parse)
+
+    async def _fetch(self, key, search, args, parse=None):
+        cached = self.cache.get(key)
+        if cached is not None:
+            # Songs without lyrics are cached as an empty string
+            return cached or None
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = asyncio.ensure_future(self._load(key, search, args, parse))
+            pending.add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _load(self, key, search, args, parse):
+        if self.database is not None:
+            stored = await self.database.get_lyrics(key)
+            if stored:
+                return self._remember(key, stored.get("lyrics"), parse)
+        loop = asyncio.get_running_loop()
+        try:
+            lyrics = await loop.run_in_executor(self.executor, search, *args)
+        except Exception as e:
+            print(f"Error retrieving lyrics: {e}")
+            # Retried after a short pause, and never persisted
+            self.cache.set(key, "", ttl=ERROR_TTL)
+            return None
+        if self.database is not None:
+            expires_at = None
+            if not lyrics:
+                # Lyrics may be added later
+                expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=NOT_FOUND_TTL)
+            await self.database.save_lyrics(key, lyrics, expires_at)
+        return self._remember(key, lyrics, parse)
+
+    def _remember(self, key, lyrics, parse):
+        # Parsed once here; every later request gets the parsed value from the cache
+        value = parse(lyrics) if parse and lyrics else lyrics
+        self.cache.set(key, value or "", ttl=FOUND_TTL if value else NOT_FOUND_TTL)
+        return value or None
+
+    def prefetch(self, songs):
+        """
+        Starts fetching lyrics for songs in the background, e.g. the current and next queued songs.
+
+        Args:
+            songs (list): Songs with a `title` and `url`.
+        """
+        if self.genius is None:
+            return
+        for song in songs:
+            if song.title == song.url:
+                # Not looked up yet, so there's no name to search Genius for
+                continue
+            asyncio.ensure_future(self.fetch_lyrics(song.title)).add_done_callback(self._prefetched)
+
+    def _prefetched(self, task):
+        if not task.cancelled() and task.exception():
+            print(f"Error prefetching lyrics: {task.exception()}")
+
+    def shutdown(self):
+        """Stops the worker threads, dropping any lookups that have not started."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,104 @@
+import bisect
+import threading
+
+# Default histogram bucket upper bounds, in milliseconds
+DEFAULT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Counter:
+    """A thread-safe monotonically increasing counter."""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, amount=1):
+        """Adds `amount` to the counter."""
+        with self._lock:
+            self.value += amount
+
+    def summary(self):
+        """Returns the counter as a dictionary."""
+        return {"name": self.name, "value": self.value}
+
+class Histogram:
+    """A thread-safe fixed-bucket histogram.
+
+    Values are counted into the first bucket whose upper bound is greater than
+    or equal to the value; values above the last bound land in an overflow bucket.
+    """
+
+    def __init__(self, name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        """Records a single observation."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, percent):
+        """Estimates a percentile as the upper bound of the bucket containing it.
+
+        Args:
+            percent (float): The percentile to estimate, between 0 and 100.
+
+        Returns:
+            float: The bucket bound, the observed maximum for the overflow bucket, or None if empty.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = percent / 100 * self.count
+            seen = 0
+            for index, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if seen >= rank and bucket_count:
+                    return self.buckets[index] if index < len(self.buckets) else self.max
+            return self.max
+
+    def summary(self):
+        """Returns count, mean, p50, p95 and max as a dictionary."""
+        return {
+            "name": self.name,
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max,
+        }
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def counter(name):
+    """Returns the process-wide counter called `name`, creating it if needed."""
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Counter(name)
+        return metric
+
+def histogram(name, buckets=DEFAULT_BUCKETS):
+    """Returns the process-wide histogram called `name`, creating it if needed."""
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Histogram(name, buckets)
+        return metric
+
+def snapshot():
+    """Returns a summary of every registered metric, keyed by name."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {metric.name: metric.summary() for metric in metrics}
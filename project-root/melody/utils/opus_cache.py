@@ -0,0 +1,345 @@
+import collections
+import hashlib
+import json
+import mmap
+import os
+import threading
+
+import discord
+
+from melody.utils import metrics
+
+# Each packet is stored as a little-endian length followed by the Opus packet itself
+LENGTH_BYTES = 2
+FILE_SUFFIX = ".frames"
+# The track's title and duration are kept in a small file next to its packets
+METADATA_SUFFIX = ".json"
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# About an hour at discord.py's default 128kbps; longer tracks and live streams aren't cached
+DEFAULT_MAX_TRACK_BYTES = 64 * 1024 * 1024
+
+class CachedOpusSource(discord.AudioSource):
+    """
+    Plays Opus packets straight from a memory-mapped cache file.
+
+    Packets are sliced out of the map and handed to the voice client as they
+    are, so a cached track needs no download, no FFmpeg and no encoding.
+    `metadata` holds the "title" and "duration" stored with the track, if any.
+    """
+    def __init__(self, path, metadata=None):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offset = 0
+        self.metadata = metadata or {}
+
+    def read(self):
+        if self.map is None or self.offset + LENGTH_BYTES > len(self.map):
+            return b""
+        start = self.offset + LENGTH_BYTES
+        length = int.from_bytes(self.map[self.offset:start], "little")
+        self.offset = start + length
+        return self.map[start:self.offset]
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+class DecodedOpusSource(discord.AudioSource):
+    """
+    Decodes cached Opus packets back to PCM, for playback at a volume other than 100%.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.decoder = discord.opus.Decoder()
+
+    def read(self):
+        packet = self.source.read()
+        return self.decoder.decode(packet) if packet else b""
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.source.cleanup()
+
+def part_pid(name):
+    """Returns the ID of the process writing a temporary file, or None if the name doesn't include one."""
+    # "<digest>.frames.<pid>.<thread>.part"
+    parts = name.split(".")
+    try:
+        return int(parts[-3])
+    except (IndexError, ValueError):
+        return None
+
+def process_alive(pid):
+    """Returns True unless `pid` is known not to be running."""
+    if pid is None:
+        return False
+    if pid == os.getpid() or os.name == "nt":
+        # On Windows os.kill would terminate the process instead of probing it
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. running as another user
+        return True
+    return True
+
+class OpusCacheWriter:
+    """
+    Encodes the PCM frames of a track as they are played and adds the result
+    to the cache once the track has played to the end.
+
+    Frames must be at unity gain so that the cached audio can be replayed at
+    any volume. Tracks that are skipped or stopped are discarded.
+    """
+    def __init__(self, cache, digest, metadata=None):
+        self.cache = cache
+        self.digest = digest
+        self.metadata = metadata
+        self.path = cache.path_for(digest)
+        self.temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.part"
+        self.file = None
+        self.encoder = None
+        self.size = 0
+        self.done = False
+
+    def write(self, frame):
+        """Encodes and appends one 20ms PCM frame. Called from the audio thread."""
+        if self.done:
+            return
+        try:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.temp_path, "wb")
+                self.encoder = discord.opus.Encoder()
+            packet = self.encoder.encode(frame, self.encoder.SAMPLES_PER_FRAME)
+            self.file.write(len(packet).to_bytes(LENGTH_BYTES, "little"))
+            self.file.write(packet)
+            self.size += LENGTH_BYTES + len(packet)
+        except Exception as e:
+            print(f"Error caching audio: {e}")
+            self.abort()
+            return
+        if self.size > self.cache.max_track_bytes:
+            self.abort()
+
+    def commit(self):
+        """Stores the encoded track. Called once the source is exhausted."""
+        if self.done:
+            return
+        self.done = True
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+            if self.metadata:
+                # Written first, so a track's packets never appear without it
+                metadata_path = self.cache.metadata_path_for(self.digest)
+                with open(f"{metadata_path}.{os.getpid()}.{threading.get_ident()}.part", "w", encoding="utf-8") as file:
+                    json.dump(self.metadata, file)
+                os.replace(file.name, metadata_path)
+            # Readers only ever see complete files
+            os.replace(self.temp_path, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Error caching audio: {e}")
+            self._remove_temp()
+            return
+        self.cache.add(self.digest, self.size)
+
+    def abort(self):
+        """Discards a partially encoded track."""
+        if self.done:
+            return
+        self.done = True
+        if self.file is not None:
+            self.file.close()
+            self._remove_temp()
+
+    def _remove_temp(self):
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+class OpusCache:
+    """
+    A content-addressed disk cache of encoded Opus packets, one file per track.
+
+    Files are named after the SHA-1 of the track key and evicted least recently
+    played first once the cache grows beyond `max_bytes`. Without a directory
+    the cache is disabled: nothing is stored and every lookup misses.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, max_track_bytes=DEFAULT_MAX_TRACK_BYTES):
+        """
+        Args:
+            directory (str, optional): Where cached tracks are stored.
+            max_bytes (int, optional): Total size of the cache on disk.
+            max_track_bytes (int, optional): Tracks that encode larger than this are not cached.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_track_bytes = max_track_bytes
+        self.entries = None
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = metrics.counter("opus_cache_hits")
+        self.misses = metrics.counter("opus_cache_misses")
+        self.evictions = metrics.counter("opus_cache_evictions")
+
+    def configure(self, directory, max_bytes=None):
+        """Points the cache at a directory (None disables it) before any track is played."""
+        with self._lock:
+            self.directory = directory
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self.entries = None
+            self.total_bytes = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def digest(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def path_for(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + FILE_SUFFIX)
+
+    def metadata_path_for(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + METADATA_SUFFIX)
+
+    def __contains__(self, key):
+        # Safe on the event loop: never indexes the directory or waits for the
+        # lock, and reports every track missing until `load` has run
+        entries = self.entries
+        return self.enabled and entries is not None and self.digest(key) in entries
+
+    def load(self):
+        """Indexes the cache directory ahead of the first track. Walks the disk, so call it from a worker thread."""
+        if self.enabled:
+            with self._lock:
+                self._get_entries()
+
+    def open(self, key):
+        """
+        Opens a cached track for playback. Touches the disk, so call it from a worker thread.
+
+        Args:
+            key (str): The track key, e.g. the normalized track URL.
+
+        Returns:
+            CachedOpusSource: The cached audio, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        digest = self.digest(key)
+        with self._lock:
+            entries = self._get_entries()
+            if digest not in entries:
+                self.misses.increment()
+                return None
+            entries.move_to_end(digest)
+        path = self.path_for(digest)
+        try:
+            source = CachedOpusSource(path, self._read_metadata(digest))
+        except (OSError, ValueError) as e:
+            print(f"Error opening cached audio: {e}")
+            self._forget(digest)
+            self.misses.increment()
+            return None
+        try:
+            # Keeps the recency order across restarts
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits.increment()
+        return source
+
+    def writer(self, key, metadata=None):
+        """
+        Returns an OpusCacheWriter that stores a track while it plays, or None
+        if the cache is disabled or already holds the track.
+
+        Args:
+            key (str): The track key.
+            metadata (dict, optional): The track's "title" and "duration", handed back by `open`.
+        """
+        if not self.enabled or key in self:
+            return None
+        return OpusCacheWriter(self, self.digest(key), metadata)
+
+    def add(self, digest, size):
+        """Records a newly written file and evicts the least recently played tracks to make room."""
+        evicted = []
+        with self._lock:
+            entries = self._get_entries()
+            self.total_bytes += size - entries.pop(digest, 0)
+            entries[digest] = size
+            while self.total_bytes > self.max_bytes and len(entries) > 1:
+                old_digest, old_size = entries.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_digest)
+        for old_digest in evicted:
+            self.evictions.increment()
+            # Tracks still playing keep their mapping; the data goes when it closes
+            for path in (self.path_for(old_digest), self.metadata_path_for(old_digest)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _read_metadata(self, digest):
+        # Tracks cached before metadata was stored have none
+        try:
+            with open(self.metadata_path_for(digest), encoding="utf-8") as file:
+                metadata = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return metadata if isinstance(metadata, dict) else {}
+
+    def _forget(self, digest):
+        with self._lock:
+            self.total_bytes -= self._get_entries().pop(digest, 0)
+
+    def _get_entries(self):
+        # Indexes the cache directory on first use, oldest files first
+        if self.entries is None:
+            files = []
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        if name.endswith(".part"):
+                            # Left behind by a process that stopped mid-track; a live one is still writing it
+                            if not process_alive(part_pid(name)):
+                                os.remove(path)
+                        elif name.endswith(FILE_SUFFIX):
+                            stat = os.stat(path)
+                            files.append((stat.st_mtime, name[:-len(FILE_SUFFIX)], stat.st_size))
+                    except OSError:
+                        pass
+            self.entries = collections.OrderedDict((digest, size) for _, digest, size in sorted(files))
+            self.total_bytes = sum(self.entries.values())
+        return self.entries
+
+    def stats(self):
+        """Returns the cache size and hit, miss and eviction counts."""
+        entries = self.entries or {}
+        return {
+            "tracks": len(entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits.value,
+            "misses": self.misses.value,
+            "evictions": self.evictions.value,
+        }
+
+# Shared disk cache; disabled until the bot configures a directory
+default_opus_cache = OpusCache()
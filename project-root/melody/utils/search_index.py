@@ -0,0 +1,150 @@
+import array
+import collections
+import functools
+import math
+import re
+import unicodedata
+
+import numpy as np
+
+from melody.utils.source_router import canonical_key
+
+# Share of the query's trigrams a title must contain to count as a match
+MIN_SCORE = 0.85
+# Queries shorter than this many trigrams (about two characters) are too vague to match locally
+MIN_TRIGRAMS = 4
+
+NON_WORD = re.compile(r"[\W_]+")
+
+def normalize_text(text):
+    """
+    Folds case, accents and punctuation so "Beyoncé - Halo!" and "beyonce halo" compare equal.
+
+    Returns:
+        str: Lowercase words separated by single spaces.
+    """
+    text = text.casefold()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(char for char in text if not unicodedata.combining(char))
+    return NON_WORD.sub(" ", text).strip()
+
+@functools.lru_cache(maxsize=100000)
+def word_trigrams(word):
+    # Titles share most of their words, so each word is split only once
+    padded = f"  {word} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def trigrams(text):
+    """
+    Returns the set of three-character substrings of normalized text.
+
+    Each word is padded so word starts and short words still produce trigrams.
+    """
+    grams = set()
+    for word in text.split():
+        grams |= word_trigrams(word)
+    return grams
+
+class SearchIndex:
+    """
+    An in-memory trigram index over track titles, for matching free-text searches.
+
+    Every track gets a sequential ID; each trigram maps to the sorted IDs of
+    the tracks whose title contains it, in a compact `array('I')`. A query
+    only has to gather candidates from the rarest of its trigrams' lists (any
+    track sharing enough trigrams must appear in one of them), then checks
+    them against the remaining lists with vectorized binary searches,
+    dropping candidates as soon as they can no longer reach the threshold.
+
+    Queries that were answered before are also kept verbatim as aliases, so
+    a repeated search is a single dictionary lookup.
+    """
+    def __init__(self):
+        # (url, source, title) per track ID
+        self.tracks = []
+        self.trigram_counts = array.array("H")
+        self.ids = {}
+        self.postings = collections.defaultdict(lambda: array.array("I"))
+        self.aliases = {}
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __contains__(self, url):
+        return canonical_key(url) in self.ids
+
+    def add(self, url, source, title, key=None):
+        """
+        Indexes a track by its title (which usually names the artist too).
+
+        A track that is already indexed keeps its first title.
+
+        Args:
+            url (str): The track's URL.
+            source (str): "youtube", "spotify" or "soundcloud".
+            title (str): The track's title.
+            key (str, optional): The URL's canonical_key, if already known.
+
+        Returns:
+            bool: True if the track was new.
+        """
+        key = key or canonical_key(url)
+        if key in self.ids:
+            return False
+        grams = trigrams(normalize_text(title))
+        track_id = len(self.tracks)
+        self.ids[key] = track_id
+        self.tracks.append((url, source, title))
+        self.trigram_counts.append(min(len(grams), 0xFFFF))
+        for gram in grams:
+            # IDs only grow, so every list stays sorted
+            self.postings[gram].append(track_id)
+        return True
+
+    def add_alias(self, query, url, source, title=None):
+        """Remembers which track a search query resolved to."""
+        text = normalize_text(query)
+        if text:
+            track_id = self.ids.get(canonical_key(url))
+            self.aliases[text] = self.tracks[track_id] if track_id is not None else (url, source, title or url)
+
+    def search(self, query, min_score=MIN_SCORE):
+        """
+        Finds the indexed track that best matches a search query.
+
+        Args:
+            query (str): Free-text search terms.
+            min_score (float, optional): The share of the query's trigrams the title must contain.
+
+        Returns:
+            tuple: The (url, source, title) of the best match, or None.
+        """
+        text = normalize_text(query)
+        alias = self.aliases.get(text)
+        if alias is not None:
+            return alias
+        grams = trigrams(text)
+        if len(grams) < MIN_TRIGRAMS or not self.tracks:
+            return None
+        needed = math.ceil(len(grams) * min_score)
+        lists = sorted((self.postings[gram] for gram in grams if gram in self.postings), key=len)
+        if len(lists) < needed:
+            return None
+        lists = [np.frombuffer(postings, dtype=np.uint32) for postings in lists]
+        # A title with `needed` of the trigrams appears in at least one of the rarest len - needed + 1
+        prefix = len(lists) - needed + 1
+        candidates, counts = np.unique(np.concatenate(lists[:prefix]), return_counts=True)
+        remaining = len(lists) - prefix
+        for postings in lists[prefix:]:
+            positions = np.minimum(np.searchsorted(postings, candidates), len(postings) - 1)
+            counts += postings[positions] == candidates
+            remaining -= 1
+            reachable = counts + remaining >= needed
+            candidates, counts = candidates[reachable], counts[reachable]
+            if not len(candidates):
+                return None
+        # Ties go to the title with the fewest extra words, then to the first indexed
+        trigram_counts = np.frombuffer(self.trigram_counts, dtype=np.uint16)[candidates]
+        best = candidates[np.argmax(counts.astype(np.int64) * 0x10000 - trigram_counts)]
+        return self.tracks[int(best)]
@@ -0,0 +1,166 @@
+import collections
+import functools
+import re
+from urllib.parse import parse_qsl, urlsplit
+
+from melody.api.clients import clients
+from melody.utils.cache import normalize_key
+
+# Text that could be a link at all; anything else (e.g. search terms with spaces) is rejected up front
+LINK_SHAPE = re.compile(r"(?:https?://)?[^\s/?#]+\.[a-z]{2,}(?::\d+)?(?:[/?#]\S*)?", re.IGNORECASE)
+
+SPOTIFY_KINDS = "track|album|playlist|artist|episode|show"
+SPOTIFY_URI = re.compile(rf"spotify:(?:user:[^:\s]+:)?(?P<kind>{SPOTIFY_KINDS}):(?P<id>[A-Za-z0-9]{{22}})")
+
+YOUTUBE_VIDEO_ID = re.compile(r"[\w-]{11}", re.ASCII)
+YOUTUBE_LIST_ID = re.compile(r"[\w-]{2,}", re.ASCII)
+
+# SoundCloud pages under a user that aren't tracks, and top-level pages that aren't users
+SOUNDCLOUD_USER_PAGES = "sets|albums|tracks|likes|reposts|popular-tracks|followers|following|comments|spotlight"
+SOUNDCLOUD_SITE_PAGES = "discover|search|stream|charts|you|upload|settings|messages|notifications|pages|pro|jobs|imprint|mobile|tags|people"
+SOUNDCLOUD_NAME = r"[\w-]+"
+
+YOUTUBE_ROUTES = (
+    # (kind, pattern for the path, query parameter holding the ID and its pattern)
+    ("track", re.compile(r"/watch/?"), "v", YOUTUBE_VIDEO_ID),
+    ("playlist", re.compile(r"/playlist/?"), "list", YOUTUBE_LIST_ID),
+    ("track", re.compile(r"/(?:shorts|embed|live|v|e)/(?P<id>[\w-]{11})/?", re.ASCII), None, None),
+)
+YOUTU_BE_ROUTES = (
+    ("track", re.compile(r"/(?P<id>[\w-]{11})/?", re.ASCII), None, None),
+)
+SPOTIFY_ROUTES = (
+    # A "kind" group takes the kind from the link itself
+    (None, re.compile(rf"(?:/intl-[a-z-]+)?(?:/embed)?(?:/user/[^/]+)?/(?P<kind>{SPOTIFY_KINDS})/(?P<id>[A-Za-z0-9]{{22}})/?"), None, None),
+)
+SOUNDCLOUD_ROUTES = (
+    # Private links end in a secret token, which is part of the track's identity
+    ("playlist", re.compile(
+        rf"/(?P<id>(?!(?:{SOUNDCLOUD_SITE_PAGES})/){SOUNDCLOUD_NAME}/sets/{SOUNDCLOUD_NAME})(?:/(?P<secret>s-\w+))?/?"
+    ), None, None),
+    ("track", re.compile(
+        rf"/(?P<id>(?!(?:{SOUNDCLOUD_SITE_PAGES})/){SOUNDCLOUD_NAME}/(?!(?:{SOUNDCLOUD_USER_PAGES})/?$){SOUNDCLOUD_NAME})"
+        rf"(?:/(?P<secret>s-\w+))?/?"
+    ), None, None),
+)
+# Short links only say where they lead once followed
+SHORT_LINK_ROUTES = (
+    ("link", re.compile(r"/[\w-]+/?"), None, None),
+)
+
+# Hostname to (source, routes), tried in order
+HOSTS = {
+    **dict.fromkeys(
+        ("youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com",
+         "youtube-nocookie.com", "www.youtube-nocookie.com"),
+        ("youtube", YOUTUBE_ROUTES),
+    ),
+    "youtu.be": ("youtube", YOUTU_BE_ROUTES),
+    **dict.fromkeys(("open.spotify.com", "play.spotify.com"), ("spotify", SPOTIFY_ROUTES)),
+    **dict.fromkeys(("spotify.link", "spotify.app.link"), ("spotify", SHORT_LINK_ROUTES)),
+    **dict.fromkeys(("soundcloud.com", "www.soundcloud.com", "m.soundcloud.com"), ("soundcloud", SOUNDCLOUD_ROUTES)),
+    "on.soundcloud.com": ("soundcloud", SHORT_LINK_ROUTES),
+}
+
+# Canonical links to each kind of item; Spotify's follow one pattern for every kind
+CANONICAL_URLS = {
+    ("youtube", "track"): "https://www.youtube.com/watch?v={id}",
+    ("youtube", "playlist"): "https://www.youtube.com/playlist?list={id}",
+    ("soundcloud", "track"): "https://soundcloud.com/{id}",
+    ("soundcloud", "playlist"): "https://soundcloud.com/{id}",
+}
+
+class SourceKey(collections.namedtuple("SourceKey", ("source", "kind", "id"))):
+    """
+    The identity of a track, playlist or album, independent of how it was linked.
+
+    `str(key)`, e.g. "youtube:track:dQw4w9WgXcQ", is what caches and the
+    database store tracks under. Short links have the kind "link" and the
+    link itself as the ID until they are followed with `follow_link`.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return f"{self.source}:{self.kind}:{self.id}"
+
+    @property
+    def url(self):
+        """The canonical link to the item."""
+        if self.kind == "link":
+            return self.id
+        if self.source == "spotify":
+            return f"https://open.spotify.com/{self.kind}/{self.id}"
+        return CANONICAL_URLS[(self.source, self.kind)].format(id=self.id)
+
+@functools.lru_cache(maxsize=4096)
+def route(text):
+    """
+    Classifies a link to YouTube, Spotify or SoundCloud.
+
+    Args:
+        text (str): A link, with or without a scheme, or a Spotify URI.
+
+    Returns:
+        SourceKey: The linked item, or None if the text isn't a link to
+            something on a supported source.
+    """
+    text = text.strip()
+    if text.startswith("spotify:"):
+        match = SPOTIFY_URI.fullmatch(text)
+        return SourceKey("spotify", match["kind"], match["id"]) if match else None
+    if not LINK_SHAPE.fullmatch(text):
+        return None
+    parts = urlsplit(text if "://" in text else f"https://{text}")
+    try:
+        source, routes = HOSTS[parts.hostname]
+    except KeyError:
+        return None
+    path = parts.path or "/"
+    for kind, pattern, param, param_pattern in routes:
+        match = pattern.fullmatch(path)
+        if not match:
+            continue
+        if param:
+            item_id = dict(parse_qsl(parts.query)).get(param)
+            if item_id is None or not param_pattern.fullmatch(item_id):
+                continue
+        elif kind == "link":
+            item_id = f"https://{parts.hostname}{path}"
+        else:
+            item_id = match["id"]
+        groups = match.groupdict()
+        if source == "soundcloud" and kind != "link":
+            # Permalinks are case-insensitive; secret tokens aren't
+            item_id = item_id.lower()
+            if groups.get("secret"):
+                item_id = f"{item_id}/{groups['secret']}"
+        return SourceKey(source, kind or groups["kind"], item_id)
+    return None
+
+def canonical_key(url):
+    """
+    Returns the string that caches and the database know a track by.
+
+    Links to a supported source are keyed by their SourceKey; anything else
+    falls back to the normalized URL.
+    """
+    key = route(url)
+    return str(key) if key else normalize_key(url)
+
+def follow_link(url):
+    """
+    Follows a short link's redirects. Blocks on network I/O, so it runs on the resolver's pool.
+
+    Args:
+        url (str): e.g. "https://on.soundcloud.com/abc123".
+
+    Returns:
+        str: The URL it leads to, or None if it couldn't be followed.
+    """
+    try:
+        response = clients.session("links").head(url, allow_redirects=True, timeout=clients.timeout)
+        response.raise_for_status()
+        return response.url
+    except Exception as e:
+        print(f"Error following short link: {e}")
+        return None
@@ -0,0 +1,179 @@
+import array
+import asyncio
+import bisect
+import re
+import time
+
+from melody.api.clients import clients
+
+LRCLIB_SEARCH_URL = "https://lrclib.net/api/search"
+
+# One or more [mm:ss.xx] stamps in front of a line
+LRC_TIMESTAMP = re.compile(r"\[(\d+):(\d{1,2}(?:[.:]\d{1,3})?)\]")
+LRC_OFFSET = re.compile(r"\[offset:\s*([+-]?\d+)\]", re.IGNORECASE)
+
+# Discord allows about five message edits per five seconds per channel
+EDIT_INTERVAL = 1.5
+# Lines shown before and after the current one
+CONTEXT_BEFORE = 1
+CONTEXT_AFTER = 2
+
+class SyncedLyrics:
+    """
+    Timestamped (LRC) lyrics, parsed once into an array of start times.
+
+    Start times are milliseconds in a compact `array('l')`, sorted, and
+    `lines[i]` is the text sung from `offsets[i]`, so finding the line at a
+    playback position is a single binary search.
+    """
+    __slots__ = ("offsets", "lines")
+
+    def __init__(self, offsets, lines):
+        self.offsets = offsets
+        self.lines = lines
+
+    @classmethod
+    def parse(cls, lrc):
+        """
+        Parses LRC text.
+
+        Args:
+            lrc (str): Lines like "[01:02.50]Some words"; metadata tags and
+                unstamped lines are ignored, and an [offset:ms] tag is applied.
+
+        Returns:
+            SyncedLyrics: The lyrics, or None if no line has a timestamp.
+        """
+        offset_match = LRC_OFFSET.search(lrc)
+        # A positive offset makes lyrics appear sooner
+        shift = -int(offset_match.group(1)) if offset_match else 0
+        entries = []
+        for line in lrc.splitlines():
+            stamps = []
+            position = 0
+            while True:
+                match = LRC_TIMESTAMP.match(line, position)
+                if not match:
+                    break
+                seconds = float(match.group(2).replace(":", "."))
+                stamps.append(int((int(match.group(1)) * 60 + seconds) * 1000))
+                position = match.end()
+            text = line[position:].strip()
+            # A line may repeat, e.g. a chorus stamped at every occurrence
+            entries.extend((max(stamp + shift, 0), text) for stamp in stamps)
+        if not entries:
+            return None
+        entries.sort(key=lambda entry: entry[0])
+        return cls(array.array("l", (stamp for stamp, _ in entries)), [text for _, text in entries])
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __sizeof__(self):
+        # Lets the lyrics cache account for the parsed lyrics rather than just this object
+        return object.__sizeof__(self) + self.offsets.buffer_info()[1] * self.offsets.itemsize + sum(
+            len(line) for line in self.lines
+        )
+
+    def line_at(self, position_ms):
+        """
+        Returns the index of the line being sung at a playback position, or -1 before the first line.
+        """
+        return bisect.bisect_right(self.offsets, position_ms) - 1
+
+    def next_change(self, index):
+        """
+        Returns when the line after `index` starts, in milliseconds, or None after the last line.
+        """
+        return self.offsets[index + 1] if index + 1 < len(self.offsets) else None
+
+    def render(self, index, title=None):
+        """
+        Formats the lines around `index` with the current line in bold.
+        """
+        lines = [f"**{title}**"] if title else []
+        for current in range(max(index - CONTEXT_BEFORE, 0), min(index + CONTEXT_AFTER + 1, len(self.lines))):
+            text = self.lines[current] or "♪"
+            lines.append(f"> **{text}**" if current == index else text)
+        if index < 0:
+            lines.append("♪")
+        return "\n".join(lines)
+
+def search_lrclib(song_title, artist_name=None, duration=None):
+    """
+    Looks up synced lyrics on lrclib.net. Blocks on network I/O, so it runs on a worker pool.
+
+    Args:
+        song_title (str): The title of the song.
+        artist_name (str, optional): The name of the artist.
+        duration (float, optional): The song's length in seconds, to pick the right recording.
+
+    Returns:
+        str: LRC text, or None if lrclib has no synced lyrics for the song.
+    """
+    params = {"track_name": song_title}
+    if artist_name:
+        params["artist_name"] = artist_name
+    response = clients.session("lrclib").get(LRCLIB_SEARCH_URL, params=params, timeout=clients.timeout)
+    response.raise_for_status()
+    candidates = [track for track in response.json() if track.get("syncedLyrics")]
+    if not candidates:
+        return None
+    if duration:
+        candidates.sort(key=lambda track: abs((track.get("duration") or 0) - duration))
+    return candidates[0]["syncedLyrics"]
+
+class KaraokeSession:
+    """
+    Keeps a message showing the line being sung, following the player's position.
+
+    The session sleeps until the next line is due rather than polling, and
+    edits at most once per EDIT_INTERVAL: lines that go by faster are
+    coalesced into a single edit showing the latest one.
+    """
+    def __init__(self, message, lyrics, position, title=None, edit_interval=EDIT_INTERVAL):
+        """
+        Args:
+            message (discord.Message): The message to keep editing.
+            lyrics (SyncedLyrics): The lyrics of the song.
+            position (callable): Returns the playback position in seconds, or None once the song is over.
+            title (str, optional): Shown above the lyrics.
+            edit_interval (float, optional): The minimum seconds between edits.
+        """
+        self.message = message
+        self.lyrics = lyrics
+        self.position = position
+        self.title = title
+        self.edit_interval = edit_interval
+        self.shown = None
+        self.last_edit = 0.0
+        self.edits = 0
+
+    async def run(self):
+        """Edits the message until the song ends or the task is cancelled."""
+        while True:
+            position = self.position()
+            if position is None:
+                return
+            position_ms = int(position * 1000)
+            index = self.lyrics.line_at(position_ms)
+            wait = self.last_edit + self.edit_interval - time.monotonic()
+            if index != self.shown and wait <= 0:
+                await self.edit(index)
+                wait = self.edit_interval
+            next_change = self.lyrics.next_change(index)
+            if next_change is None and index == self.shown:
+                return
+            if index == self.shown:
+                # Nothing to show until the next line starts
+                wait = max(wait, (next_change - position_ms) / 1000)
+            await asyncio.sleep(max(wait, 0.05))
+
+    async def edit(self, index):
+        try:
+            await self.message.edit(content=self.lyrics.render(index, self.title))
+        except Exception as e:
+            print(f"Error updating lyrics: {e}")
+        self.shown = index
+        self.last_edit = time.monotonic()
+        self.edits += 1
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+import pytest
+
+async_database = pytest.importorskip("melody.database.async_database")
+
+
+class BlockingBatches:
+    """A playlist cursor whose second batch blocks until released."""
+    def __init__(self):
+        self.fetching = threading.Event()
+        self.release = threading.Event()
+        self.closed = threading.Event()
+
+    def __call__(self, *args):
+        try:
+            yield ["first"]
+            self.fetching.set()
+            self.release.wait(5)
+            yield ["second"]
+        finally:
+            self.closed.set()
+
+
+@pytest.fixture
+def database():
+    database = async_database.AsyncDatabase("mongodb://localhost", "melody", max_workers=2)
+    yield database
+    database.executor.shutdown(wait=False)
+
+
+def test_cancelling_mid_batch_closes_the_cursor_once_the_fetch_ends(database, monkeypatch):
+    batches = BlockingBatches()
+    monkeypatch.setattr(database.database, "iter_playlist_songs", batches)
+    received = []
+
+    async def consume():
+        async for batch in database.iter_playlist_songs("mix", 1):
+            received.append(batch)
+
+    async def run():
+        task = asyncio.ensure_future(consume())
+        while not batches.fetching.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        # The cancellation itself surfaces, not "generator already executing"
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not batches.closed.is_set()
+        batches.release.set()
+        return await asyncio.get_running_loop().run_in_executor(None, batches.closed.wait, 5)
+
+    assert asyncio.run(run())
+    assert received == [["first"]]
+
+
+def test_cancelled_track_index_rebuild_stops_cleanly(database, monkeypatch):
+    batches = BlockingBatches()
+    monkeypatch.setattr(database.database, "iter_tracks", batches)
+
+    async def rebuild():
+        async for _ in database.iter_tracks():
+            pass
+
+    async def run():
+        task = asyncio.ensure_future(rebuild())
+        while not batches.fetching.is_set():
+            await asyncio.sleep(0.01)
+        # As at shutdown, while the next batch is still being read
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        batches.release.set()
+        return await asyncio.get_running_loop().run_in_executor(None, batches.closed.wait, 5)
+
+    assert asyncio.run(run())
+
+
+def test_close_waits_for_running_writes_without_blocking_the_loop(database):
+    release = threading.Event()
+    written = []
+
+    def slow_write():
+        release.wait(5)
+        written.append(True)
+
+    async def run():
+        write = asyncio.ensure_future(database._run(slow_write))
+        await asyncio.sleep(0.01)
+        close = asyncio.ensure_future(database.close())
+        # The loop keeps running while close waits for the write
+        await asyncio.sleep(0.05)
+        assert not close.done()
+        release.set()
+        await asyncio.wait_for(asyncio.gather(write, close), 5)
+
+    asyncio.run(run())
+    assert written == [True]
@@ -0,0 +1,58 @@
+import subprocess
+import sys
+
+import pytest
+
+audio_handler = pytest.importorskip("melody.utils.audio_handler")
+
+# Writes a few frames of silence, then hangs like an ffmpeg that would need its output read
+FAKE_FFMPEG = "import sys, time; sys.stdout.buffer.write(bytes(3840 * 4)); sys.stdout.flush(); time.sleep(60)"
+
+
+class FakeCommand:
+    """Stands in for an ffmpeg-python command, running a Python process instead of ffmpeg."""
+    def __init__(self):
+        self.args = []
+        self.process = None
+
+    def output(self, *args, **kwargs):
+        return self
+
+    def global_args(self, *args):
+        self.args.extend(args)
+        return self
+
+    def run_async(self, pipe_stdout=False, pipe_stderr=False, quiet=False):
+        # An unread stderr pipe could fill and stall ffmpeg
+        assert not (pipe_stderr or quiet)
+        self.process = subprocess.Popen([sys.executable, "-c", FAKE_FFMPEG], stdout=subprocess.PIPE)
+        return self.process
+
+
+class FailingWriter:
+    def write(self, frame):
+        raise OSError("disk full")
+
+    def abort(self):
+        self.aborted = True
+
+
+class FakeCache:
+    def __init__(self):
+        self.writer_ = FailingWriter()
+
+    def writer(self, key):
+        return self.writer_
+
+
+def test_cache_opus_stops_ffmpeg_when_caching_fails(monkeypatch):
+    command = FakeCommand()
+    monkeypatch.setattr(audio_handler.ffmpeg, "input", lambda *args, **kwargs: command)
+    cache = FakeCache()
+
+    assert audio_handler.AudioHandler().cache_opus("song.mp3", "test:song", opus_cache=cache) is False
+
+    assert cache.writer_.aborted
+    assert command.args == ["-loglevel", "error"]
+    # Killed and reaped rather than left sleeping
+    assert command.process.returncode is not None
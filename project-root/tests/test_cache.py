@@ -0,0 +1,59 @@
+import threading
+import time
+
+from melody.api.scheduler import request_deadline
+from melody.utils.cache import ResolutionCache
+
+
+def test_waiters_give_up_on_a_hung_loader_at_their_deadline():
+    cache = ResolutionCache(max_wait=5.0)
+    release = threading.Event()
+    loading = threading.Event()
+
+    def hung_loader():
+        loading.set()
+        release.wait(5)
+        return "late"
+
+    leader = threading.Thread(target=cache.get_or_load, args=("track:a", hung_loader))
+    leader.start()
+    loading.wait(5)
+
+    request_deadline.set(time.monotonic() + 0.1)
+    started = time.monotonic()
+    try:
+        assert cache.get_or_load("track:a", lambda: "unused") is None
+    finally:
+        request_deadline.set(None)
+        release.set()
+        leader.join(5)
+    assert time.monotonic() - started < 1.0
+    # The leader's result still lands in the cache for later callers
+    assert cache.get("track:a") == "late"
+
+
+def test_waiters_share_the_leaders_result():
+    cache = ResolutionCache()
+    loading = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def loader():
+        calls.append(1)
+        loading.set()
+        release.wait(5)
+        return "value"
+
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("k", loader))) for _ in range(4)]
+    threads[0].start()
+    loading.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == ["value"] * 4
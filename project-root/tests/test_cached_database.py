@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+cached_database = pytest.importorskip("melody.database.cached_database")
+
+
+class SlowDatabase:
+    """An in-memory AsyncDatabase whose batch writes wait for `release`."""
+    def __init__(self):
+        self.users = {}
+        self.playlists = {}
+        self.release = asyncio.Event()
+        self.writing = asyncio.Event()
+        self.fail = False
+
+    async def get_user_data(self, user_id):
+        user = self.users.get(user_id)
+        return dict(user) if user is not None else None
+
+    async def save_many_user_data(self, updates):
+        self.writing.set()
+        await self.release.wait()
+        if self.fail:
+            return False
+        for user_id, user_data in updates.items():
+            self.users.setdefault(user_id, {"_id": user_id}).update(user_data)
+        return True
+
+    async def add_songs_to_playlists(self, additions):
+        if self.fail:
+            return False
+        for key, songs in additions.items():
+            if key in self.playlists:
+                self.playlists[key].extend(songs)
+        return True
+
+    async def get_playlist(self, playlist_name, user_id):
+        songs = self.playlists.get((playlist_name, user_id))
+        if songs is None:
+            return None
+        return {"name": playlist_name, "user_id": user_id, "songs": list(songs)}
+
+    async def get_playlist_summary(self, playlist_name, user_id):
+        songs = self.playlists.get((playlist_name, user_id))
+        if songs is None:
+            return None
+        return {"name": playlist_name, "user_id": user_id, "song_count": len(songs)}
+
+
+def song(number):
+    return {"title": f"Song {number}", "url": f"https://www.youtube.com/watch?v=song{number:07d}"}
+
+
+def test_reads_during_a_flush_see_the_batch_being_written():
+    async def run():
+        database = SlowDatabase()
+        database.playlists[("mix", 1)] = [song(1)]
+        cache = cached_database.CachedDatabase(database)
+        await cache.save_user_data(1, {"volume": 80})
+        await cache.add_songs_to_playlist("mix", [song(2)], 1)
+
+        flush = asyncio.ensure_future(cache.flush())
+        await database.writing.wait()
+        # Cache misses while the batch is being written
+        reads = asyncio.gather(
+            cache.get_user_data(1),
+            cache.get_playlist("mix", 1),
+            cache.get_playlist_summary("mix", 1),
+        )
+        await asyncio.sleep(0)
+        database.release.set()
+        await flush
+        return await reads, cache
+
+    (user, playlist, summary), cache = asyncio.run(run())
+    assert user["volume"] == 80
+    assert playlist["songs"] == [song(1), song(2)]
+    assert summary["song_count"] == 2
+    assert not cache.inflight_users and not cache.inflight_songs
+
+
+def test_failed_flush_keeps_its_writes_visible_and_pending():
+    async def run():
+        database = SlowDatabase()
+        database.playlists[("mix", 1)] = []
+        database.fail = True
+        database.release.set()
+        cache = cached_database.CachedDatabase(database)
+        await cache.add_songs_to_playlist("mix", [song(1)], 1)
+        await cache.flush()
+        await cache.add_songs_to_playlist("mix", [song(2)], 1)
+        return cache, await cache.get_playlist("mix", 1)
+
+    cache, playlist = asyncio.run(run())
+    assert playlist["songs"] == [song(1), song(2)]
+    assert cache.pending_songs[("mix", 1)] == [song(1), song(2)]
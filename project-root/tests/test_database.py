@@ -0,0 +1,113 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+database = pytest.importorskip("melody.database.database")
+
+from pymongo.errors import BulkWriteError
+
+
+@pytest.fixture
+def db():
+    db = database.Database("mongodb://localhost", "melody")
+    db.client = mongomock.MongoClient()
+    db.db = db.client["melody"]
+    db.ensure_indexes()
+    return db
+
+
+def song(number):
+    return {"title": f"Song {number}", "url": f"https://www.youtube.com/watch?v=song{number:07d}"}
+
+
+def titles(db, name, user_id=1):
+    return [entry["title"] for entry in db.get_playlist(name, user_id)["songs"]]
+
+
+def fail_inserts_after(db, monkeypatch, count):
+    # Inserts the first `count` documents, then fails like an interrupted bulk insert
+    entries = db.db.playlist_entries
+    insert_many = entries.insert_many
+
+    def failing_insert_many(documents, ordered=True):
+        documents = list(documents)
+        if count:
+            insert_many(documents[:count], ordered=ordered)
+        raise BulkWriteError({"writeErrors": [], "nInserted": count})
+
+    monkeypatch.setattr(entries, "insert_many", failing_insert_many)
+    return lambda: monkeypatch.setattr(entries, "insert_many", insert_many)
+
+
+def test_failed_batch_is_undone_and_retried_exactly_once(db, monkeypatch):
+    db.create_playlist("a", 1)
+    db.create_playlist("b", 1)
+    db.add_songs_to_playlist("a", [song(0)], 1)
+    additions = {("a", 1): [song(1), song(2)], ("b", 1): [song(3)]}
+
+    restore = fail_inserts_after(db, monkeypatch, 2)
+    assert db.add_songs_to_playlists(additions) is False
+    assert titles(db, "a") == ["Song 0"]
+    assert db.get_playlist_summary("a", 1)["song_count"] == 1
+    assert db.get_playlist_summary("b", 1)["song_count"] == 0
+
+    restore()
+    assert db.add_songs_to_playlists(additions) is True
+    assert titles(db, "a") == ["Song 0", "Song 1", "Song 2"]
+    assert titles(db, "b") == ["Song 3"]
+    assert db.get_playlist_summary("a", 1)["song_count"] == 3
+    # The released positions were reused, so entries stay evenly spaced
+    assert db._entry_positions(db.get_playlist("a", 1)["_id"], 3) == [0, 1024, 2048]
+
+
+def test_failed_reservation_releases_earlier_ones(db, monkeypatch):
+    db.create_playlist("a", 1)
+    db.create_playlist("b", 1)
+    reserve = db._reserve_positions
+
+    def reserve_then_fail(playlist_name, user_id, count):
+        if playlist_name == "b":
+            raise ConnectionError("lost the connection")
+        return reserve(playlist_name, user_id, count)
+
+    monkeypatch.setattr(db, "_reserve_positions", reserve_then_fail)
+    assert db.add_songs_to_playlists({("a", 1): [song(1)], ("b", 1): [song(2)]}) is False
+    playlist = db.db.playlists.find_one({"name": "a"})
+    assert (playlist["song_count"], playlist["next_position"]) == (0, 0)
+
+
+def test_duplicate_playlists_are_merged_before_indexing(monkeypatch):
+    db = database.Database("mongodb://localhost", "melody")
+    db.client = mongomock.MongoClient()
+    db.db = db.client["melody"]
+    # Older versions inserted playlists without checking for an existing name
+    db.db.playlists.insert_many([
+        {"name": "mix", "user_id": 1, "songs": [song(1), song(2)]},
+        {"name": "mix", "user_id": 1, "songs": [song(3)]},
+        {"name": "mix", "user_id": 2, "songs": [song(4)]},
+    ])
+
+    db.ensure_indexes()
+
+    assert db.db.playlists.count_documents({"name": "mix", "user_id": 1}) == 1
+    assert titles(db, "mix") == ["Song 1", "Song 2", "Song 3"]
+    assert db.get_playlist_summary("mix", 1)["song_count"] == 3
+    assert titles(db, "mix", 2) == ["Song 4"]
+    index_names = {collection: set(db.db[collection].index_information()) for collection in ("playlists", "playlist_entries", "lyrics")}
+    assert "user_id_name_unique" in index_names["playlists"]
+    assert "playlist_id_position_unique" in index_names["playlist_entries"]
+    assert "expires_at_ttl" in index_names["lyrics"]
+
+
+def test_index_failure_does_not_skip_the_others(db, monkeypatch, capsys):
+    db.db.drop_collection("lyrics")
+    db.db.drop_collection("playlist_entries")
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("lost the connection")
+
+    monkeypatch.setattr(db.db.playlists, "create_index", fail)
+    db.ensure_indexes()
+
+    assert "playlist_id_position_unique" in db.db.playlist_entries.index_information()
+    assert "expires_at_ttl" in db.db.lyrics.index_information()
+    assert "Error creating playlist name index" in capsys.readouterr().out
@@ -0,0 +1,83 @@
+import asyncio
+import time
+import types
+
+import pytest
+
+lyrics_handler = pytest.importorskip("melody.utils.lyrics_handler")
+
+
+class FakeGenius:
+    def __init__(self):
+        self.searches = []
+
+    def search_song(self, song_title, artist_name=None):
+        self.searches.append((song_title, artist_name))
+        return None
+
+
+def test_prefetch_skips_songs_still_named_by_their_url():
+    handler = lyrics_handler.LyricsHandler(None)
+    handler.genius = FakeGenius()
+    url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+    songs = [
+        types.SimpleNamespace(title="Rick Astley - Never Gonna Give You Up", url=url),
+        types.SimpleNamespace(title=url, url=url),
+    ]
+
+    async def run():
+        handler.prefetch(songs)
+        await asyncio.sleep(0)
+        await asyncio.gather(*handler.pending.values())
+
+    try:
+        asyncio.run(run())
+    finally:
+        handler.shutdown()
+    assert handler.genius.searches == [("Never Gonna Give You Up", "Rick Astley")]
+
+
+class SlowGenius:
+    def __init__(self, lyrics):
+        self.lyrics = lyrics
+        self.searches = 0
+
+    def search_song(self, song_title, artist_name=None):
+        self.searches += 1
+        time.sleep(0.05)
+        return types.SimpleNamespace(lyrics=self.lyrics) if self.lyrics else None
+
+
+def test_concurrent_fetches_share_one_lookup_and_are_cached():
+    handler = lyrics_handler.LyricsHandler(None)
+    handler.genius = SlowGenius("We're no strangers to love")
+
+    async def run():
+        first = await asyncio.gather(*(
+            handler.fetch_lyrics(title)
+            for title in ["Rick Astley - Never Gonna Give You Up", "Rick Astley - Never Gonna Give You Up (Official Video)"] * 3
+        ))
+        again = await handler.fetch_lyrics("rick astley - never gonna give you up")
+        return first, again
+
+    try:
+        first, again = asyncio.run(run())
+    finally:
+        handler.shutdown()
+    assert set(first) == {"We're no strangers to love"}
+    assert again == "We're no strangers to love"
+    assert handler.genius.searches == 1
+
+
+def test_songs_without_lyrics_are_remembered():
+    handler = lyrics_handler.LyricsHandler(None)
+    handler.genius = SlowGenius(None)
+
+    async def run():
+        return [await handler.fetch_lyrics("Instrumental") for _ in range(3)]
+
+    try:
+        assert asyncio.run(run()) == [None, None, None]
+    finally:
+        handler.shutdown()
+    assert handler.genius.searches == 1
@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+
+music_player = pytest.importorskip("melody.music_player.music_player")
+
+from melody.music_player.song_queue import REPEAT_ALL
+
+
+class FakeSong:
+    """A queued song whose lookup returns a fixed stream URL (None if it can't be resolved)."""
+    def __init__(self, title, stream_url):
+        self.title = title
+        self.url = f"https://www.youtube.com/watch?v={title:_<11}"
+        self.source = "youtube"
+        self.track_key = f"test:{title}"
+        self.stream_url = stream_url
+        self.duration = None
+        self.queued_duration = None
+        self.codec = None
+
+    @property
+    def info(self):
+        return {"title": self.title, "duration": self.duration}
+
+    def update_info(self, info):
+        self.title = info.get("title") or self.title
+        self.duration = info.get("duration") or self.duration
+
+    def take_warm_source(self):
+        return None
+
+    async def get_audio_stream(self):
+        return self.stream_url
+
+
+class FakeVoiceClient:
+    def __init__(self):
+        self.played = []
+        self.source = None
+        self.after = None
+
+    def play(self, source, after=None):
+        self.played.append(source)
+        self.source = source
+        self.after = after
+
+    def is_playing(self):
+        return False
+
+
+class FakeContext:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, message):
+        self.messages.append(message)
+
+
+class FakePrefetcher:
+    def schedule(self, queue):
+        pass
+
+    def drop(self, song):
+        pass
+
+    def cancel(self):
+        pass
+
+
+@pytest.fixture
+def player(monkeypatch):
+    monkeypatch.setattr(music_player, "create_audio_source", lambda stream, **kwargs: stream)
+    monkeypatch.setattr(music_player.default_track_search, "record", lambda song: None)
+    player = music_player.MusicPlayer()
+    player.voice_client = FakeVoiceClient()
+    player.prefetcher = FakePrefetcher()
+    return player
+
+
+def test_unresolvable_song_mid_queue_is_skipped(player):
+    ctx = FakeContext()
+    player.queue.extend([FakeSong("first", "stream-1"), FakeSong("broken", None), FakeSong("last", "stream-3")])
+
+    async def run():
+        await player.queue_next(ctx)
+        assert player.voice_client.played == ["stream-1"]
+        # The first song ends; the broken one is passed over for the last
+        await player.advance_after_track(ctx)
+        assert player.voice_client.played == ["stream-1", "stream-3"]
+        assert player.is_playing
+        assert player.current_song.title == "last"
+        await player.advance_after_track(ctx)
+
+    asyncio.run(run())
+    assert not player.is_playing
+    assert ctx.messages == [
+        "Now playing: first",
+        "Error playing broken. Skipping to the next song.",
+        "Now playing: last",
+    ]
+
+
+def test_queue_of_unresolvable_songs_stops(player):
+    ctx = FakeContext()
+    player.queue.extend([FakeSong("one", None), FakeSong("two", None)])
+    player.queue.repeat = REPEAT_ALL
+
+    asyncio.run(player.queue_next(ctx))
+
+    # Looping doesn't retry dead links forever, and a new !play can start playback again
+    assert not player.is_playing
+    assert player.voice_client.played == []
+    assert len(ctx.messages) == 3
+
+
+def test_passthrough_defaults_to_the_remuxable_volume(player, monkeypatch):
+    created = []
+    monkeypatch.setattr(music_player, "create_opus_audio_source", lambda stream, **kwargs: created.append(kwargs) or stream)
+    passthrough = music_player.MusicPlayer(opus_passthrough=True, normalize=True)
+    passthrough.voice_client = FakeVoiceClient()
+    passthrough.prefetcher = FakePrefetcher()
+    song = FakeSong("opus", "stream-1")
+    song.codec = "opus"
+    passthrough.queue.append(song)
+
+    asyncio.run(passthrough.queue_next(FakeContext()))
+
+    # Unmeasured songs get no loudness correction, so the stream can be copied
+    assert created[0]["gain"] == 1.0
+    assert player.volume == 0.5
+
+
+def test_cached_song_takes_its_title_and_duration_from_the_cache(player, monkeypatch):
+    class FakeCache:
+        def open(self, key):
+            return FakeCached()
+
+    class FakeCached:
+        metadata = {"title": "Never Gonna Give You Up", "duration": 213}
+
+    monkeypatch.setattr(music_player, "default_opus_cache", FakeCache())
+    monkeypatch.setattr(music_player, "create_cached_audio_source", lambda cached, **kwargs: cached)
+    ctx = FakeContext()
+    # Never looked up, so it still goes by its URL
+    player.queue.append(FakeSong("https://youtu.be/dQw4w9WgXcQ", None))
+
+    asyncio.run(player.queue_next(ctx))
+
+    assert player.current_song.duration == 213
+    assert ctx.messages == ["Now playing: Never Gonna Give You Up"]
@@ -0,0 +1,118 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+opus_cache = pytest.importorskip("melody.utils.opus_cache")
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+@pytest.mark.skipif(os.name == "nt", reason="liveness of other processes isn't probed on Windows")
+def test_index_only_removes_partial_files_of_dead_processes(tmp_path):
+    cache = opus_cache.OpusCache(str(tmp_path))
+    digest = cache.digest("youtube:track:dQw4w9WgXcQ")
+    path = cache.path_for(digest)
+    os.makedirs(os.path.dirname(path))
+    abandoned = f"{path}.{dead_pid()}.1.part"
+    in_progress = f"{path}.{os.getppid()}.1.part"
+    for part in (abandoned, in_progress):
+        open(part, "wb").close()
+
+    cache.load()
+    assert "youtube:track:dQw4w9WgXcQ" not in cache
+    assert not os.path.exists(abandoned)
+    assert os.path.exists(in_progress)
+
+
+def test_part_pid():
+    assert opus_cache.part_pid("ab12.frames.4321.140001.part") == 4321
+    assert opus_cache.part_pid("stray.part") is None
+
+
+class FakeEncoder:
+    """Stands in for libopus, which the cache format doesn't depend on."""
+    SAMPLES_PER_FRAME = 960
+
+    def encode(self, frame, samples):
+        return frame[:8]
+
+
+def test_title_and_duration_are_stored_with_the_track(tmp_path, monkeypatch):
+    monkeypatch.setattr(opus_cache.discord.opus, "Encoder", FakeEncoder)
+    cache = opus_cache.OpusCache(str(tmp_path))
+    writer = cache.writer("youtube:track:dQw4w9WgXcQ", {"title": "Never Gonna Give You Up", "duration": 213})
+    writer.write(b"\1" * 3840)
+    writer.commit()
+
+    # A fresh process finds it on disk
+    source = opus_cache.OpusCache(str(tmp_path)).open("youtube:track:dQw4w9WgXcQ")
+    assert source is not None
+    try:
+        assert source.metadata == {"title": "Never Gonna Give You Up", "duration": 213}
+        assert source.read() == b"\1" * 8
+    finally:
+        source.cleanup()
+
+
+def store(cache, key, packets):
+    writer = cache.writer(key)
+    for packet in packets:
+        writer.write(packet.ljust(3840, b"\0"))
+    writer.commit()
+
+
+def test_cached_track_plays_back_its_packets(tmp_path, monkeypatch):
+    monkeypatch.setattr(opus_cache.discord.opus, "Encoder", FakeEncoder)
+    cache = opus_cache.OpusCache(str(tmp_path))
+    store(cache, "youtube:track:a", [b"packet-1", b"packet-2"])
+
+    assert cache.writer("youtube:track:a") is None
+    source = cache.open("youtube:track:a")
+    try:
+        assert [source.read(), source.read(), source.read()] == [b"packet-1", b"packet-2", b""]
+    finally:
+        source.cleanup()
+    assert cache.open("youtube:track:b") is None
+    assert cache.stats()["tracks"] == 1
+
+
+def test_least_recently_played_tracks_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(opus_cache.discord.opus, "Encoder", FakeEncoder)
+    # Each track is one 10-byte record (2-byte length and an 8-byte packet)
+    cache = opus_cache.OpusCache(str(tmp_path), max_bytes=25)
+    store(cache, "a", [b"a"])
+    store(cache, "b", [b"b"])
+    cache.open("a").cleanup()
+
+    store(cache, "c", [b"c"])
+
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert not os.path.exists(cache.path_for(cache.digest("b")))
+    assert cache.total_bytes == 20
+    # The index rebuilt from disk agrees
+    reopened = opus_cache.OpusCache(str(tmp_path))
+    # Looking a track up never walks the directory; that is left to `load`
+    assert "a" not in reopened and reopened.entries is None
+    reopened.load()
+    assert "a" in reopened and "b" not in reopened
+
+
+def test_aborted_and_disabled_caches_store_nothing(tmp_path, monkeypatch):
+    monkeypatch.setattr(opus_cache.discord.opus, "Encoder", FakeEncoder)
+    cache = opus_cache.OpusCache(str(tmp_path))
+    writer = cache.writer("skipped")
+    writer.write(b"\0" * 3840)
+    writer.abort()
+    assert "skipped" not in cache
+    assert not any(name.endswith(".part") for _, _, names in os.walk(tmp_path) for name in names)
+
+    disabled = opus_cache.OpusCache()
+    assert disabled.writer("anything") is None
+    assert disabled.open("anything") is None
@@ -0,0 +1,41 @@
+import types
+
+from melody.music_player.queue_view import QueueView
+from melody.music_player.song_queue import SongQueue
+
+URL = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+
+def make_song(title, duration=None):
+    return types.SimpleNamespace(title=title, url=URL, duration=duration, queued_duration=None)
+
+
+def resolve(song, title, duration):
+    # What Song.update_info does once a lookup returns
+    song.title, song.duration = title, duration
+
+
+def test_resolved_titles_replace_urls_in_cached_pages():
+    song = make_song(URL)
+    queue = SongQueue([make_song("Known", 60.0), song])
+    view = QueueView(queue)
+    assert URL in view.render()
+
+    resolve(song, "Never Gonna Give You Up", None)
+    queue.refresh_song(song)
+    assert "2. Never Gonna Give You Up" in view.render()
+
+    resolve(song, song.title, 213.0)
+    queue.refresh_song(song)
+    assert "Never Gonna Give You Up (3:33)" in view.render()
+    assert "4:33" in view.render()
+
+
+def test_now_playing_line_follows_the_current_songs_title():
+    view = QueueView(SongQueue())
+    current = make_song(URL)
+    assert URL in view.render(current_song=current)
+
+    # Played from the audio cache, which names it without a queue change
+    resolve(current, "Never Gonna Give You Up", 213.0)
+    assert "**Now playing:** Never Gonna Give You Up (3:33)" in view.render(current_song=current)
@@ -0,0 +1,55 @@
+import asyncio
+import types
+
+import pytest
+
+registry = pytest.importorskip("melody.music_player.registry")
+
+
+class FakePlayer:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.is_playing = False
+        self.last_active = 0.0
+        self.resolve_cancelled = False
+        self.expansion_task = None
+        self.prefetcher = types.SimpleNamespace(cancelled=False)
+        self.prefetcher.cancel = lambda: setattr(self.prefetcher, "cancelled", True)
+        self.voice_client = None
+
+    def cancel_resolve(self):
+        self.resolve_cancelled = True
+
+
+def test_evicted_players_stop_their_background_work():
+    players = registry.GuildPlayerRegistry(idle_timeout=0.0, player_factory=FakePlayer)
+
+    async def run():
+        player = players.get(1)
+        player.last_active = 0.0
+        player.expansion_task = asyncio.ensure_future(asyncio.sleep(60))
+        assert await players.evict_idle() == 1
+        await asyncio.sleep(0)
+        return player
+
+    player = asyncio.run(run())
+    assert player.resolve_cancelled
+    assert player.prefetcher.cancelled
+    assert player.expansion_task.cancelled()
+    assert players.peek(1) is None
+
+
+def test_players_removed_during_eviction_are_skipped():
+    players = registry.GuildPlayerRegistry(idle_timeout=0.0, player_factory=FakePlayer)
+
+    class SlowVoiceClient:
+        async def disconnect(self):
+            # Meanwhile another command forgets the next idle player
+            players.remove(2)
+            await asyncio.sleep(0)
+
+    players.get(1).voice_client = SlowVoiceClient()
+    players.get(2)
+
+    assert asyncio.run(players.evict_idle()) == 1
+    assert len(players) == 0
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+
+from melody.api.scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_NOW_PLAYING,
+    RateLimited,
+    RequestScheduler,
+    request_priority,
+)
+from melody.music_player.resolver import PrioritySemaphore, StreamResolver
+
+
+def test_priority_semaphore_admits_by_priority_then_arrival():
+    order = []
+
+    async def run():
+        semaphore = PrioritySemaphore(1)
+        release = asyncio.Event()
+
+        async def holder():
+            async with semaphore.hold(PRIORITY_BACKGROUND):
+                await release.wait()
+
+        async def waiter(name, priority):
+            async with semaphore.hold(priority):
+                order.append(name)
+
+        first = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+        waiters = [
+            asyncio.ensure_future(waiter("prefetch 1", PRIORITY_BACKGROUND)),
+            asyncio.ensure_future(waiter("prefetch 2", PRIORITY_BACKGROUND)),
+            asyncio.ensure_future(waiter("now playing", PRIORITY_NOW_PLAYING)),
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *waiters)
+        return semaphore
+
+    semaphore = asyncio.run(run())
+    assert order == ["now playing", "prefetch 1", "prefetch 2"]
+    assert semaphore.value == 1
+
+
+def test_priority_semaphore_skips_cancelled_waiters():
+    async def run():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire(PRIORITY_BACKGROUND)
+        cancelled = asyncio.ensure_future(semaphore.acquire(PRIORITY_NOW_PLAYING))
+        waiting = asyncio.ensure_future(semaphore.acquire(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        semaphore.release()
+        await asyncio.wait_for(waiting, 1)
+        semaphore.release()
+        return semaphore
+
+    assert asyncio.run(run()).value == 1
+
+
+def test_now_playing_lookup_is_started_before_queued_prefetches():
+    started = []
+    gate = threading.Event()
+
+    def lookup(name):
+        started.append(name)
+        gate.wait(5)
+        return name
+
+    async def run():
+        resolver = StreamResolver(source_limits={"youtube": 1})
+        with request_priority(PRIORITY_BACKGROUND):
+            tasks = [asyncio.ensure_future(resolver.resolve("youtube", lookup, f"prefetch {i}")) for i in range(3)]
+        await asyncio.sleep(0.05)
+        with request_priority(PRIORITY_NOW_PLAYING):
+            tasks.append(asyncio.ensure_future(resolver.resolve("youtube", lookup, "now playing")))
+        await asyncio.sleep(0.05)
+        gate.set()
+        results = await asyncio.gather(*tasks)
+        resolver.shutdown()
+        return results
+
+    asyncio.run(run())
+    assert started == ["prefetch 0", "now playing", "prefetch 1", "prefetch 2"]
+
+
+def test_timed_out_lookup_stops_waiting_on_the_scheduler():
+    scheduler = RequestScheduler(budgets={"svc": (100.0, 1)}, max_wait=30.0)
+    scheduler.pause("svc", 10.0)
+    finished = threading.Event()
+    outcome = []
+
+    def lookup():
+        try:
+            outcome.append(scheduler.call("svc", lambda: "called"))
+        except RateLimited as e:
+            outcome.append(e)
+        finished.set()
+
+    async def run():
+        resolver = StreamResolver(timeout=0.2)
+        result = await resolver.resolve("svc", lookup)
+        resolver.shutdown()
+        return result
+
+    started = time.monotonic()
+    assert asyncio.run(run()) is None
+    # The worker thread gave up with the lookup instead of holding a thread for the full pause
+    assert finished.wait(2)
+    assert time.monotonic() - started < 2
+    assert isinstance(outcome[0], RateLimited)
+
+
+def test_event_loop_stays_responsive_during_50_lookups():
+    def lookup(i):
+        # Stands in for youtube_dl blocking on the network
+        time.sleep(0.2)
+        return i
+
+    async def run():
+        resolver = StreamResolver(max_workers=16, source_limits={"youtube": 16})
+        lags = []
+
+        async def ticker():
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(0.01)
+                lags.append(time.monotonic() - before - 0.01)
+
+        ticks = asyncio.ensure_future(ticker())
+        results = await asyncio.gather(*(resolver.resolve("youtube", lookup, i) for i in range(50)))
+        ticks.cancel()
+        resolver.shutdown()
+        return results, lags
+
+    results, lags = asyncio.run(run())
+    assert results == list(range(50))
+    # Run synchronously, the lookups would stall the loop for 10 seconds
+    assert len(lags) > 20
+    assert max(lags) < 0.1
@@ -0,0 +1,149 @@
+import email.utils
+import threading
+import time
+
+import pytest
+
+from melody.api.scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_NOW_PLAYING,
+    QUOTA_BACKOFF,
+    RateLimited,
+    RequestScheduler,
+    TokenBucket,
+    parse_retry_after,
+    rate_limit_delay,
+    request_priority,
+)
+
+
+class FakeSpotifyError(Exception):
+    """Looks like spotipy's SpotifyException."""
+    def __init__(self, http_status, headers=None):
+        super().__init__(f"http status {http_status}")
+        self.http_status = http_status
+        self.headers = headers
+
+
+class FakeGoogleResponse(dict):
+    def __init__(self, status):
+        super().__init__()
+        self.status = status
+
+
+class FakeGoogleError(Exception):
+    """Looks like googleapiclient's HttpError."""
+    def __init__(self, status, reason):
+        super().__init__(f"<HttpError {status}: {reason}>")
+        self.resp = FakeGoogleResponse(status)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("2.5") == 2.5
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    later = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 <= parse_retry_after(later) <= 60
+
+
+def test_rate_limit_delay_recognizes_each_client():
+    assert rate_limit_delay(FakeSpotifyError(429, {"retry-after": "7"})) == 7.0
+    # No Retry-After: back off by the scheduler's own schedule
+    assert rate_limit_delay(FakeSpotifyError(503)) == 0.0
+    assert rate_limit_delay(FakeSpotifyError(404)) is None
+    assert rate_limit_delay(FakeGoogleError(403, "quotaExceeded")) == QUOTA_BACKOFF
+    assert rate_limit_delay(FakeGoogleError(403, "userRateLimitExceeded")) == 0.0
+    assert rate_limit_delay(FakeGoogleError(403, "forbidden")) is None
+    assert rate_limit_delay(ValueError("unrelated")) is None
+
+
+def test_token_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(rate=10.0, burst=2)
+    now = bucket.updated
+    for _ in range(2):
+        assert bucket.wait_time(now) == 0.0
+        bucket.take()
+    assert bucket.wait_time(now) == pytest.approx(0.1)
+    assert bucket.wait_time(now + 0.1) == pytest.approx(0.0)
+
+
+def test_calls_are_paced_to_the_budget():
+    scheduler = RequestScheduler(budgets={"svc": (20.0, 1)})
+    started = time.monotonic()
+    for _ in range(5):
+        scheduler.call("svc", lambda: None)
+    # One call from the burst, then one every 50ms
+    assert time.monotonic() - started >= 0.19
+
+
+def test_rate_limited_call_pauses_the_service_and_retries():
+    scheduler = RequestScheduler(budgets={"svc": (100.0, 10)})
+    attempts = []
+
+    def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise FakeSpotifyError(429, {"retry-after": "0.2"})
+        return "ok"
+
+    assert scheduler.call("svc", flaky) == "ok"
+    assert attempts[1] - attempts[0] >= 0.19
+    assert scheduler.queue("svc").rate_limited.value >= 1
+
+
+def test_long_pause_raises_instead_of_waiting():
+    scheduler = RequestScheduler(budgets={"svc": (100.0, 10)}, max_wait=0.5)
+    scheduler.pause("svc", 60)
+    started = time.monotonic()
+    with pytest.raises(RateLimited):
+        scheduler.call("svc", lambda: "never")
+    assert time.monotonic() - started < 0.5
+
+
+def test_identical_calls_in_flight_are_coalesced():
+    scheduler = RequestScheduler(budgets={"svc": (100.0, 10)})
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return "page"
+
+    threads = [
+        threading.Thread(target=lambda: results.append(scheduler.call("svc", fetch, key="page:0")))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == ["page"] * 5
+
+
+def test_waiting_callers_go_in_priority_order():
+    scheduler = RequestScheduler(budgets={"svc": (20.0, 1)})
+    # Spend the burst so everyone below has to queue
+    scheduler.call("svc", lambda: None)
+    order = []
+
+    def caller(name, priority):
+        with request_priority(priority):
+            scheduler.call("svc", order.append, name)
+
+    threads = []
+    for name, priority in [("prefetch 1", PRIORITY_BACKGROUND), ("prefetch 2", PRIORITY_BACKGROUND), ("now playing", PRIORITY_NOW_PLAYING)]:
+        thread = threading.Thread(target=caller, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join(5)
+
+    assert order == ["now playing", "prefetch 1", "prefetch 2"]
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+song_module = pytest.importorskip("melody.music_player.song")
+
+
+class BlockingResolver:
+    """Holds every lookup until cancelled, recording the cancellation."""
+    def __init__(self):
+        self.started = 0
+        self.cancelled = 0
+
+    async def resolve(self, source, load):
+        self.started += 1
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+
+def test_lookup_is_cancelled_once_its_last_waiter_is():
+    resolver = BlockingResolver()
+    song = song_module.Song("https://youtu.be/dQw4w9WgXcQ", "https://youtu.be/dQw4w9WgXcQ", "youtube", resolver=resolver)
+
+    async def run():
+        player = asyncio.ensure_future(song.get_audio_stream())
+        prefetch = asyncio.ensure_future(song.get_audio_stream())
+        await asyncio.sleep(0.01)
+        assert resolver.started == 1
+
+        # The prefetcher still wants the stream, so the lookup goes on
+        player.cancel()
+        await asyncio.sleep(0.01)
+        assert resolver.cancelled == 0
+
+        prefetch.cancel()
+        await asyncio.sleep(0.01)
+        assert resolver.cancelled == 1
+        assert song.pending is None
+
+        # A later play starts a fresh lookup
+        retry = asyncio.ensure_future(song.get_audio_stream())
+        await asyncio.sleep(0.01)
+        assert resolver.started == 2
+        retry.cancel()
+        await asyncio.gather(player, prefetch, retry, return_exceptions=True)
+
+    asyncio.run(run())
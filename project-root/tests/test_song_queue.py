@@ -0,0 +1,122 @@
+import random
+import time
+import types
+
+import pytest
+
+from melody.music_player.song_queue import REPEAT_ALL, REPEAT_ONE, SongQueue
+
+
+def make_song(name, duration=None):
+    return types.SimpleNamespace(title=name, duration=duration, queued_duration=None)
+
+
+def test_operations_match_a_list_across_block_boundaries():
+    rng = random.Random(1)
+    songs = [make_song(i) for i in range(200)]
+    queue = SongQueue(songs, block_size=4)
+    expected = list(songs)
+    for step in range(2000):
+        operation = rng.choice(("append", "popleft", "pop", "insert", "move", "set"))
+        if operation == "append" or not expected:
+            song = make_song(f"new {step}")
+            queue.append(song)
+            expected.append(song)
+        elif operation == "popleft":
+            assert queue.popleft() is expected.pop(0)
+        elif operation == "pop":
+            index = rng.randrange(-len(expected), len(expected))
+            assert queue.pop(index) is expected.pop(index)
+        elif operation == "insert":
+            index = rng.randrange(-len(expected), len(expected) + 2)
+            song = make_song(f"inserted {step}")
+            queue.insert(index, song)
+            expected.insert(index, song)
+        elif operation == "move":
+            source, destination = rng.randrange(len(expected)), rng.randrange(len(expected))
+            queue.move(source, destination)
+            expected.insert(destination, expected.pop(source))
+        else:
+            index = rng.randrange(len(expected))
+            song = make_song(f"replaced {step}")
+            queue[index] = song
+            expected[index] = song
+        assert len(queue) == len(expected)
+    assert list(queue) == expected
+    assert [queue[i] for i in range(len(expected))] == expected
+    assert list(queue.iter_from(len(expected) // 2)) == expected[len(expected) // 2:]
+    with pytest.raises(IndexError):
+        queue[len(expected)]
+
+
+def test_total_duration_follows_every_change():
+    queue = SongQueue(block_size=2)
+    known, unknown = make_song("known", 200.0), make_song("unknown")
+    queue.extend([known, unknown, make_song("other", 100.0)])
+    assert (queue.total_duration, queue.unknown_durations) == (300.0, 1)
+
+    unknown.duration = 50.0
+    queue.refresh_song(unknown)
+    assert (queue.total_duration, queue.unknown_durations) == (350.0, 0)
+
+    queue.pop(0)
+    assert queue.total_duration == 150.0
+    assert known.queued_duration is None
+    # A song that already left the queue doesn't change the total
+    known.duration = 999.0
+    queue.refresh_song(known)
+    assert queue.total_duration == 150.0
+
+    queue.clear()
+    assert (queue.total_duration, queue.unknown_durations, len(queue)) == (0.0, 0, 0)
+
+
+def test_shuffle_keeps_every_song():
+    songs = [make_song(i) for i in range(1000)]
+    queue = SongQueue(songs, block_size=16)
+    # Uneven blocks, which the shuffle evens out
+    for _ in range(100):
+        queue.insert(3, queue.pop(500))
+    version = queue.version
+
+    queue.shuffle(random.Random(7))
+
+    assert queue.version > version
+    assert sorted(song.title for song in queue) == list(range(1000))
+    assert list(queue) != sorted(queue, key=lambda song: song.title)
+    assert [queue[i] for i in range(len(queue))] == list(queue)
+
+
+def test_advance_honours_the_repeat_mode():
+    first, second = make_song("first"), make_song("second")
+    queue = SongQueue([first, second])
+    assert queue.advance(None) is first
+
+    queue.repeat = REPEAT_ALL
+    # The finished song goes back to the end
+    assert queue.advance(first) is second
+    assert list(queue) == [first]
+
+    queue.repeat = REPEAT_ONE
+    assert queue.advance(second) is second
+    # Skipping moves on even when repeating one song
+    assert queue.advance(second, skip=True) is first
+    assert not queue
+
+
+def test_large_queues_stay_fast():
+    # A plain list pays O(n) for every popleft and insert near the front
+    count = 200000
+    queue = SongQueue(make_song(i) for i in range(count))
+    rng = random.Random(3)
+
+    started = time.perf_counter()
+    for _ in range(10000):
+        queue.insert(rng.randrange(len(queue)), queue.pop(rng.randrange(len(queue))))
+        queue[rng.randrange(len(queue))]
+    for _ in range(count):
+        queue.popleft()
+    elapsed = time.perf_counter() - started
+
+    assert not queue
+    assert elapsed < 5.0
@@ -0,0 +1,84 @@
+import pytest
+
+source_router = pytest.importorskip("melody.utils.source_router")
+
+from melody.utils.source_router import SourceKey, canonical_key, route
+
+VIDEO = "dQw4w9WgXcQ"
+SPOTIFY = "4cOdK2wGLETKBW3PvgPWqT"
+YOUTUBE_LIST = "PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG"
+
+LINKS = {
+    f"https://www.youtube.com/watch?v={VIDEO}": ("youtube", "track", VIDEO),
+    f"https://youtube.com/watch?v={VIDEO}&t=42s": ("youtube", "track", VIDEO),
+    f"http://m.youtube.com/watch?feature=share&v={VIDEO}": ("youtube", "track", VIDEO),
+    f"https://music.youtube.com/watch?v={VIDEO}&si=abc": ("youtube", "track", VIDEO),
+    f"https://www.youtube.com/watch?v={VIDEO}&list={YOUTUBE_LIST}&index=3": ("youtube", "track", VIDEO),
+    f"youtube.com/watch?v={VIDEO}": ("youtube", "track", VIDEO),
+    f"HTTPS://WWW.YOUTUBE.COM/watch?v={VIDEO}": ("youtube", "track", VIDEO),
+    f"https://youtu.be/{VIDEO}": ("youtube", "track", VIDEO),
+    f"https://youtu.be/{VIDEO}?si=xyz&t=10": ("youtube", "track", VIDEO),
+    f"https://www.youtube.com/shorts/{VIDEO}": ("youtube", "track", VIDEO),
+    f"https://www.youtube.com/embed/{VIDEO}?autoplay=1": ("youtube", "track", VIDEO),
+    f"https://www.youtube-nocookie.com/embed/{VIDEO}": ("youtube", "track", VIDEO),
+    f"https://www.youtube.com/live/{VIDEO}?feature=shared": ("youtube", "track", VIDEO),
+    f"https://www.youtube.com/playlist?list={YOUTUBE_LIST}": ("youtube", "playlist", YOUTUBE_LIST),
+    f"https://open.spotify.com/track/{SPOTIFY}": ("spotify", "track", SPOTIFY),
+    f"https://open.spotify.com/track/{SPOTIFY}?si=abcdef": ("spotify", "track", SPOTIFY),
+    f"https://open.spotify.com/intl-de/track/{SPOTIFY}": ("spotify", "track", SPOTIFY),
+    f"https://open.spotify.com/intl-pt-br/album/{SPOTIFY}": ("spotify", "album", SPOTIFY),
+    f"https://open.spotify.com/embed/playlist/{SPOTIFY}": ("spotify", "playlist", SPOTIFY),
+    f"https://open.spotify.com/user/spotify/playlist/{SPOTIFY}": ("spotify", "playlist", SPOTIFY),
+    f"https://open.spotify.com/artist/{SPOTIFY}": ("spotify", "artist", SPOTIFY),
+    f"spotify:track:{SPOTIFY}": ("spotify", "track", SPOTIFY),
+    f"spotify:user:someone:playlist:{SPOTIFY}": ("spotify", "playlist", SPOTIFY),
+    "https://spotify.link/AbCdEf123": ("spotify", "link", "https://spotify.link/AbCdEf123"),
+    "https://soundcloud.com/artist-name/track-name": ("soundcloud", "track", "artist-name/track-name"),
+    "https://soundcloud.com/Artist-Name/Track-Name?in=x/sets/y": ("soundcloud", "track", "artist-name/track-name"),
+    "https://m.soundcloud.com/artist/track/": ("soundcloud", "track", "artist/track"),
+    "https://soundcloud.com/artist/track/s-AbCdEf": ("soundcloud", "track", "artist/track/s-AbCdEf"),
+    "https://soundcloud.com/artist/sets/my-set": ("soundcloud", "playlist", "artist/sets/my-set"),
+    "https://on.soundcloud.com/Ab12Cd": ("soundcloud", "link", "https://on.soundcloud.com/Ab12Cd"),
+}
+
+NOT_LINKS = [
+    "",
+    "never gonna give you up",
+    "best youtube.com songs",
+    "https://example.com/watch?v=" + VIDEO,
+    "https://notyoutube.com/watch?v=" + VIDEO,
+    "https://youtube.com.evil.com/watch?v=" + VIDEO,
+    "https://www.youtube.com/watch?v=short",
+    "https://www.youtube.com/@channel",
+    "https://www.youtube.com/results?search_query=x",
+    "https://youtu.be/",
+    "https://open.spotify.com/track/short",
+    "spotify:track:bad",
+    "https://soundcloud.com/artist",
+    "https://soundcloud.com/artist/likes",
+    "https://soundcloud.com/artist/sets",
+    "https://soundcloud.com/discover/sets",
+    "https://soundcloud.com/search/sounds?q=x",
+]
+
+
+@pytest.mark.parametrize("link, expected", LINKS.items())
+def test_links_route_to_their_item(link, expected):
+    assert route(link) == expected
+
+
+@pytest.mark.parametrize("text", NOT_LINKS)
+def test_other_text_is_not_routed(text):
+    assert route(text) is None
+
+
+def test_every_spelling_of_a_track_shares_one_key():
+    spellings = [link for link, key in LINKS.items() if key == ("youtube", "track", VIDEO)]
+    assert {canonical_key(link) for link in spellings} == {f"youtube:track:{VIDEO}"}
+    # Links to other sites fall back to the normalized URL
+    assert canonical_key("https://example.com/song.mp3").startswith("https://example.com/")
+
+
+def test_canonical_urls_route_back_to_the_same_key():
+    for key in map(SourceKey._make, LINKS.values()):
+        assert route(key.url) == key
@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+
+synced_lyrics = pytest.importorskip("melody.utils.synced_lyrics")
+
+from melody.utils.synced_lyrics import KaraokeSession, SyncedLyrics
+
+LRC = """[ar:Rick Astley]
+[ti:Never Gonna Give You Up]
+[00:18.50]We're no strangers to love
+[00:22.10]You know the rules and so do I
+[00:43.00][01:30.25]Never gonna give you up
+no timestamp here
+[01:00.00]
+"""
+
+
+def test_parse_orders_lines_and_repeats_choruses():
+    lyrics = SyncedLyrics.parse(LRC)
+
+    assert list(lyrics.offsets) == [18500, 22100, 43000, 60000, 90250]
+    assert lyrics.lines == [
+        "We're no strangers to love",
+        "You know the rules and so do I",
+        "Never gonna give you up",
+        "",
+        "Never gonna give you up",
+    ]
+    assert SyncedLyrics.parse("[ar:Rick Astley]\nplain lyrics") is None
+
+
+def test_offset_tag_shifts_every_line():
+    lyrics = SyncedLyrics.parse("[offset:+500]\n[00:00.20]first\n[00:02.00]second")
+    # Positive offsets show lines sooner, but never before the song starts
+    assert list(lyrics.offsets) == [0, 1500]
+
+
+def test_line_at_and_next_change():
+    lyrics = SyncedLyrics.parse(LRC)
+
+    assert lyrics.line_at(0) == -1
+    assert lyrics.line_at(18500) == 0
+    assert lyrics.line_at(42999) == 1
+    assert lyrics.line_at(10 ** 7) == 4
+    assert lyrics.next_change(-1) == 18500
+    assert lyrics.next_change(1) == 43000
+    assert lyrics.next_change(4) is None
+
+
+def test_render_marks_the_current_line():
+    lyrics = SyncedLyrics.parse(LRC)
+
+    assert lyrics.render(3, "Title") == "**Title**\nNever gonna give you up\n> **♪**\nNever gonna give you up"
+    assert lyrics.render(-1).endswith("♪")
+
+
+class FakeMessage:
+    def __init__(self):
+        self.contents = []
+
+    async def edit(self, content):
+        self.contents.append(content)
+
+
+def test_karaoke_coalesces_lines_faster_than_the_edit_rate():
+    # A line every 20ms for half a second
+    lyrics = SyncedLyrics.parse("\n".join(f"[00:00.{i * 2:02d}]line {i}" for i in range(25)))
+    message = FakeMessage()
+    started = time.monotonic()
+
+    def position():
+        elapsed = time.monotonic() - started
+        return elapsed if elapsed < 0.7 else None
+
+    session = KaraokeSession(message, lyrics, position, edit_interval=0.2)
+    asyncio.run(asyncio.wait_for(session.run(), 5))
+
+    assert 2 <= session.edits <= 5
+    # The last edit shows the latest line rather than one that went by
+    assert "> **line 24**" in message.contents[-1]